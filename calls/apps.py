@@ -4,3 +4,17 @@ from django.apps import AppConfig
 class CallsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'calls'
+
+    def ready(self):
+        from talkeasy import services
+        from calls import heartbeats, metering, reaper, sweeper
+        from calls.timers import timers
+
+        # Importing these registers their timer handlers
+        from calls import autoend, timeouts
+
+        services.register("call-metering", metering.run)
+        services.register("call-timers", timers.run)
+        services.register("call-sweeper", sweeper.run)
+        services.register("call-heartbeats", heartbeats.run)
+        services.register("call-reaper", reaper.run)
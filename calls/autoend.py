@@ -0,0 +1,79 @@
+# calls/autoend.py
+"""
+End calls exactly when the caller's coins run out.
+
+A call's talk budget is the user's balance plus whatever the meter has
+already taken from it (``coins_deducted``), so the deadline is
+``joined_at + budget / coins_per_second``. The clock starts when the
+call is joined, so that is when the timer is first armed; calls that are
+never joined have no deadline. Top-ups re-arm every joined call of the
+user.
+
+Balances can change in another worker, so when a timer fires the
+deadline is recomputed from the database and the timer re-armed if the
+user still has talk time left.
+"""
+import time
+from channels.db import database_sync_to_async
+from calls.models import AgoraCallHistory
+from calls.notifications import notify_call_ended
+from calls.settlement import settle_call
+from calls.timers import timers
+from users.models import UserStats
+
+AUTO_END = "auto_end"
+
+# Timers that fire this close to the recomputed deadline end the call
+DEADLINE_SLACK_SECONDS = 1
+
+
+def talk_deadline(coin_balance, coins_per_second, joined_at, coins_deducted=0):
+    """Epoch seconds at which the call's talk budget is used up, or None if unmetered or not joined."""
+    if not joined_at or not coins_per_second or coins_per_second <= 0:
+        return None
+    budget_seconds = (coin_balance + coins_deducted) / coins_per_second
+    return joined_at.timestamp() + budget_seconds
+
+
+def arm_auto_end(call):
+    coin_balance = (
+        UserStats.objects.filter(user_id=call.user_id)
+        .values_list("coin_balance", flat=True).first()
+    ) or 0
+    deadline = talk_deadline(coin_balance, call.coins_per_second, call.joined_at, call.coins_deducted)
+    if deadline is None:
+        timers.cancel(AUTO_END, call.id)
+    else:
+        timers.arm(AUTO_END, call.id, deadline)
+
+
+def rearm_user_calls(user_id):
+    """Push the deadline of every active call of ``user_id`` after a top-up."""
+    for call in AgoraCallHistory.objects.filter(user_id=user_id, is_active=True, joined_at__isnull=False):
+        arm_auto_end(call)
+
+
+def expire_calls(call_ids):
+    """Settle the calls that are really out of talk time; re-arm the rest."""
+    rows = AgoraCallHistory.objects.filter(id__in=call_ids, is_active=True).values_list(
+        "id", "joined_at", "coins_per_second", "coins_deducted", "user__stats__coin_balance",
+    )
+    settled = []
+    now = time.time()
+    for call_id, joined_at, coins_per_second, coins_deducted, coin_balance in rows:
+        deadline = talk_deadline(coin_balance or 0, coins_per_second, joined_at, coins_deducted)
+        if deadline is None:
+            continue
+        if deadline > now + DEADLINE_SLACK_SECONDS:
+            timers.arm(AUTO_END, call_id, deadline)
+            continue
+        result = settle_call(call_id, ender="system")
+        if result:
+            settled.append(result)
+    return settled
+
+
+@timers.handler(AUTO_END)
+async def auto_end_calls(call_ids):
+    for settled in await database_sync_to_async(expire_calls)(call_ids):
+        await notify_call_ended(settled, "Talk time used up, call ended automatically")
@@ -1,15 +1,32 @@
+# calls/consumers.py
+"""
+Call signalling socket.
+
+Who the socket belongs to is resolved once on connect: the user, the
+executive they manage (if any) and the ids of the active calls either
+of them is a party to. ``incoming_call`` events add calls to that set
+and end / cancel / reject / miss events remove them, so call actions
+authorize against the connection instead of querying for the executive
+again. A call id the socket has not heard of falls back to one
+authorization query and is remembered if it checks out.
+"""
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.utils import timezone
 from django.contrib.auth.models import AnonymousUser
 from django.db import models
+from calls.heartbeats import heartbeats
 from calls.models import AgoraCallHistory
+from calls.timeouts import call_accepted, heartbeat_received
 from executives.models import Executive
+from talkeasy.dbpool import consumer_db, db_executor
+from talkeasy.wire import WireProtocolMixin, text_of, with_text
 from users.models import UserProfile
 
 
-class CallConsumer(AsyncWebsocketConsumer):
+class CallConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
+    executive = None
+
     async def connect(self):
         try:
             # Get user from middleware (set by JWTAuthMiddleware)
@@ -35,7 +52,8 @@ class CallConsumer(AsyncWebsocketConsumer):
             
             # Check if user is an executive
             self.executive_group_name = None
-            executive = await self.get_executive_for_user(self.user)
+            executive = self.executive = await self.get_executive_for_user(self.user)
+            self.call_ids = await self.get_active_call_ids()
             if executive:
                 self.executive_group_name = f"executive_{executive.id}"
                 await self.channel_layer.group_add(
@@ -114,7 +132,7 @@ class CallConsumer(AsyncWebsocketConsumer):
                 await self.handle_heartbeat(data)
                 
             elif message_type == 'get_user_info':
-                executive = await self.get_executive_for_user(self.user)
+                executive = self.executive
                 await self.send(text_data=json.dumps({
                     'type': 'user_info',
                     'user_id': self.user.id,
@@ -143,6 +161,11 @@ class CallConsumer(AsyncWebsocketConsumer):
         if not call_id:
             await self.send_error("Call ID is required")
             return
+        try:
+            call_id = int(call_id)
+        except (TypeError, ValueError):
+            await self.send_error("Call not found or access denied")
+            return
             
         try:
             call = await self.get_user_call(call_id)
@@ -169,8 +192,8 @@ class CallConsumer(AsyncWebsocketConsumer):
 
     async def accept_call(self, call):
         """Executive accepts the call"""
-        executive = await self.get_executive_for_user(self.user)
-        if not executive or call.executive.id != executive.id:
+        executive = self.executive
+        if not executive or call.executive_id != executive.id:
             await self.send_error("You don't have permission to accept this call")
             return
             
@@ -178,17 +201,18 @@ class CallConsumer(AsyncWebsocketConsumer):
             await self.send_error(f"Call is not in pending state. Current status: {call.status}")
             return
             
-        await database_sync_to_async(self.update_call_status)(call, 'ringing')
+        await self.update_call_status(call, 'ringing')
+        call_accepted(call.id)
         
         # Notify caller
         await self.channel_layer.group_send(
-            f"user_{call.user.id}",
-            {
+            f"user_{call.user_id}",
+            with_text({
                 'type': 'call_accepted_event',
                 'call_id': call.id,
                 'executive_token': getattr(call, 'executive_token', ''),
                 'callee_uid': getattr(call, 'callee_uid', None)
-            }
+            })
         )
         
         await self.send(text_data=json.dumps({
@@ -202,8 +226,8 @@ class CallConsumer(AsyncWebsocketConsumer):
 
     async def reject_call(self, call):
         """Executive rejects the call"""
-        executive = await self.get_executive_for_user(self.user)
-        if not executive or call.executive.id != executive.id:
+        executive = self.executive
+        if not executive or call.executive_id != executive.id:
             await self.send_error("You don't have permission to reject this call")
             return
             
@@ -211,18 +235,19 @@ class CallConsumer(AsyncWebsocketConsumer):
             await self.send_error(f"Call cannot be rejected. Current status: {call.status}")
             return
             
-        await database_sync_to_async(self.update_call_status)(call, 'rejected')
+        await self.update_call_status(call, 'rejected')
+        self.call_ids.discard(call.id)
         
-        if hasattr(call, 'executive'):
-            await database_sync_to_async(self.clear_executive_on_call)(call.executive)
+        if call.executive_id:
+            await self.clear_executive_on_call(call.executive_id)
         
         # Notify caller
         await self.channel_layer.group_send(
-            f"user_{call.user.id}",
-            {
+            f"user_{call.user_id}",
+            with_text({
                 'type': 'call_rejected_event',
                 'call_id': call.id
-            }
+            })
         )
         
         await self.send(text_data=json.dumps({
@@ -236,36 +261,26 @@ class CallConsumer(AsyncWebsocketConsumer):
 
     async def end_call(self, call):
         """End an active call"""
-        user_can_end = await self.user_can_end_call(call)
+        user_can_end = self.user_can_end_call(call)
         if not user_can_end:
             await self.send_error("You don't have permission to end this call")
             return
             
         try:
-            await database_sync_to_async(call.end_call)(ender=f"user_{self.user.id}")
-            
-            if hasattr(call, 'executive'):
-                await database_sync_to_async(self.clear_executive_on_call)(call.executive)
+            # Settlement also releases executive.on_call in the same transaction
+            await db_executor.run(self.channel_name, call.end_call, ender=f"user_{self.user.id}")
+            self.call_ids.discard(call.id)
             
             # Notify both parties
-            await self.channel_layer.group_send(
-                f"user_{call.user.id}",
-                {
-                    'type': 'call_ended_event',
-                    'call_id': call.id,
-                    'duration': str(call.duration) if hasattr(call, 'duration') and call.duration else None
-                }
-            )
+            event = with_text({
+                'type': 'call_ended_event',
+                'call_id': call.id,
+                'duration': str(call.duration) if hasattr(call, 'duration') and call.duration else None
+            })
+            await self.channel_layer.group_send(f"user_{call.user_id}", event)
             
-            if hasattr(call, 'executive'):
-                await self.channel_layer.group_send(
-                    f"executive_{call.executive.id}",
-                    {
-                        'type': 'call_ended_event',
-                        'call_id': call.id,
-                        'duration': str(call.duration) if hasattr(call, 'duration') and call.duration else None
-                    }
-                )
+            if call.executive_id:
+                await self.channel_layer.group_send(f"executive_{call.executive_id}", event)
             
             await self.send(text_data=json.dumps({
                 'type': 'action_success',
@@ -281,7 +296,7 @@ class CallConsumer(AsyncWebsocketConsumer):
 
     async def cancel_call(self, call):
         """Cancel a pending call"""
-        if call.user.id != self.user.id:
+        if call.user_id != self.user.id:
             await self.send_error("You don't have permission to cancel this call")
             return
             
@@ -289,19 +304,20 @@ class CallConsumer(AsyncWebsocketConsumer):
             await self.send_error(f"Call cannot be cancelled. Current status: {call.status}")
             return
             
-        await database_sync_to_async(self.update_call_status)(call, 'cancelled')
+        await self.update_call_status(call, 'cancelled')
+        self.call_ids.discard(call.id)
         
-        if hasattr(call, 'executive'):
-            await database_sync_to_async(self.clear_executive_on_call)(call.executive)
+        if call.executive_id:
+            await self.clear_executive_on_call(call.executive_id)
         
         # Notify executive
-        if hasattr(call, 'executive'):
+        if call.executive_id:
             await self.channel_layer.group_send(
-                f"executive_{call.executive.id}",
-                {
+                f"executive_{call.executive_id}",
+                with_text({
                     'type': 'call_cancelled_event',
                     'call_id': call.id
-                }
+                })
             )
         
         await self.send(text_data=json.dumps({
@@ -315,21 +331,21 @@ class CallConsumer(AsyncWebsocketConsumer):
 
     async def join_call(self, call):
         """User joins the call"""
-        if call.user.id != self.user.id:
+        if call.user_id != self.user.id:
             await self.send_error("You don't have permission to join this call")
             return
             
         try:
-            await database_sync_to_async(call.mark_joined)()
+            await db_executor.run(self.channel_name, call.mark_joined)
             
-            if hasattr(call, 'executive'):
+            if call.executive_id:
                 await self.channel_layer.group_send(
-                    f"executive_{call.executive.id}",
-                    {
+                    f"executive_{call.executive_id}",
+                    with_text({
                         'type': 'call_joined_event',
                         'call_id': call.id,
                         'joined_at': call.joined_at.isoformat() if hasattr(call, 'joined_at') and call.joined_at else None
-                    }
+                    })
                 )
             
             await self.send(text_data=json.dumps({
@@ -355,7 +371,8 @@ class CallConsumer(AsyncWebsocketConsumer):
                     return
                     
                 if call.is_active and call.status == 'joined':
-                    await database_sync_to_async(self.update_heartbeat)(call)
+                    heartbeats.record(call.id)
+                    heartbeat_received(call.id)
                     
                     await self.send(text_data=json.dumps({
                         'type': 'heartbeat_ack',
@@ -368,8 +385,23 @@ class CallConsumer(AsyncWebsocketConsumer):
             except Exception as e:
                 await self.send_error(f"Error processing heartbeat: {str(e)}")
 
+    def is_party(self, call):
+        return call.user_id == self.user.id or (
+            self.executive is not None and call.executive_id == self.executive.id
+        )
+
+    def user_can_end_call(self, call):
+        """Check if user can end the call"""
+        return self.is_party(call)
+
+    def party_filter(self):
+        # By id, like the other checks here: scope["user"] need not be a UserProfile
+        if self.executive:
+            return models.Q(user_id=self.user.id) | models.Q(executive=self.executive)
+        return models.Q(user_id=self.user.id)
+
     # Database operations
-    @database_sync_to_async
+    @consumer_db
     def get_executive_for_user(self, user):
         """Get executive profile for the authenticated user"""
         try:
@@ -377,54 +409,41 @@ class CallConsumer(AsyncWebsocketConsumer):
         except:
             return None
 
-    @database_sync_to_async
-    def get_user_call(self, call_id):
-        """Get call that belongs to the authenticated user"""
+    @consumer_db
+    def get_active_call_ids(self):
         try:
-            executive = Executive.objects.filter(manager_executive=self.user).first()
-            
-            if executive:
-                return AgoraCallHistory.objects.filter(
-                    id=call_id
-                ).filter(
-                    models.Q(user=self.user) | models.Q(executive=executive)
-                ).first()
-            else:
-                return AgoraCallHistory.objects.filter(
-                    id=call_id, user=self.user
-                ).first()
+            return set(
+                AgoraCallHistory.objects.filter(self.party_filter(), is_active=True).values_list("id", flat=True)
+            )
         except:
-            return None
+            return set()
 
-    @database_sync_to_async
-    def user_can_end_call(self, call):
-        """Check if user can end the call"""
+    @consumer_db
+    def get_user_call(self, call_id):
+        """Get call that belongs to the authenticated user"""
         try:
-            if call.user.id == self.user.id:
-                return True
-                
-            executive = Executive.objects.filter(manager_executive=self.user).first()
-            if executive and call.executive.id == executive.id:
-                return True
-                
-            return False
+            if call_id in self.call_ids:
+                call = AgoraCallHistory.objects.filter(id=call_id).first()
+                if call is not None and self.is_party(call):
+                    return call
+                self.call_ids.discard(call_id)
+                return None
+            # Not announced to this socket (e.g. the event was missed)
+            call = AgoraCallHistory.objects.filter(self.party_filter(), id=call_id).first()
+            if call is not None and call.is_active:
+                self.call_ids.add(call.id)
+            return call
         except:
-            return False
+            return None
 
-    @database_sync_to_async
+    @consumer_db
     def update_call_status(self, call, status):
         call.status = status
         call.save(update_fields=['status'])
 
-    @database_sync_to_async
-    def clear_executive_on_call(self, executive):
-        executive.on_call = False
-        executive.save(update_fields=['on_call'])
-
-    @database_sync_to_async
-    def update_heartbeat(self, call):
-        call.last_heartbeat = timezone.now()
-        call.save(update_fields=['last_heartbeat'])
+    @consumer_db
+    def clear_executive_on_call(self, executive_id):
+        Executive.objects.filter(pk=executive_id).update(on_call=False)
 
     async def send_error(self, message):
         await self.send(text_data=json.dumps({
@@ -436,43 +455,48 @@ class CallConsumer(AsyncWebsocketConsumer):
 
     # WebSocket event handlers
     async def call_accepted_event(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=text_of(event, {
             'type': 'call_accepted',
             **event
         }))
 
     async def call_rejected_event(self, event):
-        await self.send(text_data=json.dumps({
+        self.call_ids.discard(event.get('call_id'))
+        await self.send(text_data=text_of(event, {
             'type': 'call_rejected',
             **event
         }))
 
     async def call_ended_event(self, event):
-        await self.send(text_data=json.dumps({
+        self.call_ids.discard(event.get('call_id'))
+        await self.send(text_data=text_of(event, {
             'type': 'call_ended',
             **event
         }))
 
     async def call_cancelled_event(self, event):
-        await self.send(text_data=json.dumps({
+        self.call_ids.discard(event.get('call_id'))
+        await self.send(text_data=text_of(event, {
             'type': 'call_cancelled',
             **event
         }))
 
     async def call_joined_event(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=text_of(event, {
             'type': 'call_joined',
             **event
         }))
 
     async def call_missed_event(self, event):
-        await self.send(text_data=json.dumps({
+        self.call_ids.discard(event.get('call_id'))
+        await self.send(text_data=text_of(event, {
             'type': 'call_missed',
             **event
         }))
 
     async def incoming_call(self, event):
-        await self.send(text_data=json.dumps({
+        self.call_ids.add(event.get('call_id'))
+        await self.send(text_data=text_of(event, {
             'type': 'incoming_call',
             **event
         }))
\ No newline at end of file
@@ -0,0 +1,97 @@
+# calls/heartbeats.py
+"""
+Write-coalescing buffer for call heartbeats.
+
+Heartbeats from the WebSocket consumer and the Agora webhook are kept in
+memory and written to ``AgoraCallHistory.last_heartbeat`` by the
+``call-heartbeats`` service every ``CALL_HEARTBEAT_FLUSH_SECONDS``.
+Timestamps are truncated to the second and calls sharing a second are
+written with one UPDATE, so a flush costs a handful of statements no
+matter how many calls are live.
+
+Anything that needs an up-to-date value should read it through
+``last_heartbeat()`` rather than straight from the database. Calls that
+sent nothing since the last flush are checked then, and dropped from the
+buffer once they are no longer active, whichever worker ended them.
+"""
+import threading
+from collections import defaultdict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from calls.models import AgoraCallHistory
+from calls.utils import chunked
+from talkeasy.services import run_periodic
+
+
+class HeartbeatBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # call_id -> newest heartbeat not yet written
+        self._latest = {}  # call_id -> newest heartbeat seen by this process
+
+    def record(self, call_id, at=None):
+        at = at or timezone.now()
+        with self._lock:
+            self._pending[call_id] = at
+            self._latest[call_id] = at
+
+    def last_heartbeat(self, call_id, stored=None):
+        """Newest of the buffered value and ``stored`` (the database value)."""
+        buffered = self._latest.get(call_id)
+        if buffered is None or (stored is not None and stored > buffered):
+            return stored
+        return buffered
+
+    def forget(self, call_id):
+        with self._lock:
+            self._pending.pop(call_id, None)
+            self._latest.pop(call_id, None)
+
+    def flush(self):
+        """Write pending heartbeats; returns how many calls were updated."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            idle = [call_id for call_id in self._latest if call_id not in pending]
+        if idle:
+            self.prune(idle)
+        if not pending:
+            return 0
+
+        by_second = defaultdict(list)
+        for call_id, at in pending.items():
+            by_second[at.replace(microsecond=0)].append(call_id)
+        try:
+            for at, call_ids in by_second.items():
+                for chunk in chunked(call_ids):
+                    AgoraCallHistory.objects.filter(id__in=chunk, is_active=True).update(last_heartbeat=at)
+        except Exception:
+            # Put the batch back unless a newer heartbeat arrived meanwhile
+            with self._lock:
+                for call_id, at in pending.items():
+                    self._pending.setdefault(call_id, at)
+            raise
+        return len(pending)
+
+    def prune(self, call_ids):
+        """Drop the buffered values of calls in ``call_ids`` that have ended."""
+        active = set()
+        for chunk in chunked(call_ids):
+            active.update(AgoraCallHistory.objects.filter(id__in=chunk, is_active=True).values_list("id", flat=True))
+        with self._lock:
+            for call_id in call_ids:
+                if call_id not in active and call_id not in self._pending:
+                    self._latest.pop(call_id, None)
+
+
+heartbeats = HeartbeatBuffer()
+
+
+async def run():
+    try:
+        await run_periodic(
+            getattr(settings, "CALL_HEARTBEAT_FLUSH_SECONDS", 5),
+            database_sync_to_async(heartbeats.flush),
+        )
+    finally:
+        await database_sync_to_async(heartbeats.flush)()
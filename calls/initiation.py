@@ -0,0 +1,51 @@
+# calls/initiation.py
+"""
+Query-lean helpers for ``CallInitiateView``.
+
+Initiating a call reads the executive, their rates and the caller's
+balance in one joined query, then claims the executive and inserts the
+call in one transaction.
+"""
+from django.db.models import Subquery
+from executives.models import Executive, ExecutiveStats
+from users.models import UserStats
+
+
+def load_executive_for_call(executive_id, user_id):
+    """
+    The executive with ``stats`` joined in and the caller's balance
+    annotated as ``caller_coin_balance`` (None when the caller has no
+    stats row), or None if the executive does not exist.
+    """
+    caller_balance = UserStats.objects.filter(user_id=user_id).values("coin_balance")[:1]
+    return (
+        Executive.objects.select_related("stats")
+        .annotate(caller_coin_balance=Subquery(caller_balance))
+        .filter(pk=executive_id)
+        .first()
+    )
+
+
+def executive_rates(executive):
+    """The executive's stats row; created for executives that never had one."""
+    try:
+        return executive.stats
+    except ExecutiveStats.DoesNotExist:
+        return ExecutiveStats.objects.get_or_create(executive=executive)[0]
+
+
+def claim_executive(executive_id):
+    """
+    Mark an available executive as on call in one conditional UPDATE.
+
+    Returns False when the executive is busy, banned or suspended by the
+    time the UPDATE runs, so of any number of simultaneous callers
+    exactly one can win. Whether they are online is presence's call and
+    is checked before claiming.
+    """
+    return Executive.objects.filter(
+        pk=executive_id,
+        on_call=False,
+        is_banned=False,
+        is_suspended=False,
+    ).update(on_call=True) == 1
@@ -0,0 +1,72 @@
+import contextlib
+import io
+import json
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from calls.consumers import CallConsumer
+from calls.timers import timers
+from executives.models import Executive
+from talkeasy.bench import Timer, bench_database, seed_calls, seed_parties
+
+
+class Command(BaseCommand):
+    help = "Measure CallConsumer actions per second on one worker and queries per action."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=200, help="Active calls the socket is a party to")
+        parser.add_argument("--actions", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        with bench_database():
+            self.run(options["calls"], options["actions"])
+
+    def run(self, calls, actions):
+        users, executives = seed_parties(calls)
+        manager = get_user_model().objects.create(email="bench@example.com", name="Bench manager")
+        executive = executives[0]
+        Executive.objects.filter(pk=executive.pk).update(manager_executive=manager)
+        call_ids = [call.id for call in seed_calls(users, [executive] * calls, status="joined")]
+
+        consumer = CallConsumer()
+        consumer.scope = {"type": "websocket", "user": manager}
+        consumer.channel_layer = get_channel_layer()
+        consumer.channel_name = "bench.call"
+        replies = [0]
+
+        async def base_send(message):
+            replies[0] += 1
+        consumer.base_send = base_send
+
+        queries = [0]
+
+        def count_queries(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        async def drive(messages):
+            for message in messages:
+                await consumer.receive(message)
+
+        workloads = {
+            "heartbeat": [
+                json.dumps({"type": "heartbeat", "call_id": call_ids[i % calls]}) for i in range(actions)
+            ],
+            "get_user_info": [json.dumps({"type": "get_user_info"})] * actions,
+        }
+        # The consumer prints every message it receives
+        with contextlib.redirect_stdout(io.StringIO()):
+            async_to_sync(consumer.connect)()
+        self.stdout.write(f"calls={calls} actions={actions} vendor={connection.vendor}")
+        for name, messages in workloads.items():
+            queries[0] = 0
+            with connection.execute_wrapper(count_queries), contextlib.redirect_stdout(io.StringIO()), Timer() as t:
+                async_to_sync(drive)(messages)
+            self.stdout.write(
+                f"{name}: {actions / t.elapsed:,.0f} actions/s queries/action={queries[0] / actions:.2f}"
+            )
+
+        for call_id in call_ids:
+            timers.cancel_call(call_id)
@@ -0,0 +1,77 @@
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIRequestFactory, force_authenticate
+from calls.models import AgoraCallHistory
+from calls.timers import timers
+from calls.views import CallInitiateView
+from talkeasy.bench import Timer, bench_database, seed_parties, summarize
+
+
+class Command(BaseCommand):
+    help = "Fire concurrent CallInitiateView requests at one executive and check exactly one wins."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--callers", type=int, default=300)
+        parser.add_argument("--workers", type=int, default=32)
+        parser.add_argument("--rounds", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with bench_database():
+            self.run(options["callers"], options["workers"], options["rounds"])
+
+    def run(self, callers, workers, rounds):
+        users, executives = seed_parties(callers)
+        target = executives[0]
+        factory = APIRequestFactory()
+        view = CallInitiateView.as_view()
+        start = threading.Barrier(workers)
+
+        latencies, statuses, winners = [], Counter(), []
+        elapsed = 0.0
+        for round_no in range(rounds):
+            def initiate(index):
+                request = factory.post("/calls/initiate/", {
+                    "executive_id": target.id,
+                    "channel_name": f"claim_{round_no}_{index}",
+                    "caller_uid": index,
+                }, format="json")
+                force_authenticate(request, user=users[index])
+                if index < workers:
+                    start.wait()
+                try:
+                    with Timer() as t:
+                        response = view(request)
+                    return response.status_code, t.elapsed
+                finally:
+                    connection.close()
+
+            with Timer() as t:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    results = list(pool.map(initiate, range(callers)))
+            elapsed += t.elapsed
+
+            round_statuses = Counter(code for code, _ in results)
+            statuses.update(round_statuses)
+            latencies.extend(latency for _, latency in results)
+            winners.append(round_statuses[201])
+
+            # Free the executive for the next round
+            for call_id in AgoraCallHistory.objects.filter(is_active=True).values_list("id", flat=True):
+                timers.cancel_call(call_id)
+            AgoraCallHistory.objects.filter(is_active=True).update(is_active=False, status="cancelled")
+            type(target).objects.filter(pk=target.pk).update(on_call=False)
+
+        stats = summarize(latencies)
+        total = callers * rounds
+        self.stdout.write(f"callers={callers} rounds={rounds} workers={workers} vendor={connection.vendor}")
+        self.stdout.write(f"throughput={total / elapsed:.1f} initiates/s statuses={dict(statuses)}")
+        self.stdout.write(
+            "latency: p50={p50_ms:.1f}ms p99={p99_ms:.1f}ms max={max_ms:.1f}ms".format(**stats)
+        )
+        if all(count == 1 for count in winners):
+            self.stdout.write(self.style.SUCCESS(f"Exactly one winner in each of {rounds} rounds"))
+        else:
+            self.stderr.write(self.style.ERROR(f"Winners per round: {winners}"))
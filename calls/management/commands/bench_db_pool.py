@@ -0,0 +1,63 @@
+import asyncio
+import time
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.db import connection
+from calls.models import AgoraCallHistory
+from talkeasy.bench import Timer, bench_database, seed_calls, seed_parties
+from talkeasy.dbpool import DBExecutor
+
+
+class Command(BaseCommand):
+    help = "Measure consumer ORM throughput against the DB pool size (0 = database_sync_to_async)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=200)
+        parser.add_argument("--queries", type=int, default=20, help="Queries per connection")
+        parser.add_argument("--sizes", default="0,1,2,4,8,16")
+        parser.add_argument(
+            "--latency-ms", type=float, default=0.0,
+            help="Extra round trip added to each query, to model a database across the network",
+        )
+
+    def handle(self, *args, **options):
+        with bench_database():
+            self.run(options)
+
+    def run(self, options):
+        connections, queries = options["connections"], options["queries"]
+        latency = options["latency_ms"] / 1000
+        users, executives = seed_parties(connections)
+        call_ids = [call.id for call in seed_calls(users, executives)]
+
+        def lookup(call_id):
+            call = AgoraCallHistory.objects.filter(id=call_id).first()
+            if latency:
+                time.sleep(latency)
+            return call
+
+        async def socket(executor, key, call_id):
+            for _ in range(queries):
+                await executor.run(key, lookup, call_id)
+
+        async def drive(executor):
+            await asyncio.gather(*(
+                socket(executor, f"bench.{i}", call_id) for i, call_id in enumerate(call_ids)
+            ))
+
+        self.stdout.write(
+            f"connections={connections} queries/connection={queries} "
+            f"latency={options['latency_ms']}ms vendor={connection.vendor}"
+        )
+        for size in [int(size) for size in options["sizes"].split(",")]:
+            executor = DBExecutor(size)
+            try:
+                with Timer() as t:
+                    async_to_sync(drive)(executor)
+            finally:
+                executor.shutdown()
+            stats = executor.stats()
+            self.stdout.write(
+                f"pool={size or 'sync-thread'}: {connections * queries / t.elapsed:,.0f} queries/s "
+                f"max_queued={stats['max_queued']}"
+            )
@@ -0,0 +1,59 @@
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from executives.consumers import UsersConsumer
+from executives.presence import PresenceSubscription, delta_text, presence_entry
+from talkeasy import wire
+from talkeasy.bench import Timer
+
+
+class Command(BaseCommand):
+    help = "Measure delivering one presence delta to every subscriber, encoded per socket or once per group."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subscribers", type=int, default=10000)
+        parser.add_argument("--executives", type=int, default=50, help="Entries in the delta")
+        parser.add_argument("--rounds", type=int, default=5)
+
+    def handle(self, *args, **options):
+        subscribers, rounds = options["subscribers"], options["rounds"]
+        entries = [
+            presence_entry(f"EX{i:04d}", f"Executive {i}", "online", gender="female", languages=[1, 2])
+            for i in range(options["executives"])
+        ]
+        sockets = [self.socket() for _ in range(subscribers)]
+
+        async def fan_out(event):
+            for socket in sockets:
+                await socket.presence_shard_delta(event)
+
+        def per_socket(version):
+            return {"type": "presence_shard_delta", "version": version, "executives": entries}
+
+        def once(version):
+            return {**per_socket(version), "text": delta_text(None, version, entries)}
+
+        self.stdout.write(
+            f"subscribers={subscribers} entries={len(entries)} rounds={rounds} "
+            f"encoder={'orjson' if wire.orjson is not None else 'json'}"
+        )
+        version = 0
+        for name, build in (("encode per socket", per_socket), ("encode once", once)):
+            with Timer() as t:
+                for _ in range(rounds):
+                    version += 1
+                    async_to_sync(fan_out)(build(version))
+            deliveries = subscribers * rounds
+            self.stdout.write(
+                f"{name}: {deliveries / t.elapsed:,.0f} deliveries/s "
+                f"{t.elapsed / rounds * 1000:.1f}ms per delta"
+            )
+
+    def socket(self):
+        consumer = UsersConsumer()
+        consumer.subscription = PresenceSubscription()
+        consumer.shard_versions = {}
+
+        async def base_send(message):
+            pass
+        consumer.base_send = base_send
+        return consumer
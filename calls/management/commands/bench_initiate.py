@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIRequestFactory, force_authenticate
+from calls.models import AgoraCallHistory
+from calls.timers import timers
+from calls.views import CallInitiateView
+from talkeasy.bench import Timer, bench_database, seed_parties, summarize
+
+
+class Command(BaseCommand):
+    help = "Measure p50/p99 CallInitiateView latency and queries per initiation."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        with bench_database():
+            self.run(options["calls"])
+
+    def run(self, calls):
+        users, executives = seed_parties(calls)
+        factory = APIRequestFactory()
+        view = CallInitiateView.as_view()
+
+        latencies, statuses, queries = [], {}, [0]
+
+        def count_queries(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            for i, (user, executive) in enumerate(zip(users, executives)):
+                request = factory.post("/calls/initiate/", {
+                    "executive_id": executive.id,
+                    "channel_name": f"init_{i}",
+                    "caller_uid": i,
+                }, format="json")
+                force_authenticate(request, user=user)
+                with Timer() as t:
+                    response = view(request)
+                latencies.append(t.elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        for call_id in AgoraCallHistory.objects.values_list("id", flat=True):
+            timers.cancel_call(call_id)
+
+        stats = summarize(latencies)
+        self.stdout.write(f"calls={calls} vendor={connection.vendor} statuses={statuses}")
+        self.stdout.write(f"queries/initiation={queries[0] / calls:.1f}")
+        self.stdout.write(
+            "latency: mean={mean_ms:.2f}ms p50={p50_ms:.2f}ms p99={p99_ms:.2f}ms max={max_ms:.2f}ms".format(**stats)
+        )
@@ -0,0 +1,43 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from calls.metering import charge_active_calls
+from calls.models import AgoraCallHistory
+from talkeasy.bench import Timer, bench_database, seed_calls, seed_parties, summarize
+
+
+class Command(BaseCommand):
+    help = "Benchmark one metering tick over N concurrently joined calls."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=10_000)
+        parser.add_argument("--ticks", type=int, default=20)
+        parser.add_argument("--balance", type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        with bench_database():
+            self.run(options["calls"], options["ticks"], options["balance"])
+
+    def run(self, count, ticks, balance):
+        users, executives = seed_parties(count, coin_balance=balance)
+        joined_at = timezone.now()
+        seed_calls(users, executives, status="joined", joined_at=joined_at)
+
+        samples, queries = [], []
+        exhausted = 0
+        for tick in range(1, ticks + 1):
+            with CaptureQueriesContext(connection) as captured, Timer() as t:
+                exhausted += len(charge_active_calls(joined_at + timedelta(seconds=tick)))
+            samples.append(t.elapsed)
+            queries.append(len(captured))
+
+        stats = summarize(samples)
+        charged = AgoraCallHistory.objects.aggregate(total=Sum("coins_deducted"))["total"]
+        self.stdout.write(f"active_calls={count} ticks={ticks} vendor={connection.vendor}")
+        self.stdout.write(
+            "per tick: mean={mean_ms:.1f}ms p50={p50_ms:.1f}ms p99={p99_ms:.1f}ms max={max_ms:.1f}ms".format(**stats)
+        )
+        self.stdout.write(f"queries/tick={max(queries)} coins_charged={charged} exhausted_call_ticks={exhausted}")
@@ -0,0 +1,81 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+from calls.models import AgoraCallHistory
+from calls.views import AgoraWebhookView, EndCallView
+from talkeasy.bench import Timer, bench_database, seed_calls, seed_parties
+from users.models import UserStats
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark call settlement: every call receives concurrent end requests "
+        "from the REST view, the WebSocket consumer path and the Agora webhook."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=500)
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument("--balance", type=int, default=10_000)
+
+    def handle(self, *args, **options):
+        with bench_database():
+            self.run(options["calls"], options["workers"], options["balance"])
+
+    def run(self, count, workers, balance):
+        users, executives = seed_parties(count, coin_balance=balance)
+        calls = seed_calls(
+            users, executives, status="joined",
+            joined_at=timezone.now() - timedelta(seconds=60),
+        )
+
+        factory = APIRequestFactory()
+        end_view = EndCallView.as_view()
+        webhook_view = AgoraWebhookView.as_view()
+        base_ts = timezone.now()
+
+        def via_rest(call):
+            end_view(factory.post(f"/calls/end-call/{call.id}/"), call_id=call.id)
+
+        def via_consumer(call):
+            AgoraCallHistory.objects.get(pk=call.id).end_call(ender=f"user_{call.user_id}")
+
+        def via_webhook(call):
+            webhook_view(factory.post("/calls/agora/webhook/", {
+                "eventType": "channel.destroyed",
+                "channelName": call.channel_name,
+                "uid": str(call.uid),
+                "timestamp": (base_ts + timedelta(microseconds=call.id)).isoformat(),
+            }, format="json"))
+
+        jobs = [(entry, call) for call in calls for entry in (via_rest, via_consumer, via_webhook)]
+        random.shuffle(jobs)
+
+        def work(job):
+            entry, call = job
+            try:
+                entry(call)
+            finally:
+                connection.close()
+
+        with Timer() as t:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(work, jobs))
+
+        ended = AgoraCallHistory.objects.filter(status="ended", is_active=False).count()
+        charged = AgoraCallHistory.objects.aggregate(total=Sum("coins_deducted"))["total"] or 0
+        remaining = UserStats.objects.filter(user__in=users).aggregate(total=Sum("coin_balance"))["total"]
+        debited = count * balance - remaining
+
+        self.stdout.write(f"calls={count} end_requests={len(jobs)} workers={workers} vendor={connection.vendor}")
+        self.stdout.write(f"elapsed={t.elapsed:.3f}s settlements/s={ended / t.elapsed:.1f} requests/s={len(jobs) / t.elapsed:.1f}")
+        self.stdout.write(f"settled={ended}/{count} coins_charged={charged} coins_debited={debited}")
+        if ended != count or charged != debited:
+            self.stderr.write(self.style.ERROR("Settlement mismatch: a call was lost or double charged"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Each call settled exactly once"))
@@ -0,0 +1,47 @@
+import random
+from django.core.management.base import BaseCommand
+from calls.timers import TimerWheel
+from talkeasy.bench import Timer
+
+
+class Command(BaseCommand):
+    help = "Benchmark insert, cancel and tick cost of the call timer wheel."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--timers", type=int, default=100_000)
+        parser.add_argument("--tick", type=float, default=0.25)
+        parser.add_argument("--horizon", type=float, default=3600, help="Deadlines are spread over this many seconds")
+
+    def handle(self, *args, **options):
+        count, tick, horizon = options["timers"], options["tick"], options["horizon"]
+        now = 1_000_000.0
+        wheel = TimerWheel(tick, now=now)
+        deadlines = [now + random.uniform(1, horizon) for _ in range(count)]
+
+        with Timer() as insert:
+            for call_id, deadline in enumerate(deadlines):
+                wheel.add(("ring_timeout", call_id), deadline)
+
+        with Timer() as rearm:
+            for call_id, deadline in enumerate(deadlines):
+                wheel.add(("ring_timeout", call_id), deadline + 30)
+
+        cancelled = range(0, count, 2)
+        with Timer() as cancel:
+            for call_id in cancelled:
+                wheel.remove(("ring_timeout", call_id))
+
+        pending = len(wheel)
+        ticks = int((horizon + 31) / tick)
+        fired = 0
+        with Timer() as drain:
+            for step in range(1, ticks + 1):
+                fired += len(wheel.advance(now + step * tick))
+
+        self.stdout.write(f"timers={count} tick={tick}s horizon={horizon}s")
+        self.stdout.write(f"insert: {insert.elapsed / count * 1e6:.2f} us/op")
+        self.stdout.write(f"re-arm: {rearm.elapsed / count * 1e6:.2f} us/op")
+        self.stdout.write(f"cancel: {cancel.elapsed / len(cancelled) * 1e6:.2f} us/op")
+        self.stdout.write(
+            f"drain: {ticks} ticks, {fired}/{pending} fired, {drain.elapsed / ticks * 1e6:.2f} us/tick"
+        )
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from calls.tokens import AgoraTokenCache, build_token
+from talkeasy.bench import Timer
+
+
+class Command(BaseCommand):
+    help = "Measure Agora token throughput: cold signing vs the token cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tokens", type=int, default=20000)
+        parser.add_argument("--channels", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count, channels = options["tokens"], options["channels"]
+
+        with Timer() as t:
+            for i in range(count):
+                build_token(f"bench_{i % channels}", i % channels + 1)
+        self.report("cold build", count, t.elapsed)
+
+        cache = AgoraTokenCache()
+        with Timer() as t:
+            for i in range(0, count, 2):
+                cache.call_tokens(f"bench_{i}", i + 1, i + 1001)
+        self.report("initiate pairs (miss)", count, t.elapsed)
+
+        cache = AgoraTokenCache()
+        with Timer() as t:
+            for i in range(count):
+                cache.token(f"bench_{i % channels}", i % channels + 1)
+        self.report(f"cached ({channels} parties)", count, t.elapsed)
+
+    def report(self, label, count, elapsed):
+        self.stdout.write(f"{label:>24}: {count / elapsed:12.0f} tokens/s ({elapsed * 1e6 / count:.1f}us each)")
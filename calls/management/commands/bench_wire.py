@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from executives.presence import delta_text, presence_entry
+from talkeasy import wire
+from talkeasy.bench import Timer
+
+
+class Command(BaseCommand):
+    help = "Compare JSON and the MessagePack subprotocol: bytes per message and encode/decode rates."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--executives", type=int, default=200, help="Entries in the presence snapshot")
+        parser.add_argument("--iterations", type=int, default=20000)
+
+    def handle(self, *args, **options):
+        if wire.msgpack is None:
+            raise CommandError("msgpack is not installed")
+        iterations = options["iterations"]
+        now = timezone.now().isoformat()
+        entries = [
+            presence_entry(f"EX{i:04d}", f"Executive {i}", "online", gender="female", languages=[1, 2])
+            for i in range(options["executives"])
+        ]
+        messages = {
+            "connection_established": {
+                "type": "connection_established", "message": "WebSocket connected successfully!",
+                "user_id": 42, "executive_id": 7, "timestamp": now, "status": "connected",
+            },
+            "action_success": {
+                "type": "action_success", "action": "end_call", "call_id": 1234,
+                "status": "ended", "message": "Call ended successfully", "timestamp": now,
+            },
+            "incoming_call": {
+                "type": "incoming_call", "call_id": 1234, "channel_name": "call_42_7_1700000000",
+                "caller_name": "Caller", "caller_uid": 42, "executive_token": "x" * 139,
+                "callee_uid": 1007, "timestamp": now, "coins_per_second": 3, "amount_per_min": "6.00",
+            },
+            "call_ended_event": {
+                "type": "call_ended_event", "call_id": 1234, "reason": "balance_exhausted",
+                "ended_by": "system", "coins_deducted": 540, "executive_earnings": 18.0,
+                "duration_seconds": 180, "duration": "0:03:00",
+            },
+            "presence_delta (5)": wire.loads(delta_text(None, 10, entries[:5])),
+            f"executive_status_list ({len(entries)})": {
+                "type": "executive_status_list", "version": 10, "data": entries,
+            },
+        }
+
+        self.stdout.write(f"iterations={iterations} encoder={'orjson' if wire.orjson is not None else 'json'}")
+        for name, message in messages.items():
+            text = wire.dumps(message)
+            packed = wire.pack(message)
+            with Timer() as json_encode:
+                for _ in range(iterations):
+                    wire.dumps(message)
+            with Timer() as pack_encode:
+                for _ in range(iterations):
+                    wire.pack(message)
+            with Timer() as json_decode:
+                for _ in range(iterations):
+                    wire.loads(text)
+            with Timer() as pack_decode:
+                for _ in range(iterations):
+                    wire.msgpack.unpackb(packed)
+            size = len(text.encode())
+            self.stdout.write(
+                f"{name}: json={size}B msgpack={len(packed)}B ({len(packed) / size:.0%}) "
+                f"encode json={iterations / json_encode.elapsed:,.0f}/s msgpack={iterations / pack_encode.elapsed:,.0f}/s "
+                f"decode json={iterations / json_decode.elapsed:,.0f}/s msgpack={iterations / pack_decode.elapsed:,.0f}/s"
+            )
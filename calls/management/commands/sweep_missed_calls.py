@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from asgiref.sync import async_to_sync
+from calls.notifications import notify_calls_missed
+from calls.sweeper import sweep_missed_calls
+from talkeasy.bench import Timer
+
+
+class Command(BaseCommand):
+    help = "Mark every timed-out pending/ringing call as missed and notify both parties."
+
+    def handle(self, *args, **options):
+        with Timer() as db:
+            rows = sweep_missed_calls()
+        with Timer() as notify:
+            if rows:
+                async_to_sync(notify_calls_missed)(rows)
+
+        executives = len({row[2] for row in rows})
+        self.stdout.write(
+            f"missed={len(rows)} executives_released={executives} "
+            f"db={db.elapsed * 1000:.1f}ms notify={notify.elapsed * 1000:.1f}ms"
+        )
@@ -0,0 +1,96 @@
+# calls/metering.py
+"""
+Per-second coin metering for joined calls.
+
+Every tick charges each joined call for the whole seconds it has run
+since it was joined, minus what was already taken (``coins_deducted``).
+The balances of the users involved are read under lock first, so each
+call records only what its user could actually pay. Calls are grouped by
+the amount taken this tick, so a tick is one UPDATE on UserStats and one
+on AgoraCallHistory per distinct amount (usually one or two) instead of
+a save() per call. Calls whose user has hit a zero balance are settled
+and both parties get a ``call_ended`` event.
+"""
+from collections import defaultdict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from calls.models import AgoraCallHistory
+from calls.notifications import notify_call_ended
+from calls.settlement import clamped_debit, compute_charges, settle_call
+from calls.utils import chunked
+from talkeasy.services import run_periodic
+from users.models import UserStats
+
+
+def charge_active_calls(now=None):
+    """
+    Charge all joined calls up to ``now``.
+
+    Returns the ids of calls whose user ran out of coins.
+    """
+    now = now or timezone.now()
+
+    with transaction.atomic():
+        rows = (
+            AgoraCallHistory.objects.select_for_update()
+            .filter(status="joined", is_active=True, end_time__isnull=True, joined_at__isnull=False)
+            .values_list("id", "user_id", "joined_at", "coins_per_second", "coins_deducted")
+        )
+
+        calls_by_user = defaultdict(list)  # user_id -> [(call_id, owed)]
+        for call_id, user_id, joined_at, coins_per_second, coins_deducted in rows:
+            seconds = max(0, int((now - joined_at).total_seconds()))
+            owed = compute_charges(seconds, coins_per_second, 0)[0] - coins_deducted
+            calls_by_user[user_id].append((call_id, max(0, owed)))
+
+        balances = {}
+        for chunk in chunked(calls_by_user):
+            balances.update(
+                UserStats.objects.select_for_update()
+                .filter(user_id__in=chunk)
+                .values_list("user_id", "coin_balance")
+            )
+
+        users_by_amount = defaultdict(list)
+        calls_by_amount = defaultdict(list)
+        exhausted = []
+        for user_id, calls in calls_by_user.items():
+            balance = balances.get(user_id, 0)
+            left = balance
+            for call_id, owed in calls:
+                taken = min(owed, left)
+                left -= taken
+                if taken:
+                    calls_by_amount[taken].append(call_id)
+            if balance > left:
+                users_by_amount[balance - left].append(user_id)
+            if left == 0:
+                exhausted.extend(call_id for call_id, _ in calls)
+
+        for taken, user_ids in users_by_amount.items():
+            for chunk in chunked(user_ids):
+                UserStats.objects.filter(user_id__in=chunk).update(coin_balance=clamped_debit(taken))
+
+        for taken, call_ids in calls_by_amount.items():
+            for chunk in chunked(call_ids):
+                AgoraCallHistory.objects.filter(id__in=chunk).update(
+                    coins_deducted=F("coins_deducted") + taken,
+                    last_coin_update_time=now,
+                )
+
+    return exhausted
+
+
+async def meter_once():
+    exhausted = await database_sync_to_async(charge_active_calls)()
+    for call_id in exhausted:
+        settled = await database_sync_to_async(settle_call)(call_id, ender="system")
+        if settled:
+            await notify_call_ended(settled, "Insufficient balance, call ended automatically")
+
+
+async def run():
+    await run_periodic(getattr(settings, "CALL_METERING_INTERVAL_SECONDS", 1), meter_once)
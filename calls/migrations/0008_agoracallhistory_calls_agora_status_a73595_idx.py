@@ -0,0 +1,19 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0007_agoracallhistory_duration_seconds_and_more'),
+        ('executives', '0017_rename_set_coin_executivestats_amount_per_min_and_more'),
+        ('users', '0011_remove_userprofile_coin_balance'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agoracallhistory',
+            index=models.Index(fields=['status', 'start_time'], name='calls_agora_status_a73595_idx'),
+        ),
+    ]
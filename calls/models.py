@@ -56,6 +56,8 @@ class AgoraCallHistory(models.Model):
         indexes = [
             models.Index(fields=["is_active", "channel_name"]),
             models.Index(fields=["status"]),
+            models.Index(fields=["status", "start_time"]),
+            models.Index(fields=["is_active", "last_heartbeat"]),
         ]
 
     def __str__(self):
@@ -68,63 +70,33 @@ class AgoraCallHistory(models.Model):
             self.status = "joined"
         self.save(update_fields=["joined_at", "status"])
 
+        # The talk clock starts now, so move the auto-end deadline with it
+        from .autoend import arm_auto_end
+        from .timeouts import call_joined
+        call_joined(self.id)
+        arm_auto_end(self)
+
     def _compute_final_duration(self, ended_at):
         base_start = self.joined_at or self.start_time
         return (ended_at - base_start) if ended_at and base_start else timezone.timedelta()
 
     def end_call(self, ender="client", request_id=None):
+        from .settlement import SETTLED_FIELDS, settle_call
+
         if self.end_time:
-            return  # already ended
-
-        self.end_time = timezone.now()
-
-        if self.joined_at:
-            self.duration = self.end_time - self.joined_at
-
-        duration_seconds = int(self.duration.total_seconds()) if self.duration else 0
-        self.duration_seconds = duration_seconds
-
-        #  Deduct coins from user
-        coins_to_deduct = int(Decimal(duration_seconds) * Decimal(str(self.coins_per_second)))
-        self.coins_deducted = coins_to_deduct
-        if hasattr(self.user, "stats"):
-            user_stats = self.user.stats
-            user_stats.coin_balance = max(0, user_stats.coin_balance - coins_to_deduct)
-            user_stats.save(update_fields=["coin_balance"])
-
-        #  Compute executive earnings
-        amount_per_second = (Decimal(str(self.amount_per_min)) / Decimal("60")).quantize(
-            Decimal("0.01"), rounding=ROUND_DOWN
-        )
-        earnings = (Decimal(duration_seconds) * amount_per_second).quantize(
-            Decimal("0.01"), rounding=ROUND_DOWN
-        )
-        self.executive_earnings = earnings
-
-        # Update executive stats
-        if hasattr(self.executive, "stats"):
-            exec_stats = self.executive.stats
-            exec_stats.total_earnings = (exec_stats.total_earnings or Decimal("0")) + earnings
-            exec_stats.earnings_today = (exec_stats.earnings_today or Decimal("0")) + earnings
-            exec_stats.pending_payout = (exec_stats.pending_payout or Decimal("0")) + earnings
-            exec_stats.total_talk_seconds_today += duration_seconds
-            exec_stats.save(update_fields=[
-                "total_earnings", "earnings_today", "pending_payout", "total_talk_seconds_today"
-            ])
-
-        # Reset executive on_call
-        self.executive.on_call = False
-        self.executive.save(update_fields=["on_call"])
-
-        # End the call
-        self.is_active = False
-        self.status = "ended"
-        self.ended_by = ender
-        self.end_request_id = request_id
-        self.save(update_fields=[
-            "is_active", "status", "end_time", "duration", "duration_seconds",
-            "coins_deducted", "executive_earnings", "ended_by", "end_request_id"
-        ])
+            return False  # already ended
+
+        settled = settle_call(self.pk, ender=ender, request_id=request_id)
+        if settled is None:
+            # Someone else settled it first; pick up their result
+            self.refresh_from_db(fields=SETTLED_FIELDS)
+            return False
+
+        for field in SETTLED_FIELDS:
+            setattr(self, field, settled[field])
+        if AgoraCallHistory.executive.is_cached(self):
+            self.executive.on_call = False
+        return True
 
     def deduct_coins(self, coins):
         if self.user.coin_balance <= 0:
@@ -142,16 +114,10 @@ class AgoraCallHistory(models.Model):
 
 
 
+    @staticmethod
     def mark_missed_calls():
-        timeout = timezone.now() - timedelta(seconds=30)
-        missed_calls = AgoraCallHistory.objects.filter(
-            status="ringing", start_time__lte=timeout, is_active=True
-        )
-        for call in missed_calls:
-            call.status = "missed"
-            call.is_active = False
-            call.end_time = timezone.now()
-            call.save()
+        from .sweeper import sweep_and_notify
+        return sweep_and_notify()
 
 
 class CallRating(models.Model):
@@ -0,0 +1,41 @@
+# calls/notifications.py
+import asyncio
+from channels.layers import get_channel_layer
+from talkeasy.wire import with_text
+
+
+async def send_to_call_parties(user_id, executive_id, event):
+    """group_send ``event`` to the caller's and the executive's CallConsumer groups, encoded once."""
+    channel_layer = get_channel_layer()
+    if not channel_layer:
+        return
+    try:
+        event = with_text(event)
+        await asyncio.gather(
+            channel_layer.group_send(f"user_{user_id}", event),
+            channel_layer.group_send(f"executive_{executive_id}", event),
+        )
+    except Exception as e:
+        print(f"WebSocket notification failed: {e}")
+
+
+async def notify_call_ended(settled, reason):
+    """Tell both parties a call was ended server-side; ``settled`` comes from settle_call."""
+    await send_to_call_parties(settled["user_id"], settled["executive_id"], {
+        "type": "call_ended_event",
+        "call_id": settled["call_id"],
+        "reason": reason,
+        "ended_by": settled["ended_by"],
+        "coins_deducted": settled["coins_deducted"],
+        "executive_earnings": float(settled["executive_earnings"]),
+        "duration_seconds": settled["duration_seconds"],
+        "duration": str(settled["duration"]) if settled["duration"] else None,
+    })
+
+
+async def notify_calls_missed(rows):
+    """Send ``call_missed`` for a batch of ``(call_id, user_id, executive_id)`` rows at once."""
+    await asyncio.gather(*(
+        send_to_call_parties(user_id, executive_id, {"type": "call_missed_event", "call_id": call_id})
+        for call_id, user_id, executive_id in rows
+    ))
@@ -0,0 +1,64 @@
+# calls/reaper.py
+"""
+Reaper for abandoned calls.
+
+A call whose client crashed keeps ``is_active=True`` and its executive
+stays ``on_call``, so nobody can call them again. Every
+``CALL_REAPER_INTERVAL_SECONDS`` the ``call-reaper`` service settles
+active calls whose heartbeat lease (``last_heartbeat``) is older than
+``CALL_REAPER_STALE_SECONDS``; settlement also releases the executive.
+
+Only joined calls are reaped: pending and ringing calls belong to the
+missed-call sweeper, and rejected or cancelled calls are already over.
+A call that has not sent a heartbeat yet is judged by when it was
+joined (or started), so one that crashed before its first heartbeat
+flush is reaped too. The scan only looks at active joined calls and is
+capped per pass, so it stays cheap however much call history there is.
+"""
+from datetime import timedelta
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from calls.heartbeats import heartbeats
+from calls.models import AgoraCallHistory
+from calls.notifications import notify_call_ended
+from calls.settlement import settle_call
+from talkeasy.services import run_periodic
+
+REAP_BATCH_SIZE = 500
+
+
+def stale_seconds():
+    return getattr(settings, "CALL_REAPER_STALE_SECONDS", 120)
+
+
+def reap_stale_calls(now=None, limit=REAP_BATCH_SIZE):
+    """Settle abandoned calls with ender="reaper"; returns the settlement results."""
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=stale_seconds())
+    candidates = (
+        AgoraCallHistory.objects.filter(is_active=True, status="joined")
+        .annotate(lease=Coalesce("last_heartbeat", "joined_at", "start_time"))
+        .filter(lease__lt=cutoff)
+        .order_by("lease")
+        .values_list("id", "lease")[:limit]
+    )
+    reaped = []
+    for call_id, stored in candidates:
+        # A heartbeat may be sitting in this process's buffer, not yet flushed
+        if heartbeats.last_heartbeat(call_id, stored) >= cutoff:
+            continue
+        settled = settle_call(call_id, ender="reaper")
+        if settled:
+            reaped.append(settled)
+    return reaped
+
+
+async def reap_once():
+    for settled in await database_sync_to_async(reap_stale_calls)():
+        await notify_call_ended(settled, "Connection lost, call ended automatically")
+
+
+async def run():
+    await run_periodic(getattr(settings, "CALL_REAPER_INTERVAL_SECONDS", 30), reap_once)
@@ -0,0 +1,134 @@
+# calls/settlement.py
+from decimal import Decimal, ROUND_DOWN
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from calls.heartbeats import heartbeats
+from calls.models import AgoraCallHistory
+from calls.timers import timers
+from executives.models import Executive, ExecutiveStats
+from users.models import UserStats
+
+# Fields written on the call row when it is settled
+SETTLED_FIELDS = [
+    "is_active", "status", "end_time", "duration", "duration_seconds",
+    "coins_deducted", "executive_earnings", "ended_by", "end_request_id",
+]
+
+
+def compute_charges(duration_seconds, coins_per_second, amount_per_min):
+    """Return (coins to deduct from the user, earnings for the executive)."""
+    coins = int(Decimal(duration_seconds) * Decimal(str(coins_per_second)))
+    amount_per_second = (Decimal(str(amount_per_min)) / Decimal("60")).quantize(
+        Decimal("0.01"), rounding=ROUND_DOWN
+    )
+    earnings = (Decimal(duration_seconds) * amount_per_second).quantize(
+        Decimal("0.01"), rounding=ROUND_DOWN
+    )
+    return coins, earnings
+
+
+def clamped_debit(coins):
+    # coin_balance is unsigned on MySQL, so clamp with CASE instead of
+    # letting the subtraction go negative.
+    return Case(
+        When(coin_balance__gt=coins, then=F("coin_balance") - coins),
+        default=Value(0),
+    )
+
+
+def settle_call(call_id, ender="client", request_id=None):
+    """
+    End a call and move coins/earnings in a single transaction.
+
+    Always runs the same six statements: locked reads of the call and of
+    the user's balance, a conditional UPDATE that claims the call
+    (``end_time IS NULL``), and F()-based UPDATEs on UserStats,
+    ExecutiveStats and Executive. Concurrent enders (REST view, WebSocket
+    consumer, Agora webhook) race on the claim and only one of them moves
+    any coins.
+
+    The call records only the coins actually taken: when the balance runs
+    short, the executive is paid for the talk time those coins cover.
+
+    Returns a dict with the settled values, or None if the call had
+    already been ended.
+    """
+    now = timezone.now()
+
+    with transaction.atomic():
+        row = (
+            AgoraCallHistory.objects.select_for_update()
+            .filter(pk=call_id, end_time__isnull=True)
+            .values(
+                "user_id", "executive_id", "joined_at", "coins_per_second",
+                "amount_per_min", "coins_deducted",
+            )
+            .first()
+        )
+        if row is None:
+            return None
+
+        balance = (
+            UserStats.objects.select_for_update()
+            .filter(user_id=row["user_id"])
+            .values_list("coin_balance", flat=True)
+            .first()
+        ) or 0
+
+        duration = (now - row["joined_at"]) if row["joined_at"] else None
+        duration_seconds = int(duration.total_seconds()) if duration else 0
+        coins, earnings = compute_charges(
+            duration_seconds, row["coins_per_second"], row["amount_per_min"]
+        )
+        # Coins already taken by the per-second meter are not charged again
+        remaining = min(max(0, coins - row["coins_deducted"]), balance)
+        if row["coins_deducted"] + remaining < coins:
+            coins = row["coins_deducted"] + remaining
+            paid_seconds = int(Decimal(coins) / Decimal(str(row["coins_per_second"])))
+            earnings = compute_charges(
+                min(paid_seconds, duration_seconds), row["coins_per_second"], row["amount_per_min"]
+            )[1]
+        coins = max(coins, row["coins_deducted"])
+
+        claimed = AgoraCallHistory.objects.filter(pk=call_id, end_time__isnull=True).update(
+            is_active=False,
+            status="ended",
+            end_time=now,
+            duration=duration,
+            duration_seconds=duration_seconds,
+            coins_deducted=coins,
+            executive_earnings=earnings,
+            ended_by=ender,
+            end_request_id=request_id,
+        )
+        if not claimed:
+            return None
+
+        UserStats.objects.filter(user_id=row["user_id"]).update(
+            coin_balance=clamped_debit(remaining)
+        )
+        ExecutiveStats.objects.filter(executive_id=row["executive_id"]).update(
+            total_earnings=F("total_earnings") + earnings,
+            earnings_today=F("earnings_today") + earnings,
+            pending_payout=F("pending_payout") + earnings,
+            total_talk_seconds_today=F("total_talk_seconds_today") + duration_seconds,
+        )
+        Executive.objects.filter(pk=row["executive_id"]).update(on_call=False)
+
+    timers.cancel_call(call_id)
+    heartbeats.forget(call_id)
+    return {
+        "call_id": call_id,
+        "user_id": row["user_id"],
+        "executive_id": row["executive_id"],
+        "is_active": False,
+        "status": "ended",
+        "end_time": now,
+        "duration": duration,
+        "duration_seconds": duration_seconds,
+        "coins_deducted": coins,
+        "executive_earnings": earnings,
+        "ended_by": ender,
+        "end_request_id": request_id,
+    }
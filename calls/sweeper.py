@@ -0,0 +1,53 @@
+# calls/sweeper.py
+"""
+Periodic sweep for calls nobody answered.
+
+The ring/join timers in ``calls.timeouts`` only exist in the process
+that armed them, so calls started on a worker that has since restarted
+are picked up here instead. Runs as the ``call-sweeper`` service and as
+the ``sweep_missed_calls`` management command.
+"""
+from datetime import timedelta
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from calls.models import AgoraCallHistory
+from calls.notifications import notify_calls_missed
+from calls.timeouts import join_timeout, miss_calls, ring_timeout
+from talkeasy.services import run_periodic
+
+
+def timed_out_calls(now=None):
+    now = now or timezone.now()
+    ring_cutoff = now - timedelta(seconds=ring_timeout())
+    # Accepted calls get the join timeout on top of the ring timeout
+    join_cutoff = ring_cutoff - timedelta(seconds=join_timeout())
+    return AgoraCallHistory.objects.filter(
+        Q(status="pending", start_time__lte=ring_cutoff)
+        | Q(status="ringing", start_time__lte=join_cutoff),
+        is_active=True,
+    )
+
+
+def sweep_missed_calls(now=None):
+    """Mark every timed-out call missed; returns the moved ``(call_id, user_id, executive_id)`` rows."""
+    return miss_calls(timed_out_calls(now), ender="sweeper")
+
+
+def sweep_and_notify(now=None):
+    rows = sweep_missed_calls(now)
+    if rows:
+        async_to_sync(notify_calls_missed)(rows)
+    return rows
+
+
+async def sweep_once():
+    rows = await database_sync_to_async(sweep_missed_calls)()
+    if rows:
+        await notify_calls_missed(rows)
+
+
+async def run():
+    await run_periodic(getattr(settings, "CALL_SWEEP_INTERVAL_SECONDS", 15), sweep_once)
@@ -1,3 +1,624 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import io
+import json
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import skipUnless
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from calls.autoend import AUTO_END, expire_calls, talk_deadline
+from calls.consumers import CallConsumer
+from calls.heartbeats import HeartbeatBuffer
+from calls.initiation import claim_executive
+from calls import views
+from calls.views import CallInitiateView
+from calls.metering import charge_active_calls
+from calls.models import AgoraCallHistory
+from calls import notifications
+from calls.reaper import reap_stale_calls
+from calls.settlement import settle_call
+from calls.sweeper import sweep_missed_calls
+from calls.timeouts import (
+    JOIN_TIMEOUT, RING_TIMEOUT, call_accepted, call_initiated, mark_calls_missed,
+    unanswered_calls, unjoined_calls,
+)
+from calls.timers import CallTimers, TimerWheel, timers
+from calls.tokens import AgoraTokenCache
+from executives.models import Executive, ExecutiveStats
+from executives.presence import PresenceRegistry
+from executives.presence_store import MemoryPresenceStore
+from talkeasy import wire
+from talkeasy.dbpool import DBExecutor
+from users.models import UserProfile, UserStats
 
-# Create your tests here.
+
+class CallFixturesMixin:
+    def setUp(self):
+        self.user = UserProfile.objects.create(mobile_number="9000000001", name="Caller")
+        UserStats.objects.filter(user=self.user).update(coin_balance=1000)
+        self.executive = Executive.objects.create(
+            executive_id="EX0001", mobile_number="8000000001", name="Exec",
+            is_online=True, on_call=True,
+        )
+        ExecutiveStats.objects.create(executive=self.executive, coins_per_second=3, amount_per_min="6.00")
+
+    def make_call(self, joined_seconds_ago=100, **kwargs):
+        defaults = dict(
+            user=self.user, executive=self.executive, channel_name="chan_1",
+            token="t", executive_token="t", uid=1, callee_uid=1001, status="joined",
+            joined_at=timezone.now() - timedelta(seconds=joined_seconds_ago),
+            coins_per_second=3, amount_per_min="6.00",
+        )
+        defaults.update(kwargs)
+        return AgoraCallHistory.objects.create(**defaults)
+
+
+class SettlementTests(CallFixturesMixin, TestCase):
+    def test_settlement_query_count_is_fixed(self):
+        call = self.make_call()
+        # SAVEPOINT, locked reads of call and balance, claim, UserStats, ExecutiveStats, Executive, RELEASE
+        with self.assertNumQueries(8):
+            settled = settle_call(call.id, ender="client")
+        self.assertIsNotNone(settled)
+
+    def test_settlement_moves_coins_and_earnings(self):
+        call = self.make_call(joined_seconds_ago=100)
+        settled = settle_call(call.id, ender="client", request_id="req-1")
+
+        seconds = settled["duration_seconds"]
+        self.assertEqual(settled["coins_deducted"], seconds * 3)
+        self.assertEqual(settled["executive_earnings"], Decimal("0.10") * seconds)
+
+        call.refresh_from_db()
+        self.assertEqual(call.status, "ended")
+        self.assertFalse(call.is_active)
+        self.assertEqual(call.end_request_id, "req-1")
+        self.assertEqual(UserStats.objects.get(user=self.user).coin_balance, 1000 - seconds * 3)
+        stats = ExecutiveStats.objects.get(executive=self.executive)
+        self.assertEqual(stats.total_earnings, settled["executive_earnings"])
+        self.assertEqual(stats.total_talk_seconds_today, seconds)
+        self.assertFalse(Executive.objects.get(pk=self.executive.pk).on_call)
+
+    def test_second_settlement_is_a_noop(self):
+        call = self.make_call()
+        self.assertIsNotNone(settle_call(call.id, ender="client"))
+        with self.assertNumQueries(3):
+            self.assertIsNone(settle_call(call.id, ender="webhook"))
+        self.assertEqual(AgoraCallHistory.objects.get(pk=call.pk).ended_by, "client")
+
+    def test_balance_is_clamped_at_zero(self):
+        call = self.make_call(joined_seconds_ago=1000)
+        settled = settle_call(call.id)
+        self.assertEqual(UserStats.objects.get(user=self.user).coin_balance, 0)
+        # Only the 1000 coins taken are recorded, and paid for 333 seconds
+        self.assertEqual(settled["coins_deducted"], 1000)
+        self.assertEqual(settled["executive_earnings"], Decimal("0.10") * 333)
+
+    def test_end_call_on_stale_instance_picks_up_winner(self):
+        call = self.make_call()
+        stale = AgoraCallHistory.objects.get(pk=call.pk)
+        self.assertTrue(call.end_call(ender="client"))
+        self.assertFalse(stale.end_call(ender="webhook"))
+        self.assertEqual(stale.ended_by, "client")
+        self.assertEqual(stale.coins_deducted, call.coins_deducted)
+
+
+class MeteringTests(CallFixturesMixin, TestCase):
+    def test_metered_coins_are_not_charged_again_at_settlement(self):
+        call = self.make_call(joined_seconds_ago=0)
+        charge_active_calls(call.joined_at + timedelta(seconds=10))
+        self.assertEqual(UserStats.objects.get(user=self.user).coin_balance, 1000 - 30)
+
+        settled = settle_call(call.id)
+        balance = UserStats.objects.get(user=self.user).coin_balance
+        self.assertEqual(balance, 1000 - settled["coins_deducted"])
+
+    def test_calls_record_only_the_coins_taken(self):
+        UserStats.objects.filter(user=self.user).update(coin_balance=40)
+        first = self.make_call(joined_seconds_ago=0)
+        second = self.make_call(channel_name="chan_2", joined_at=first.joined_at)
+        # 30 coins owed per call, 40 available
+        self.assertEqual(
+            sorted(charge_active_calls(first.joined_at + timedelta(seconds=10))), sorted([first.id, second.id])
+        )
+        self.assertEqual(UserStats.objects.get(user=self.user).coin_balance, 0)
+        taken = AgoraCallHistory.objects.filter(pk__in=[first.pk, second.pk]).values_list("coins_deducted", flat=True)
+        self.assertEqual(sum(taken), 40)
+
+        settled = settle_call(first.id)
+        self.assertEqual(settled["coins_deducted"], AgoraCallHistory.objects.get(pk=first.pk).coins_deducted)
+
+    def test_exhausted_calls_are_reported(self):
+        UserStats.objects.filter(user=self.user).update(coin_balance=20)
+        call = self.make_call(joined_seconds_ago=0)
+        self.assertEqual(charge_active_calls(call.joined_at + timedelta(seconds=5)), [])
+        self.assertEqual(charge_active_calls(call.joined_at + timedelta(seconds=10)), [call.id])
+
+
+class AutoEndTests(CallFixturesMixin, TestCase):
+    def tearDown(self):
+        timers.cancel_call(self.call.id)
+
+    def test_join_arms_deadline_from_balance(self):
+        self.call = self.make_call(status="pending", joined_at=None)
+        self.call.mark_joined()
+        self.assertTrue(timers.is_armed(AUTO_END, self.call.id))
+        expected = talk_deadline(1000, 3, self.call.joined_at)
+        self.assertAlmostEqual(expected - self.call.joined_at.timestamp(), 1000 / 3, places=3)
+
+    def test_timer_rearms_while_talk_time_remains(self):
+        # 1000 coins at 3/s is 333s of talk time
+        self.call = self.make_call(joined_seconds_ago=300)
+        self.assertEqual(expire_calls([self.call.id]), [])
+        self.assertTrue(timers.is_armed(AUTO_END, self.call.id))
+
+        UserStats.objects.filter(user=self.user).update(coin_balance=100)
+        settled = expire_calls([self.call.id])
+        self.assertEqual([s["call_id"] for s in settled], [self.call.id])
+        self.assertFalse(timers.is_armed(AUTO_END, self.call.id))
+
+    def test_calls_not_joined_have_no_deadline(self):
+        self.call = self.make_call(status="pending", joined_at=None)
+        self.assertIsNone(talk_deadline(1000, 3, None))
+        self.assertEqual(expire_calls([self.call.id]), [])
+        self.assertFalse(timers.is_armed(AUTO_END, self.call.id))
+
+    def test_missed_calls_drop_their_timer(self):
+        self.call = self.make_call(status="ringing", joined_at=None)
+        timers.arm(AUTO_END, self.call.id, time.time() + 60)
+        mark_calls_missed([self.call.id], "ringing")
+        self.assertFalse(timers.is_armed(AUTO_END, self.call.id))
+
+
+class TimerWheelTests(SimpleTestCase):
+    def make_wheel(self):
+        # 4 slots x 3 levels: a 64 tick horizon keeps cascades and overflow cheap to hit
+        return TimerWheel(tick=1, slots_per_level=4, levels=3, now=0)
+
+    def fired_at(self, wheel, key, limit=500):
+        for second in range(1, limit):
+            if key in wheel.advance(second):
+                return second
+        return None
+
+    def test_timers_fire_on_their_tick_across_levels(self):
+        for deadline in (1, 3, 4, 5, 17, 63, 64, 200):
+            wheel = self.make_wheel()
+            wheel.add("k", deadline)
+            self.assertEqual(self.fired_at(wheel, "k"), deadline)
+            self.assertEqual(len(wheel), 0)
+
+    def test_cancel_and_rearm(self):
+        wheel = self.make_wheel()
+        wheel.add("gone", 10)
+        wheel.add("moved", 10)
+        self.assertTrue(wheel.remove("gone"))
+        wheel.add("moved", 30)
+        self.assertEqual(wheel.advance(29), [])
+        self.assertEqual(wheel.advance(30), ["moved"])
+
+    def test_past_deadline_fires_on_next_tick(self):
+        wheel = self.make_wheel()
+        wheel.advance(50)
+        wheel.add("late", 10)
+        self.assertEqual(wheel.advance(51), ["late"])
+
+
+class CallTimersTests(SimpleTestCase):
+    def test_a_failing_handler_does_not_drop_other_kinds(self):
+        call_timers, fired = CallTimers(tick=0.01), []
+
+        @call_timers.handler("broken")
+        async def broken(call_ids):
+            raise RuntimeError("boom")
+
+        @call_timers.handler("working")
+        async def working(call_ids):
+            fired.extend(call_ids)
+
+        call_timers.arm("broken", 1, time.time())
+        call_timers.arm("working", 2, time.time())
+        time.sleep(0.03)
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            async_to_sync(call_timers.fire_due)()
+        self.assertEqual(fired, [2])
+        self.assertIn("boom", output.getvalue())
+
+
+class TimeoutTests(CallFixturesMixin, TestCase):
+    def test_ring_timeout_marks_missed_and_releases_executive(self):
+        call = self.make_call(status="pending", joined_at=None)
+        joined = self.make_call(channel_name="chan_2")
+        rows = mark_calls_missed([call.id, joined.id], "pending")
+
+        self.assertEqual(rows, [(call.id, self.user.id, self.executive.id)])
+        call.refresh_from_db()
+        self.assertEqual((call.status, call.is_active), ("missed", False))
+        self.assertFalse(Executive.objects.get(pk=self.executive.pk).on_call)
+        self.assertEqual(AgoraCallHistory.objects.get(pk=joined.pk).status, "joined")
+
+    def test_accept_swaps_ring_timer_for_join_timer(self):
+        call_initiated(42)
+        call_accepted(42)
+        self.assertFalse(timers.is_armed(RING_TIMEOUT, 42))
+        self.assertTrue(timers.is_armed(JOIN_TIMEOUT, 42))
+        timers.cancel_call(42)
+
+
+class TimeoutHandlerTests(CallFixturesMixin, TransactionTestCase):
+    def test_ring_timeout_leaves_accepted_calls_to_the_join_timeout(self):
+        # The accept was handled by another worker, so this one's ring timer still fires
+        accepted = self.make_call(status="ringing", joined_at=None)
+        async_to_sync(unanswered_calls)([accepted.id])
+
+        accepted.refresh_from_db()
+        self.assertEqual((accepted.status, accepted.is_active), ("ringing", True))
+        self.assertTrue(Executive.objects.get(pk=self.executive.pk).on_call)
+
+        async_to_sync(unjoined_calls)([accepted.id])
+        self.assertEqual(AgoraCallHistory.objects.get(pk=accepted.pk).status, "missed")
+
+
+class SweeperTests(CallFixturesMixin, TestCase):
+    def test_sweep_moves_only_timed_out_calls(self):
+        stale = self.make_call(status="pending", joined_at=None)
+        fresh = self.make_call(status="pending", joined_at=None, channel_name="chan_2")
+        AgoraCallHistory.objects.filter(pk=stale.pk).update(start_time=timezone.now() - timedelta(minutes=5))
+
+        with self.assertNumQueries(5):
+            rows = sweep_missed_calls()
+
+        self.assertEqual([row[0] for row in rows], [stale.pk])
+        self.assertEqual(AgoraCallHistory.objects.get(pk=stale.pk).status, "missed")
+        self.assertEqual(AgoraCallHistory.objects.get(pk=fresh.pk).status, "pending")
+        self.assertFalse(Executive.objects.get(pk=self.executive.pk).on_call)
+
+
+class HeartbeatBufferTests(CallFixturesMixin, TestCase):
+    def test_flush_coalesces_heartbeats_into_one_update_per_second(self):
+        buffer = HeartbeatBuffer()
+        calls = [self.make_call(channel_name=f"chan_{i}") for i in range(20)]
+        at = timezone.now().replace(microsecond=0)
+        for _ in range(5):
+            for call in calls:
+                buffer.record(call.id, at)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(buffer.flush(), 20)
+        self.assertEqual(AgoraCallHistory.objects.filter(last_heartbeat=at).count(), 20)
+        # Nothing to write; the idle calls are only checked for having ended
+        with self.assertNumQueries(1):
+            self.assertEqual(buffer.flush(), 0)
+
+    def test_flush_drops_calls_ended_elsewhere(self):
+        buffer = HeartbeatBuffer()
+        live, ended = self.make_call(), self.make_call(channel_name="chan_2")
+        at = timezone.now()
+        buffer.record(live.id, at)
+        buffer.record(ended.id, at)
+        buffer.flush()
+        # Settled by another worker, so this buffer never saw forget()
+        AgoraCallHistory.objects.filter(pk=ended.pk).update(is_active=False, status="ended")
+
+        buffer.flush()
+        self.assertEqual(buffer.last_heartbeat(live.id), at)
+        self.assertIsNone(buffer.last_heartbeat(ended.id))
+
+    def test_reads_prefer_newest_value(self):
+        buffer = HeartbeatBuffer()
+        now = timezone.now()
+        buffer.record(7, now)
+        self.assertEqual(buffer.last_heartbeat(7, now - timedelta(seconds=5)), now)
+        self.assertEqual(buffer.last_heartbeat(7, now + timedelta(seconds=5)), now + timedelta(seconds=5))
+        self.assertIsNone(buffer.last_heartbeat(8))
+
+
+class ReaperTests(CallFixturesMixin, TestCase):
+    def test_reaps_only_calls_with_lapsed_lease(self):
+        now = timezone.now()
+        abandoned = self.make_call(last_heartbeat=now - timedelta(minutes=10))
+        alive = self.make_call(channel_name="chan_2", last_heartbeat=now)
+        just_joined = self.make_call(channel_name="chan_3")
+
+        reaped = reap_stale_calls(now)
+
+        self.assertEqual([r["call_id"] for r in reaped], [abandoned.id])
+        abandoned.refresh_from_db()
+        self.assertEqual((abandoned.status, abandoned.ended_by), ("ended", "reaper"))
+        self.assertFalse(Executive.objects.get(pk=self.executive.pk).on_call)
+        self.assertTrue(AgoraCallHistory.objects.get(pk=alive.pk).is_active)
+        self.assertTrue(AgoraCallHistory.objects.get(pk=just_joined.pk).is_active)
+
+    def test_joined_call_without_heartbeat_is_reaped(self):
+        now = timezone.now()
+        crashed = self.make_call(joined_seconds_ago=600)
+        self.assertIsNone(crashed.last_heartbeat)
+
+        self.assertEqual([r["call_id"] for r in reap_stale_calls(now)], [crashed.id])
+        self.assertFalse(AgoraCallHistory.objects.get(pk=crashed.pk).is_active)
+
+    def test_rejected_and_cancelled_calls_are_left_alone(self):
+        now = timezone.now()
+        start = now - timedelta(minutes=5)
+        rejected = self.make_call(status="rejected", joined_at=None)
+        cancelled = self.make_call(channel_name="chan_2", status="cancelled", joined_at=None)
+        AgoraCallHistory.objects.filter(pk__in=[rejected.pk, cancelled.pk]).update(start_time=start)
+
+        self.assertEqual(reap_stale_calls(now), [])
+        for call, status in ((rejected, "rejected"), (cancelled, "cancelled")):
+            call.refresh_from_db()
+            self.assertEqual((call.status, call.ended_by), (status, None))
+
+
+class ClaimExecutiveTests(CallFixturesMixin, TestCase):
+    def test_only_first_claim_wins(self):
+        Executive.objects.filter(pk=self.executive.pk).update(on_call=False)
+        with self.assertNumQueries(1):
+            self.assertTrue(claim_executive(self.executive.id))
+        self.assertFalse(claim_executive(self.executive.id))
+        self.assertTrue(Executive.objects.get(pk=self.executive.pk).on_call)
+
+    def test_unavailable_executive_cannot_be_claimed(self):
+        Executive.objects.filter(pk=self.executive.pk).update(on_call=False, is_suspended=True)
+        self.assertFalse(claim_executive(self.executive.id))
+        self.assertFalse(Executive.objects.get(pk=self.executive.pk).on_call)
+
+
+@override_settings(AGORA_TOKEN_TTL_SECONDS=3600, AGORA_TOKEN_REFRESH_MARGIN_SECONDS=300)
+class AgoraTokenCacheTests(SimpleTestCase):
+    def test_tokens_are_reused_until_near_expiry(self):
+        cache = AgoraTokenCache()
+        token, expires_at = cache.lease("chan_1", 7, now=1000)
+        self.assertEqual(expires_at, 4600)
+        self.assertEqual(cache.lease("chan_1", "7", now=4299), (token, expires_at))
+
+        renewed, renewed_expiry = cache.lease("chan_1", 7, now=4300)
+        self.assertNotEqual(renewed, token)
+        self.assertEqual(renewed_expiry, 7900)
+
+    def test_call_tokens_warm_the_callee_entry(self):
+        cache = AgoraTokenCache()
+        caller, callee = cache.call_tokens("chan_1", 7, 1007)
+        self.assertNotEqual(caller, callee)
+        self.assertEqual(cache.token("chan_1", 1007), callee)
+        self.assertEqual(len(cache), 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = AgoraTokenCache(max_entries=2)
+        first = cache.token("chan_1", 1)
+        cache.token("chan_2", 2)
+        cache.token("chan_1", 1)
+        cache.token("chan_3", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.token("chan_1", 1), first)
+
+
+class CallInitiateQueryBudgetTests(CallFixturesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        original = views.presence
+        views.presence = PresenceRegistry(MemoryPresenceStore())
+        views.presence.set_status(self.executive.executive_id, self.executive.name, "online")
+        self.addCleanup(setattr, views, "presence", original)
+
+    def initiate(self, executive_id=None):
+        request = APIRequestFactory().post("/calls/initiate/", {
+            "executive_id": executive_id or self.executive.id,
+            "channel_name": "chan_new",
+            "caller_uid": 7,
+        }, format="json")
+        force_authenticate(request, user=self.user)
+        return CallInitiateView.as_view()(request)
+
+    def test_initiation_query_budget(self):
+        Executive.objects.filter(pk=self.executive.pk).update(on_call=False)
+        # load, SAVEPOINT, claim, insert, RELEASE
+        with self.assertNumQueries(5):
+            response = self.initiate()
+        self.assertEqual(response.status_code, 201)
+        call = AgoraCallHistory.objects.get(pk=response.data["id"])
+        self.assertEqual((call.status, call.coins_per_second), ("pending", 3))
+        self.assertTrue(Executive.objects.get(pk=self.executive.pk).on_call)
+
+    def test_rejections_cost_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.initiate().data["code"], "executive_busy")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.initiate(executive_id=999999).status_code, 404)
+
+        Executive.objects.filter(pk=self.executive.pk).update(on_call=False)
+        UserStats.objects.filter(user=self.user).update(coin_balance=100)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.initiate().status_code, 402)
+        self.assertFalse(Executive.objects.get(pk=self.executive.pk).on_call)
+
+    def test_presence_decides_who_is_online(self):
+        Executive.objects.filter(pk=self.executive.pk).update(on_call=False, is_online=False)
+        UserStats.objects.filter(user=self.user).update(coin_balance=1000)
+        # The column lags behind presence until the flag flusher runs
+        self.assertEqual(self.initiate().status_code, 201)
+
+        Executive.objects.filter(pk=self.executive.pk).update(on_call=False, is_online=True)
+        views.presence.set_status(self.executive.executive_id, self.executive.name, "offline")
+        self.assertEqual(self.initiate().data["detail"], "Executive is offline")
+
+
+# Queries are counted on this thread's connection, so they must not go to the pool
+@override_settings(CONSUMER_DB_POOL_SIZE=0)
+class CallConsumerAuthorizationTests(CallFixturesMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.manager = get_user_model().objects.create(email="manager@example.com", name="Manager")
+        Executive.objects.filter(pk=self.executive.pk).update(manager_executive=self.manager)
+        self.call = self.make_call()
+
+        self.consumer = CallConsumer()
+        self.consumer.scope = {"type": "websocket", "user": self.manager}
+        self.consumer.channel_layer = get_channel_layer()
+        self.consumer.channel_name = "test.call"
+        self.sent = []
+
+        async def base_send(message):
+            if "text" in message:
+                self.sent.append(json.loads(message["text"]))
+        self.consumer.base_send = base_send
+        async_to_sync(self.consumer.connect)()
+        self.sent.clear()
+
+    def action(self, message):
+        async_to_sync(self.consumer.receive)(json.dumps(message))
+        return self.sent.pop()
+
+    def test_connect_resolves_the_executive_and_active_calls_once(self):
+        self.assertEqual(self.consumer.executive, self.executive)
+        self.assertEqual(self.consumer.call_ids, {self.call.id})
+
+    def test_actions_authorize_against_the_connection(self):
+        # Only the call itself is read; the executive is not looked up again
+        with self.assertNumQueries(1):
+            self.assertEqual(self.action({"type": "heartbeat", "call_id": self.call.id})["type"], "heartbeat_ack")
+        with self.assertNumQueries(0):
+            self.assertTrue(self.action({"type": "get_user_info"})["is_executive"])
+
+    def test_call_events_update_the_allowed_calls(self):
+        other = self.make_call(channel_name="chan_2")
+        async_to_sync(self.consumer.incoming_call)({"type": "incoming_call", "call_id": other.id})
+        self.assertIn(other.id, self.consumer.call_ids)
+        with self.assertNumQueries(1):
+            self.action({"type": "heartbeat", "call_id": other.id})
+
+        async_to_sync(self.consumer.call_ended_event)({"type": "call_ended_event", "call_id": other.id})
+        self.assertEqual(self.consumer.call_ids, {self.call.id})
+
+    def test_calls_of_other_parties_are_refused(self):
+        stranger = UserProfile.objects.create(mobile_number="9000000002")
+        other_executive = Executive.objects.create(executive_id="EX0002", mobile_number="8000000002")
+        foreign = self.make_call(user=stranger, executive=other_executive, channel_name="chan_3")
+        response = self.action({"type": "heartbeat", "call_id": foreign.id})
+        self.assertEqual(response["message"], "Call not found or access denied")
+        self.assertNotIn(foreign.id, self.consumer.call_ids)
+
+
+class CallEventEncodingTests(SimpleTestCase):
+    def test_events_are_encoded_once_and_forwarded_unchanged(self):
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, message):
+                sent.append((group, message))
+        original = notifications.get_channel_layer
+        notifications.get_channel_layer = Layer
+        self.addCleanup(setattr, notifications, "get_channel_layer", original)
+
+        async_to_sync(notifications.send_to_call_parties)(1, 2, {"type": "call_missed_event", "call_id": 7})
+        (_, to_user), (_, to_executive) = sent
+        self.assertIs(to_user["text"], to_executive["text"])
+        self.assertEqual(json.loads(to_user["text"]), {"type": "call_missed_event", "call_id": 7})
+
+        consumer = CallConsumer()
+        consumer.call_ids = {7}
+        frames = []
+
+        async def base_send(message):
+            frames.append(message["text"])
+        consumer.base_send = base_send
+        async_to_sync(consumer.call_missed_event)(to_user)
+        self.assertIs(frames[0], to_user["text"])
+        # Events sent without text are still encoded by the handler
+        async_to_sync(consumer.call_joined_event)({"type": "call_joined_event", "call_id": 7})
+        self.assertEqual(json.loads(frames[1]), {"type": "call_joined_event", "call_id": 7})
+
+
+class WireProtocolTests(SimpleTestCase):
+    def consumer(self, subprotocols):
+        consumer = CallConsumer()
+        consumer.scope = {"type": "websocket", "subprotocols": subprotocols}
+        consumer.user = SimpleNamespace(id=1)
+        frames = []
+
+        async def base_send(message):
+            frames.append(message)
+        consumer.base_send = base_send
+        async_to_sync(consumer.accept)()
+        return consumer, frames
+
+    def test_json_stays_the_default(self):
+        consumer, frames = self.consumer([])
+        self.assertIsNone(frames[0]["subprotocol"])
+        async_to_sync(consumer.websocket_receive)({"type": "websocket.receive", "text": '{"type": "ping"}'})
+        self.assertEqual(json.loads(frames[1]["text"])["message"], "WebSocket is working perfectly!")
+
+    @skipUnless(wire.msgpack, "msgpack is not installed")
+    def test_msgpack_clients_get_short_codes_without_filler(self):
+        consumer, frames = self.consumer(["talkeasy.msgpack.v1"])
+        self.assertEqual(frames[0]["subprotocol"], wire.MSGPACK_SUBPROTOCOL)
+        ping = wire.msgpack.packb({"t": "ping"})
+        with contextlib.redirect_stdout(io.StringIO()):
+            async_to_sync(consumer.websocket_receive)({"type": "websocket.receive", "bytes": ping})
+        pong = wire.msgpack.unpackb(frames[1]["bytes"])
+        self.assertEqual(set(pong), {"t", "ts", "u"})
+        self.assertEqual(wire.unpack(frames[1]["bytes"])["type"], "pong")
+
+        async_to_sync(consumer.send_error)("Call not found")
+        self.assertEqual(wire.unpack(frames[2]["bytes"])["message"], "Call not found")
+
+    @skipUnless(wire.msgpack, "msgpack is not installed")
+    def test_group_messages_are_packed_once(self):
+        text = wire.dumps({"type": "call_missed_event", "call_id": 7})
+        self.assertIs(wire.pack_text(text), wire.pack_text(text))
+
+
+class DBExecutorTests(SimpleTestCase):
+    def test_jobs_keep_their_order_per_connection_and_overlap_across_connections(self):
+        executor = DBExecutor(size=4)
+        self.addCleanup(executor.shutdown)
+        log, lock, active, peak = [], threading.Lock(), [0], [0]
+
+        def job(key, i):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.005)
+            with lock:
+                log.append((key, i))
+                active[0] -= 1
+
+        async def scenario():
+            await asyncio.gather(*(executor.run(key, job, key, i) for i in range(5) for key in "abcdef"))
+
+        async_to_sync(scenario)()
+        for key in "abcdef":
+            self.assertEqual([i for k, i in log if k == key], list(range(5)))
+        self.assertGreater(peak[0], 1)
+        self.assertLessEqual(peak[0], 4)
+        stats = executor.stats()
+        self.assertEqual((stats["completed"], stats["queued"], stats["running"], stats["connections"]), (30, 0, 0, 0))
+        self.assertGreater(stats["max_queued"], 0)
+
+    def test_cancelled_job_still_holds_back_the_next_one(self):
+        executor = DBExecutor(size=2)
+        self.addCleanup(executor.shutdown)
+        started, log = threading.Event(), []
+
+        def slow():
+            started.set()
+            time.sleep(0.05)
+            log.append("slow")
+
+        async def scenario():
+            first = asyncio.ensure_future(executor.run("a", slow))
+            await asyncio.get_running_loop().run_in_executor(None, started.wait)
+            second = asyncio.ensure_future(executor.run("a", log.append, "next"))
+            first.cancel()
+            await second
+
+        async_to_sync(scenario)()
+        self.assertEqual(log, ["slow", "next"])
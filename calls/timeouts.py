@@ -0,0 +1,125 @@
+# calls/timeouts.py
+"""
+Ring, join and heartbeat timeouts for calls, driven by ``calls.timers``.
+
+* ring: armed at initiation, cancelled when the executive accepts.
+* join: armed on accept, cancelled once the call is joined.
+* heartbeat: armed on the first heartbeat and pushed forward by every
+  following one; only calls whose clients send heartbeats can time out.
+
+Ring and join timeouts move the call to ``missed`` and release the
+executive, in one batch per tick. A ring timeout only misses calls still
+``pending`` and a join timeout only ones still ``ringing``: the timers
+live in the process that armed them, so an accept handled by another
+worker cannot cancel the ring timer here. Heartbeat timeouts settle the call.
+"""
+import time
+from datetime import timedelta
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from calls.autoend import AUTO_END
+from calls.heartbeats import heartbeats
+from calls.models import AgoraCallHistory
+from calls.notifications import notify_call_ended, notify_calls_missed
+from calls.settlement import settle_call
+from calls.timers import timers
+from executives.models import Executive
+
+RING_TIMEOUT = "ring_timeout"
+JOIN_TIMEOUT = "join_timeout"
+HEARTBEAT_TIMEOUT = "heartbeat_timeout"
+
+
+def ring_timeout():
+    return getattr(settings, "CALL_RING_TIMEOUT_SECONDS", 30)
+
+
+def join_timeout():
+    return getattr(settings, "CALL_JOIN_TIMEOUT_SECONDS", 30)
+
+
+def heartbeat_timeout():
+    return getattr(settings, "CALL_HEARTBEAT_TIMEOUT_SECONDS", 60)
+
+
+def call_initiated(call_id):
+    timers.arm(RING_TIMEOUT, call_id, time.time() + ring_timeout())
+
+
+def call_accepted(call_id):
+    timers.cancel(RING_TIMEOUT, call_id)
+    timers.arm(JOIN_TIMEOUT, call_id, time.time() + join_timeout())
+
+
+def call_joined(call_id):
+    timers.cancel(RING_TIMEOUT, call_id)
+    timers.cancel(JOIN_TIMEOUT, call_id)
+
+
+def heartbeat_received(call_id):
+    timers.arm(HEARTBEAT_TIMEOUT, call_id, time.time() + heartbeat_timeout())
+
+
+def miss_calls(queryset, ender="timeout"):
+    """
+    Move the still-unanswered calls in ``queryset`` to ``missed`` and
+    release their executives: one UPDATE per table. Any auto-end timer
+    left on them is cancelled.
+
+    Returns ``(call_id, user_id, executive_id)`` for every call moved.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            queryset.select_for_update()
+            .filter(is_active=True, status__in=["pending", "ringing"])
+            .values_list("id", "user_id", "executive_id")
+        )
+        if not rows:
+            return []
+        AgoraCallHistory.objects.filter(id__in=[row[0] for row in rows]).update(
+            status="missed", is_active=False, end_time=now, ended_by=ender,
+        )
+        Executive.objects.filter(id__in={row[2] for row in rows}).update(on_call=False)
+    for call_id, _, _ in rows:
+        timers.cancel(AUTO_END, call_id)
+    return rows
+
+
+def mark_calls_missed(call_ids, status):
+    return miss_calls(AgoraCallHistory.objects.filter(id__in=call_ids, status=status))
+
+
+def expire_heartbeats(call_ids):
+    """Settle calls whose heartbeat really lapsed; re-arm the ones refreshed elsewhere."""
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=heartbeat_timeout())
+    settled = []
+    rows = AgoraCallHistory.objects.filter(id__in=call_ids, is_active=True).values_list("id", "last_heartbeat")
+    for call_id, stored in rows:
+        last_heartbeat = heartbeats.last_heartbeat(call_id, stored)
+        if last_heartbeat and last_heartbeat > cutoff:
+            timers.arm(HEARTBEAT_TIMEOUT, call_id, last_heartbeat.timestamp() + heartbeat_timeout())
+            continue
+        result = settle_call(call_id, ender="heartbeat_timeout")
+        if result:
+            settled.append(result)
+    return settled
+
+
+@timers.handler(RING_TIMEOUT)
+async def unanswered_calls(call_ids):
+    await notify_calls_missed(await database_sync_to_async(mark_calls_missed)(call_ids, "pending"))
+
+
+@timers.handler(JOIN_TIMEOUT)
+async def unjoined_calls(call_ids):
+    await notify_calls_missed(await database_sync_to_async(mark_calls_missed)(call_ids, "ringing"))
+
+
+@timers.handler(HEARTBEAT_TIMEOUT)
+async def lapsed_heartbeats(call_ids):
+    for settled in await database_sync_to_async(expire_heartbeats)(call_ids):
+        await notify_call_ended(settled, "Connection lost, call ended automatically")
@@ -0,0 +1,165 @@
+# calls/timers.py
+"""
+In-process call timers.
+
+Each (kind, call_id) pair holds at most one armed deadline; arming it
+again replaces the previous one. Views arm timers from worker threads,
+and the ``call-timers`` service fires due timers on the ASGI event loop,
+handing every handler the batch of call ids that came due in one tick.
+
+Timers are kept in a hierarchical timing wheel, so arming and cancelling
+are O(1) no matter how many calls are pending, and a tick only touches
+the timers that are due.
+"""
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from talkeasy.services import run_periodic
+
+
+class TimerWheel:
+    """
+    Hashed hierarchical timing wheel.
+
+    Level 0 has one slot per tick; every slot on level ``n`` covers a
+    full rotation of level ``n - 1``. Timers further out than the top
+    level can reach are parked in its farthest slot and re-placed when
+    that slot cascades.
+    """
+
+    def __init__(self, tick, slots_per_level=64, levels=4, now=None):
+        self.tick = tick
+        self.bits = (slots_per_level - 1).bit_length()
+        if 1 << self.bits != slots_per_level:
+            raise ValueError("slots_per_level must be a power of two")
+        self.mask = slots_per_level - 1
+        self.levels = levels
+        self.current = self.to_tick(time.time() if now is None else now)
+        self._wheel = [[{} for _ in range(slots_per_level)] for _ in range(levels)]
+        self._where = {}  # key -> slot dict currently holding it
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def to_tick(self, seconds):
+        return int(seconds / self.tick)
+
+    def add(self, key, deadline):
+        """Insert or move ``key`` so it expires at ``deadline`` (epoch seconds)."""
+        self.remove(key)
+        # A deadline that is already due fires on the next tick
+        self._place(key, max(self.to_tick(deadline), self.current + 1))
+
+    def remove(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del slot[key]
+            return True
+        return False
+
+    def _place(self, key, expires):
+        delta = expires - self.current
+        for level in range(self.levels):
+            if delta < 1 << (self.bits * (level + 1)):
+                break
+        else:
+            # Beyond the horizon: park in the farthest top-level slot
+            level = self.levels - 1
+            expires_slot = self.current + (1 << (self.bits * self.levels)) - 1
+            slot = self._wheel[level][(expires_slot >> (self.bits * level)) & self.mask]
+            slot[key] = expires
+            self._where[key] = slot
+            return
+        slot = self._wheel[level][(expires >> (self.bits * level)) & self.mask]
+        slot[key] = expires
+        self._where[key] = slot
+
+    def _cascade(self):
+        for level in range(1, self.levels):
+            if self.current & ((1 << (self.bits * level)) - 1):
+                break
+            slot = self._wheel[level][(self.current >> (self.bits * level)) & self.mask]
+            entries = list(slot.items())
+            slot.clear()
+            for key, expires in entries:
+                self._place(key, expires)
+
+    def advance(self, now):
+        """Move the wheel up to ``now`` and return the keys that expired."""
+        target = self.to_tick(now)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            self._cascade()
+            slot = self._wheel[0][self.current & self.mask]
+            if slot:
+                for key in slot:
+                    del self._where[key]
+                expired.extend(slot)
+                slot.clear()
+        return expired
+
+
+class CallTimers:
+    def __init__(self, tick=None):
+        self._lock = threading.Lock()
+        self._wheel = TimerWheel(tick or getattr(settings, "CALL_TIMER_TICK_SECONDS", 0.25))
+        self._handlers = {}
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def handler(self, kind):
+        """Register ``async def handler(call_ids)`` for timers of ``kind``."""
+        def decorator(func):
+            self._handlers[kind] = func
+            return func
+        return decorator
+
+    def arm(self, kind, call_id, deadline):
+        """Fire ``kind`` for ``call_id`` at ``deadline`` (epoch seconds)."""
+        with self._lock:
+            self._wheel.add((kind, call_id), deadline)
+
+    def cancel(self, kind, call_id):
+        with self._lock:
+            self._wheel.remove((kind, call_id))
+
+    def cancel_call(self, call_id):
+        with self._lock:
+            for kind in self._handlers:
+                self._wheel.remove((kind, call_id))
+
+    def is_armed(self, kind, call_id):
+        return (kind, call_id) in self._wheel
+
+    def pop_due(self, now=None):
+        """Remove and return ``{kind: [call_id, ...]}`` for every timer due at ``now``."""
+        with self._lock:
+            expired = self._wheel.advance(time.time() if now is None else now)
+        due = defaultdict(list)
+        for kind, call_id in expired:
+            due[kind].append(call_id)
+        return due
+
+    async def fire_due(self):
+        # The timers are already off the wheel, so one failing kind must not
+        # cost the others theirs
+        for kind, call_ids in self.pop_due().items():
+            handler = self._handlers.get(kind)
+            if not handler:
+                continue
+            try:
+                await handler(call_ids)
+            except Exception as e:
+                print(f"Call timer handler {kind} failed for {call_ids}: {e}")
+
+    async def run(self):
+        await run_periodic(self._wheel.tick, self.fire_due)
+
+
+timers = CallTimers()
@@ -0,0 +1,91 @@
+# calls/tokens.py
+"""
+Cache of Agora RTC tokens.
+
+Building a token is a full HMAC signing pass, and a call needs one for
+the caller and one for the executive when it is initiated, then the
+executive's again on join. Tokens are kept per (channel, uid, role) and
+handed out until ``AGORA_TOKEN_REFRESH_MARGIN_SECONDS`` before they
+expire, so repeat requests for the same party are a dictionary lookup.
+
+``call_tokens()`` builds both parties' tokens up front, which also warms
+the entry ``CallJoinView`` asks for. Clients renew through ``lease()``
+(see the renew-token views), which returns the cached token while it
+still has life left and only signs a new one near expiry.
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from agora_token_builder import RtcTokenBuilder
+
+PUBLISHER = 1
+
+
+def token_ttl():
+    return getattr(settings, "AGORA_TOKEN_TTL_SECONDS", 3600)
+
+
+def refresh_margin():
+    return getattr(settings, "AGORA_TOKEN_REFRESH_MARGIN_SECONDS", 300)
+
+
+def build_token(channel_name, uid, role=PUBLISHER, expires_at=None):
+    """Sign a new token; this is the expensive call the cache avoids."""
+    expires_at = expires_at or int(time.time()) + token_ttl()
+    return RtcTokenBuilder.buildTokenWithUid(
+        settings.AGORA_APP_ID,
+        settings.AGORA_APP_CERTIFICATE,
+        channel_name,
+        uid,
+        role,
+        expires_at
+    )
+
+
+class AgoraTokenCache:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (channel, uid, role) -> (token, expires_at), oldest first
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lease(self, channel_name, uid, role=PUBLISHER, now=None):
+        """Return ``(token, expires_at)``, signing a new token only when needed."""
+        now = int(time.time() if now is None else now)
+        # The builder signs str(uid), so "42" and 42 are the same token
+        key = (channel_name, str(uid), role)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] - refresh_margin() > now:
+                self._entries.move_to_end(key)
+                return entry
+
+        expires_at = now + token_ttl()
+        entry = (build_token(channel_name, uid, role, expires_at), expires_at)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def token(self, channel_name, uid, role=PUBLISHER):
+        return self.lease(channel_name, uid, role)[0]
+
+    def call_tokens(self, channel_name, caller_uid, callee_uid, role=PUBLISHER):
+        """Caller and callee tokens for one channel, built together."""
+        now = int(time.time())
+        return (
+            self.lease(channel_name, caller_uid, role, now)[0],
+            self.lease(channel_name, callee_uid, role, now)[0],
+        )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+agora_tokens = AgoraTokenCache()
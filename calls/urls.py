@@ -10,6 +10,8 @@ urlpatterns = [
     path("end-call/<int:call_id>/", EndCallView.as_view(), name="end-call"),
     path("agora/webhook/", AgoraWebhookView.as_view(), name="agora-webhook"),
     path("calls/<int:call_id>/end/", EndCallView.as_view(), name="end-call"),
+    path("calls/<int:call_id>/renew-token/", CallTokenRenewView.as_view(), name="renew-token"),
+    path("Executive-call/<int:call_id>/renew-token/", ExecutiveCallTokenRenewView.as_view(), name="renew-token-executive"),
     path("user-call/<int:call_id>/reject/", RejectCallViewUser.as_view(), name="reject-call-user"),
     path("Executive-call/<int:call_id>/reject/", RejectCallViewExecutive.as_view(), name="reject-call-executive"),
 
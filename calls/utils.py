@@ -1,6 +1,7 @@
 import time
 from django.conf import settings
 from agora_token_builder import RtcTokenBuilder
+from calls.tokens import agora_tokens
 
 def build_agora_token(channel_name: str, uid: int, role: int = 1, ttl_seconds: int | None = None) -> str:
     app_id = settings.AGORA_APP_ID
@@ -13,13 +14,15 @@ def build_agora_token(channel_name: str, uid: int, role: int = 1, ttl_seconds: i
 # calls/utils.py
 
 def generate_agora_token(channel_name, uid, role=1):
-    expiration_time = int(time.time()) + settings.AGORA_TOKEN_TTL_SECONDS
-    token = RtcTokenBuilder.buildTokenWithUid(
-        settings.AGORA_APP_ID,
-        settings.AGORA_APP_CERTIFICATE,
-        channel_name,
-        uid,
-        role,  
-        expiration_time
-    )
-    return token
+    # Served from the token cache; see calls/tokens.py
+    return agora_tokens.token(channel_name, uid, role)
+
+
+# Upper bound on ids per IN (...) so statements stay within driver limits
+BATCH_SIZE = 5000
+
+
+def chunked(ids, size=BATCH_SIZE):
+    ids = list(ids)
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
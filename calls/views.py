@@ -1,6 +1,7 @@
 # calls/views.py
 from django.conf import settings
 from django.db import transaction
+from django.http import Http404
 from django.utils import timezone
 from rest_framework import status, permissions
 from rest_framework.response import Response
@@ -32,6 +33,13 @@ from executives.models import Executive
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from users.models import UserStats
+from calls.autoend import arm_auto_end
+from calls.heartbeats import heartbeats
+from calls.initiation import claim_executive, executive_rates, load_executive_for_call
+from calls.timeouts import call_initiated, call_joined
+from calls.tokens import agora_tokens
+from executives.presence import presence
+from talkeasy.wire import with_text
 
 
 class CallInitiateView(APIView):
@@ -42,8 +50,10 @@ class CallInitiateView(APIView):
             channel_name = serializer.validated_data['channel_name']
             caller_uid = serializer.validated_data['caller_uid']
 
-            # Get executive
-            executive = get_object_or_404(Executive, id=executive_id)
+            # Executive, their rates and the caller's balance in one query
+            executive = load_executive_for_call(executive_id, request.user.id)
+            if executive is None:
+                raise Http404("No Executive matches the given query.")
 
             # Validate executive availability
             validation_error = self.validate_executive(executive)
@@ -51,48 +61,48 @@ class CallInitiateView(APIView):
                 return validation_error
 
             user = request.user
-            try:
-                user_stats = user.stats
-            except UserStats.DoesNotExist:
+            coin_balance = executive.caller_coin_balance
+            if coin_balance is None:
                 return Response(
                     {"detail": "User stats not found"},
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            if user_stats.coin_balance < 180:
+            if coin_balance < 180:
                 return Response(
                     {"detail": "At least 180 coins required to start a call"},
                     status=status.HTTP_402_PAYMENT_REQUIRED
                 )
 
-            # Mark executive as on call
-            executive.on_call = True
-            executive.save(update_fields=["on_call"])
-
             # Generate tokens for caller and executive
-            caller_token = generate_agora_token(channel_name, caller_uid)
             callee_uid = caller_uid + 1000
-            executive_token = generate_agora_token(channel_name, callee_uid)
-
-            # Get executive rates safely
-            exec_stats, _ = ExecutiveStats.objects.get_or_create(executive=executive)
-            rate_per_minute = exec_stats.amount_per_min
-            coins_per_second = exec_stats.coins_per_second
-
-            # Create call history
-            call_history = AgoraCallHistory.objects.create(
-                executive=executive,
-                channel_name=channel_name,
-                uid=caller_uid,
-                callee_uid=callee_uid,
-                token=caller_token,
-                executive_token=executive_token,
-                status="pending",
-                is_active=True,
-                user=user,
-                coins_per_second=coins_per_second,
-                amount_per_min=rate_per_minute
-            )
+            caller_token, executive_token = agora_tokens.call_tokens(channel_name, caller_uid, callee_uid)
+
+            with transaction.atomic():
+                # Mark executive as on call; only one concurrent caller can win.
+                # Anything failing below rolls the claim back with the call.
+                if not claim_executive(executive.id):
+                    return self.executive_busy()
+
+                # Get executive rates safely
+                exec_stats = executive_rates(executive)
+                rate_per_minute = exec_stats.amount_per_min
+                coins_per_second = exec_stats.coins_per_second
+
+                # Create call history
+                call_history = AgoraCallHistory.objects.create(
+                    executive=executive,
+                    channel_name=channel_name,
+                    uid=caller_uid,
+                    callee_uid=callee_uid,
+                    token=caller_token,
+                    executive_token=executive_token,
+                    status="pending",
+                    is_active=True,
+                    user=user,
+                    coins_per_second=coins_per_second,
+                    amount_per_min=rate_per_minute
+                )
 
             # Send WebSocket notification
             self.send_incoming_call_notification(executive_id, call_history, user)
@@ -116,23 +126,31 @@ class CallInitiateView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     def validate_executive(self, executive):
-        if not executive.is_online:
+        # Presence is the source of truth for online/on call; the columns lag behind it
+        presence_status = presence.status(executive.executive_id)
+        if presence_status == "offline":
             return Response({"detail": "Executive is offline"}, status=status.HTTP_400_BAD_REQUEST)
         if executive.is_banned:
             return Response({"detail": "Executive is banned"}, status=status.HTTP_403_FORBIDDEN)
         if executive.is_suspended:
             return Response({"detail": "Executive is suspended"}, status=status.HTTP_403_FORBIDDEN)
-        if executive.on_call:
-            return Response({"detail": "Executive is on another call"}, status=status.HTTP_400_BAD_REQUEST)
+        if presence_status == "oncall" or executive.on_call:
+            return self.executive_busy()
         return None
 
+    def executive_busy(self):
+        return Response(
+            {"detail": "Executive is on another call", "code": "executive_busy"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
     def send_incoming_call_notification(self, executive_id, call_history, caller):
         try:
             channel_layer = get_channel_layer()
             if channel_layer:
                 async_to_sync(channel_layer.group_send)(
                     f"executive_{executive_id}",
-                    {
+                    with_text({
                         "type": "incoming_call",
                         "call_id": call_history.id,
                         "channel_name": call_history.channel_name,
@@ -143,14 +161,15 @@ class CallInitiateView(APIView):
                         "timestamp": call_history.start_time.isoformat(),
                         "coins_per_second": call_history.coins_per_second,
                         "amount_per_min": str(call_history.amount_per_min),
-                    }
+                    })
                 )
         except Exception as e:
             print(f"WebSocket notification failed: {e}")
 
     def schedule_missed_call_check(self, call_id):
-        from .tasks import mark_call_as_missed
-        mark_call_as_missed.apply_async(args=[call_id], countdown=30)
+        # Ring timeout is owned by the in-process timer wheel; accepting the
+        # call cancels it
+        call_initiated(call_id)
 
 
 
@@ -188,7 +207,8 @@ class EndCallView(APIView):
             return Response({"error": "Call not found or already ended"}, status=404)
 
         #  Check if user has coins left before ending
-        if call.user.coin_balance <= 0:
+        user_stats = getattr(call.user, "stats", None)
+        if user_stats is not None and user_stats.coin_balance <= 0:
             call.end_call(ender="system")
             reason = "Insufficient balance, call ended automatically"
         else:
@@ -256,9 +276,9 @@ class AgoraWebhookView(APIView):
             req_id = f"webhook:{event}:{payload.get('timestamp', timezone.now().isoformat())}"
             call.end_call(ender="webhook", request_id=req_id)
 
-        # You may persist heartbeat / last activity timestamp
-        call.last_heartbeat = timezone.now()
-        call.save(update_fields=["last_heartbeat"])
+        # Last activity is buffered and written in bulk by the heartbeat flusher
+        if call.is_active:
+            heartbeats.record(call.id)
         return Response({"ok": True})
 
 class CallJoinView(APIView):
@@ -277,8 +297,8 @@ class CallJoinView(APIView):
         if not callee_uid:
             return Response({"error": "callee_uid is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Generate token for executive
-        executive_token = generate_agora_token(call.channel_name, callee_uid)
+        # Usually already built alongside the caller's token at initiate time
+        executive_token = agora_tokens.token(call.channel_name, callee_uid)
 
         # Update call record
         call.callee_uid = callee_uid
@@ -287,6 +307,8 @@ class CallJoinView(APIView):
         call.joined_at = timezone.now()
         call.is_active = True
         call.save()
+        call_joined(call.id)
+        arm_auto_end(call)
 
         return Response({
             "id": call.id,
@@ -301,6 +323,47 @@ class CallJoinView(APIView):
 
 
 
+class CallTokenRenewView(APIView):
+    """Renew the caller's Agora token before it expires."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, call_id):
+        try:
+            call = AgoraCallHistory.objects.get(id=call_id, user=request.user, is_active=True)
+        except AgoraCallHistory.DoesNotExist:
+            return Response({"error": "Call not found or already inactive"}, status=404)
+        return renew_token_response(call, "uid", "token")
+
+
+class ExecutiveCallTokenRenewView(APIView):
+    """Renew the executive's Agora token before it expires."""
+    authentication_classes = [ExecutiveTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, call_id):
+        try:
+            call = AgoraCallHistory.objects.get(id=call_id, executive=request.user, is_active=True)
+        except AgoraCallHistory.DoesNotExist:
+            return Response({"error": "Call not found or already inactive"}, status=404)
+        if call.callee_uid is None:
+            return Response({"error": "Executive has not joined the call"}, status=status.HTTP_400_BAD_REQUEST)
+        return renew_token_response(call, "callee_uid", "executive_token")
+
+
+def renew_token_response(call, uid_field, token_field):
+    uid = getattr(call, uid_field)
+    token, expires_at = agora_tokens.lease(call.channel_name, uid)
+    if token != getattr(call, token_field):
+        AgoraCallHistory.objects.filter(id=call.id).update(**{token_field: token})
+    return Response({
+        "call_id": call.id,
+        "channel_name": call.channel_name,
+        "uid": uid,
+        "token": token,
+        "expires_at": expires_at,
+    })
+
+
 class RejectCallViewUser(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
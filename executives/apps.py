@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class ExecutivesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'executives'
+
+    def ready(self):
+        from talkeasy import middleware, services
+        from executives import flags, leases
+        from executives.presence import presence
+
+        middleware.connect_invalidation()
+
+        services.register("presence-leases", leases.run)
+        services.register("executive-flags", flags.run)
+        services.on_shutdown(presence.store.close)
@@ -1,7 +1,84 @@
+"""
+Authentication for the executive app's ``X-EXECUTIVE-TOKEN`` header.
+
+Tokens are looked up through ``token_cache``, which keeps
+``(executive id, expiry, revoked)`` for each token (keyed on its
+SHA-256) for ``EXECUTIVE_TOKEN_CACHE_SECONDS``, so repeat requests
+authenticate without a query. ``request.user`` is a lazy executive: the
+row is only loaded if the view reads it, and then fresh, so views that
+save ``request.user`` never write back stale columns.
+
+Saving or deleting an ``ExecutiveToken`` or ``Executive`` updates the
+cache through the signals wired in ``talkeasy.middleware`` (revoking a
+token marks it revoked, anything else drops the entries), whichever code
+path made the change. A banned executive's tokens are treated as
+revoked.
+"""
+import time
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
-from .models import ExecutiveToken
-from django.utils import timezone
+from talkeasy.authcache import AuthCache, owner_key, token_digest
+from .models import Executive, ExecutiveToken
+
+
+def cache_ttl():
+    return getattr(settings, "EXECUTIVE_TOKEN_CACHE_SECONDS", 60)
+
+
+class ExecutiveTokenCache(AuthCache):
+    def lookup(self, token, now=None):
+        """``(executive_id, expires_at, revoked)`` for ``token``, or None if there is no such token."""
+        now = time.time() if now is None else now
+        digest = token_digest(token)
+        entry = self.get(digest, now)
+        if entry is not None:
+            return entry
+
+        row = ExecutiveToken.objects.filter(refresh_token=token).values_list(
+            "executive_id", "expires_at", "revoked", "executive__is_banned"
+        ).first()
+        if row is None:
+            super().invalidate(digest)
+            return None
+        executive_id, expires_at, revoked, banned = row
+        entry = (executive_id, expires_at.timestamp(), revoked or banned)
+        self.put(digest, entry, owner_key(Executive, executive_id), now + cache_ttl())
+        return entry
+
+    def revoke(self, token):
+        digest = token_digest(token)
+        entry = self.get(digest)
+        if entry is not None:
+            self.update(digest, entry[:2] + (True,))
+
+    def invalidate(self, token):
+        super().invalidate(token_digest(token))
+
+    def invalidate_executive(self, executive_id):
+        self.invalidate_owner(owner_key(Executive, executive_id))
+
+
+token_cache = ExecutiveTokenCache(getattr(settings, "EXECUTIVE_TOKEN_CACHE_SIZE", 10000))
+
+
+class LazyExecutive(SimpleLazyObject):
+    # Answered without loading the row, so permission checks stay query-free:
+    # IsAuthenticated tests bool(request.user) before is_authenticated
+    is_authenticated = True
+    is_anonymous = False
+
+    def __bool__(self):
+        return True
+
+
+def load_executive(executive_id):
+    executive = Executive.objects.filter(pk=executive_id).first()
+    if executive is None:
+        # Deleted since the token was cached
+        raise AuthenticationFailed("Invalid token")
+    return executive
 
 
 class ExecutiveTokenAuthentication(BaseAuthentication):
@@ -10,12 +87,14 @@ class ExecutiveTokenAuthentication(BaseAuthentication):
         if not token:
             return None
 
-        try:
-            token_obj = ExecutiveToken.objects.get(refresh_token=token)  
-        except ExecutiveToken.DoesNotExist:
+        entry = token_cache.lookup(token)
+        if entry is None:
             raise AuthenticationFailed("Invalid token")
 
-        if hasattr(token_obj, "expires_at") and token_obj.expires_at < timezone.now():
+        executive_id, expires_at, revoked = entry
+        if revoked:
+            raise AuthenticationFailed("Token revoked")
+        if expires_at < time.time():
             raise AuthenticationFailed("Token expired")
 
-        return (token_obj.executive, None)
+        return (LazyExecutive(lambda: load_executive(executive_id)), None)
@@ -1,116 +1,24 @@
+import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth.models import AnonymousUser
-from channels.db import database_sync_to_async
+from asgiref.sync import sync_to_async
 from django.utils import timezone
-from urllib.parse import parse_qs
-
-# JWT imports for UsersConsumer
-from rest_framework_simplejwt.tokens import UntypedToken
-from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from django.conf import settings
-import jwt
 
 # Import your models (adjust paths as needed)
-from executives.models import Executive, ExecutiveToken
+from executives.models import Executive
 from users.models import UserProfile
-
-# Clean global dictionary for executive statuses
-EXECUTIVE_STATUS = {}
-
-class JWTAuthMixin:
-    
-    async def authenticate_jwt(self, token):
-        try:
-            UntypedToken(token)
-            
-            decoded_token = jwt.decode(
-                token, 
-                settings.SECRET_KEY, 
-                algorithms=['HS256']
-            )
-            
-            user_id = decoded_token.get('user_id')
-            print(f"DEBUG: JWT Token decoded user_id: {user_id}")  
-            
-            if not user_id:
-                return None
-                
-            user = await self.get_user_by_id_jwt(user_id)
-            if user:
-                print(f"DEBUG: Found user via JWT: {getattr(user, 'name', 'Unknown')} (ID: {user.id})")
-            return user
-            
-        except (InvalidToken, TokenError, jwt.ExpiredSignatureError, jwt.DecodeError) as e:
-            print(f"JWT Authentication failed: {str(e)}")
-            return None
-    
-    @database_sync_to_async
-    def get_user_by_id_jwt(self, user_id):
-        try:
-            executive = Executive.objects.get(id=user_id)
-            print(f"DEBUG: Found executive via JWT: {executive.name} ({executive.executive_id})")
-            return executive
-        except Executive.DoesNotExist:
-            try:
-                user_profile = UserProfile.objects.get(id=user_id)
-                print(f"DEBUG: Found UserProfile via JWT: {getattr(user_profile, 'name', 'Unknown User')}")
-                return user_profile
-            except UserProfile.DoesNotExist:
-                return None
-
-
-class CustomTokenAuthMixin:    
-    async def authenticate_token(self, token):
-        try:
-            token_obj = await self.get_token_by_refresh_token(token)
-            if not token_obj:
-                print(f"DEBUG: Token not found in database: {token[:10]}...")
-                return None
-            
-            if hasattr(token_obj, 'expires_at') and token_obj.expires_at:
-                if token_obj.expires_at < timezone.now():
-                    print(f"DEBUG: Token expired at {token_obj.expires_at}")
-                    return None
-            
-            executive = token_obj.executive
-            if executive:
-                print(f"DEBUG: Found executive: {executive.name} (ID: {executive.id}, Exec ID: {executive.executive_id})")
-            return executive
-            
-        except Exception as e:
-            print(f"Custom Token Authentication failed: {str(e)}")
-            return None
-    
-    @database_sync_to_async
-    def get_token_by_refresh_token(self, token):
-        try:
-            return ExecutiveToken.objects.select_related('executive').get(refresh_token=token)
-        except ExecutiveToken.DoesNotExist:
-            return None
-    
-    @database_sync_to_async
-    def get_user_by_id(self, user_id):
-        try:
-            executive = Executive.objects.get(id=user_id)
-            print(f"DEBUG: Found executive: {executive.name} ({executive.executive_id})")
-            return executive
-        except Executive.DoesNotExist:
-            try:
-                return UserProfile.objects.get(id=user_id)
-            except UserProfile.DoesNotExist:
-                return None
+from executives.flags import flags
+from executives.leases import take_offline
+from executives.presence import PRESENCE_GROUP, STATUSES, PresenceSubscription, broadcast_delta, presence
+from talkeasy.dbpool import consumer_db
+from talkeasy.middleware import authenticate_executive_token, authenticate_jwt, token_from_scope
+from talkeasy.wire import WireProtocolMixin, dumps, text_of
 
 
-class ExecutivesConsumer(AsyncWebsocketConsumer, CustomTokenAuthMixin):
+class ExecutivesConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
     async def connect(self):
-        headers = dict(self.scope.get('headers', []))
-        token = headers.get(b'x-executive-token', b'').decode()
-        
-        if not token:
-            query_string = self.scope.get('query_string', b'').decode()
-            query_params = parse_qs(query_string)
-            token = query_params.get('token', [None])[0]
+        token = token_from_scope(self.scope, b'x-executive-token')
         
         if not token:
             print("DEBUG: No token provided in headers or query params")
@@ -118,7 +26,7 @@ class ExecutivesConsumer(AsyncWebsocketConsumer, CustomTokenAuthMixin):
             return
         
         # Authenticate user with custom token
-        authenticated_user = await self.authenticate_token(token)
+        authenticated_user = await authenticate_executive_token(token)
         if not authenticated_user:
             print("DEBUG: Authentication failed")
             # Send error message before closing
@@ -147,7 +55,8 @@ class ExecutivesConsumer(AsyncWebsocketConsumer, CustomTokenAuthMixin):
         
         # Use the authenticated user's executive_id
         self.executive_id = str(self.user.executive_id)
-        self.users_group_name = "users_online"
+        self.users_group_name = PRESENCE_GROUP
+        self.language_ids = await self.get_language_ids()
         
         print(f"DEBUG: Executive {self.user.name} ({self.executive_id}) connecting...")
         
@@ -155,11 +64,8 @@ class ExecutivesConsumer(AsyncWebsocketConsumer, CustomTokenAuthMixin):
         
         await self.channel_layer.group_add(self.users_group_name, self.channel_name)
         
-        EXECUTIVE_STATUS[self.executive_id] = "online"
-        
-        await self.update_executive_status("online")
-        
-        await self.broadcast_status()
+        await self.set_status("online")
+        self.lease_task = asyncio.ensure_future(self.renew_lease())
         
         await self.send(text_data=json.dumps({
             "type": "connection_established",
@@ -177,9 +83,9 @@ class ExecutivesConsumer(AsyncWebsocketConsumer, CustomTokenAuthMixin):
     async def disconnect(self, close_code):
         if hasattr(self, "executive_id") and hasattr(self, "user"):
             print(f"DEBUG: Executive {self.user.name} ({self.executive_id}) disconnecting...")
-            EXECUTIVE_STATUS[self.executive_id] = "offline"
-            await self.update_executive_status("offline")
-            await self.broadcast_status()
+            if getattr(self, "lease_task", None):
+                self.lease_task.cancel()
+            await self.set_status("offline")
         
         if hasattr(self, "users_group_name") and hasattr(self, "channel_name"):
             await self.channel_layer.group_discard(self.users_group_name, self.channel_name)
@@ -192,112 +98,91 @@ class ExecutivesConsumer(AsyncWebsocketConsumer, CustomTokenAuthMixin):
             if "status" in data:
                 new_status = data["status"]
                 
-                valid_statuses = ["online", "offline", "oncall"]
+                valid_statuses = list(STATUSES)
                 if new_status not in valid_statuses:
                     await self.send(text_data=json.dumps({
                         "error": f"Invalid status. Valid options: {valid_statuses}"
                     }))
                     return
                 
-                EXECUTIVE_STATUS[self.executive_id] = new_status
-                await self.update_executive_status(new_status)
-                await self.broadcast_status()
+                await self.set_status(new_status)
                 
             elif "connect" in data:
-                status = "online" if data["connect"] else "offline"
-                EXECUTIVE_STATUS[self.executive_id] = status
-                await self.update_executive_status(status)
-                await self.broadcast_status()
+                await self.set_status("online" if data["connect"] else "offline")
                 
             elif "oncall" in data:
-                status = "oncall" if data["oncall"] else "online"
-                EXECUTIVE_STATUS[self.executive_id] = status
-                await self.update_executive_status(status)
-                await self.broadcast_status()
+                await self.set_status("oncall" if data["oncall"] else "online")
             
+            current_status = await sync_to_async(presence.status, thread_sensitive=False)(self.executive_id)
             await self.send(text_data=json.dumps({
                 "type": "ack",
                 "executive_id": self.executive_id,
-                "status": EXECUTIVE_STATUS[self.executive_id],
-                "message": f"Status updated to {EXECUTIVE_STATUS[self.executive_id]}"
+                "status": current_status,
+                "message": f"Status updated to {current_status}"
             }))
             
         except Exception as e:
             print(f"DEBUG: Error in receive: {str(e)}")
             await self.send(text_data=json.dumps({"error": str(e)}))
 
-    @database_sync_to_async
-    def update_executive_status(self, status):
-        try:
-            self.user.is_online = status == "online"
-            self.user.on_call = status == "oncall"
-            self.user.save(update_fields=['is_online', 'on_call'])
-            print(f"DEBUG: Updated {self.user.name} status in database: {status}")
-        except Exception as e:
-            print(f"DEBUG: Error updating database: {str(e)}")
+    @consumer_db
+    def get_language_ids(self):
+        return list(self.user.languages_known.values_list("id", flat=True))
 
-    async def broadcast_status(self):
+    async def set_status(self, status):
+        """Record the status and queue a presence_delta if it changed."""
+        self.status = status
+        delta = await self.record_presence()
         try:
-            executive_data = await self.get_executives_detailed_status()
-            
-            print(f"DEBUG: Broadcasting status update: {len(executive_data)} executives")
-            
-            await self.channel_layer.group_send(
-                self.users_group_name,
-                {
-                    "type": "status_update",
-                    "data": executive_data
-                }
-            )
+            if status == "offline":
+                await take_offline(self.channel_layer, [self.executive_id], [delta] if delta else [])
+                return
+            flags.record(self.executive_id, status)
+            await broadcast_delta(self.channel_layer, delta)
         except Exception as e:
-            print(f"DEBUG: Error in broadcast_status: {str(e)}")
+            print(f"DEBUG: Error broadcasting presence: {str(e)}")
+
+    async def record_presence(self):
+        return await sync_to_async(presence.set_status, thread_sensitive=False)(
+            self.executive_id, self.user.name, self.status,
+            gender=self.user.gender, languages=self.language_ids
+        )
 
-    @database_sync_to_async
-    def get_executives_detailed_status(self):
-        executive_data = []
-        for exec_id, status in EXECUTIVE_STATUS.items():
+    async def renew_lease(self):
+        """Keep this socket's presence lease alive for as long as it is open."""
+        interval = presence.lease_ttl() / 3
+        while True:
+            await asyncio.sleep(interval)
+            if self.status == "offline":
+                continue
             try:
-                executive = Executive.objects.get(executive_id=exec_id)
-                executive_data.append({
-                    "executive_id": exec_id,
-                    "name": executive.name,
-                    "status": status,
-                    "is_available": status in ["online", "oncall"]
-                })
-                print(f"DEBUG: Added {executive.name} to status list")
-            except Executive.DoesNotExist:
-                print(f"DEBUG: Executive with ID {exec_id} not found in database")
-                # If executive not found, include basic info
-                executive_data.append({
-                    "executive_id": exec_id,
-                    "name": "Unknown Executive",
-                    "status": status,
-                    "is_available": False
-                })
-        return executive_data
+                delta = await self.record_presence()
+                if delta:
+                    # The lease had lapsed and been swept; restore the flags
+                    flags.record(self.executive_id, self.status)
+                    await broadcast_delta(self.channel_layer, delta)
+            except Exception as e:
+                print(f"DEBUG: Error renewing presence lease: {str(e)}")
 
-    async def status_update(self, event):
+    async def presence_delta(self, event):
         try:
-            await self.send(text_data=json.dumps({
-                "type": "executive_status_list",
-                "data": event["data"]
+            await self.send(text_data=text_of(event, {
+                "type": "presence_delta",
+                "from_version": event["from_version"],
+                "version": event["version"],
+                "data": event["executives"]
             }))
         except Exception:
             pass
 
 
-class UsersConsumer(AsyncWebsocketConsumer, JWTAuthMixin):
-    
+class UsersConsumer(WireProtocolMixin, AsyncWebsocketConsumer):
+    presence_version = 0
+    subscription = None  # PresenceSubscription when the user filters presence
+
     async def connect(self):
         # Extract token from headers first, fallback to query parameters
-        headers = dict(self.scope.get('headers', []))
-        token = headers.get(b'authorization', b'').decode().replace('Bearer ', '')
-        
-        # Fallback to query parameters if no header token
-        if not token:
-            query_string = self.scope.get('query_string', b'').decode()
-            query_params = parse_qs(query_string)
-            token = query_params.get('token', [None])[0]
+        token = token_from_scope(self.scope, b'authorization')
         
         if not token:
             print("DEBUG: No JWT token provided in headers or query params")
@@ -305,56 +190,123 @@ class UsersConsumer(AsyncWebsocketConsumer, JWTAuthMixin):
             return
         
         # Authenticate user with JWT
-        authenticated_user = await self.authenticate_jwt(token)
+        authenticated_user = await authenticate_jwt(token, (Executive, UserProfile))
         if not authenticated_user:
             print("DEBUG: JWT authentication failed")
             await self.close(code=4001)
             return
         
         self.user = authenticated_user
-        self.group_name = "users_online"
         
         await self.accept()
-        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.join_presence_group(PRESENCE_GROUP)
+        self.presence_groups = {PRESENCE_GROUP}
         
-        executive_data = await self.get_executives_detailed_status()
-        await self.send(text_data=json.dumps({
-            "type": "executive_status_list",
-            "data": executive_data,
-            "user_info": {
-                "user_id": getattr(self.user, 'user_id', None) or getattr(self.user, 'executive_id', None),
-                "name": getattr(self.user, 'name', 'Unknown'),
-                "user_type": "executive" if isinstance(self.user, Executive) else "user"
-            }
-        }))
+        await self.send_snapshot(user_info={
+            "user_id": getattr(self.user, 'user_id', None) or getattr(self.user, 'executive_id', None),
+            "name": getattr(self.user, 'name', 'Unknown'),
+            "user_type": "executive" if isinstance(self.user, Executive) else "user"
+        })
 
     async def disconnect(self, close_code):
-        if hasattr(self, 'group_name') and hasattr(self, 'channel_name'):
-            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if hasattr(self, 'channel_name'):
+            for group in getattr(self, 'presence_groups', ()):
+                await self.leave_presence_group(group)
 
-    @database_sync_to_async
-    def get_executives_detailed_status(self):
-        executive_data = []
-        for exec_id, status in EXECUTIVE_STATUS.items():
-            try:
-                executive = Executive.objects.get(executive_id=exec_id)
-                executive_data.append({
-                    "executive_id": exec_id,
-                    "name": executive.name,
-                    "status": status,
-                    "is_available": status in ["online", "oncall"]
-                })
-            except Executive.DoesNotExist:
-                executive_data.append({
-                    "executive_id": exec_id,
-                    "name": "Unknown Executive",
-                    "status": status,
-                    "is_available": False
-                })
-        return executive_data
+    async def receive(self, text_data):
+        try:
+            data = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        if data.get("type") == "resync":
+            await self.send_snapshot()
+        elif data.get("type") == "subscribe":
+            await self.subscribe(data.get("languages") or [], data.get("genders") or [])
+
+    async def subscribe(self, languages, genders):
+        try:
+            subscription = PresenceSubscription(languages, genders)
+        except (TypeError, ValueError):
+            await self.send(text_data=json.dumps({"error": "languages must be a list of language ids"}))
+            return
+
+        groups = subscription.groups()
+        for group in self.presence_groups - groups:
+            await self.leave_presence_group(group)
+        for group in groups - self.presence_groups:
+            await self.join_presence_group(group)
+        self.presence_groups = groups
+        self.subscription = subscription or None
+        self.shard_versions = {}
+        await self.send_snapshot()
+
+    async def join_presence_group(self, group):
+        await self.channel_layer.group_add(group, self.channel_name)
+        if group == PRESENCE_GROUP:
+            presence.cache.watch()
 
-    async def status_update(self, event):
+    async def leave_presence_group(self, group):
+        await self.channel_layer.group_discard(group, self.channel_name)
+        if group == PRESENCE_GROUP:
+            presence.cache.unwatch()
+
+    async def send_snapshot(self, **extra):
+        if self.subscription is not None:
+            await self.send_filtered_snapshot(**extra)
+            return
+        if not presence.cache.loaded:
+            await sync_to_async(presence.refresh, thread_sensitive=False)()
+        self.presence_version, message = presence.cache.message(**extra)
+        await self.send(text_data=message)
+
+    async def presence_delta(self, event):
+        from_version, version = event["from_version"], event["version"]
+        if self.subscription is not None or version <= self.presence_version:
+            # Already part of the snapshot this socket was sent
+            return
+        # Keep the process-wide copy current; it reloads itself on a gap
+        if not presence.cache.apply(from_version, version, event["executives"]):
+            await sync_to_async(presence.refresh, thread_sensitive=False)()
+        if from_version != self.presence_version + 1:
+            await self.send_snapshot()
+            return
+        self.presence_version = version
+        await self.send(text_data=text_of(event, {
+            "type": "presence_delta",
+            "from_version": from_version,
+            "version": version,
+            "data": event["executives"]
+        }))
+
+    async def send_filtered_snapshot(self, **extra):
+        # Shard feeds do not advance this process's copy, so read the store
+        await sync_to_async(presence.refresh, thread_sensitive=False)()
+        version, entries = presence.cache.entries()
+        self.presence_version = version
         await self.send(text_data=json.dumps({
             "type": "executive_status_list",
-            "data": event["data"]
-        }))
\ No newline at end of file
+            "version": version,
+            "data": [entry for entry in entries if self.subscription.matches(entry)],
+            "subscription": self.subscription.as_dict(),
+            **extra
+        }))
+
+    async def presence_shard_delta(self, event):
+        if self.subscription is None:
+            return
+        version = event["version"]
+        # An executive in several of this socket's shards arrives once per shard
+        entries = [
+            entry for entry in event["executives"]
+            if self.subscription.matches(entry)
+            and self.shard_versions.get(entry["executive_id"], self.presence_version) < version
+        ]
+        if not entries:
+            return
+        for entry in entries:
+            self.shard_versions[entry["executive_id"]] = version
+        message = {"type": "presence_delta", "from_version": None, "version": version, "data": entries}
+        # The pre-encoded text only fits when nothing was filtered out
+        await self.send(text_data=text_of(event, message) if len(entries) == len(event["executives"]) else dumps(message))
@@ -0,0 +1,94 @@
+# executives/flags.py
+"""
+Write-behind persistence of ``Executive.is_online`` / ``on_call``.
+
+The presence registry is the source of truth for whether an executive is
+online; the database columns are a copy for REST views and admin. Status
+changes only record the new flags here, and the ``executive-flags``
+service writes them every ``EXECUTIVE_FLAG_FLUSH_SECONDS`` (and once
+more on shutdown) with at most one UPDATE per column value, however many
+executives changed.
+
+``on_call`` is also the lock taken by ``calls.initiation.claim_executive``
+and released by settlement, so clearing it here skips executives with an
+active call rather than releasing a claim made since the status change.
+"""
+import threading
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from calls.utils import chunked
+from executives.models import Executive
+from talkeasy.services import run_periodic
+
+# Presence status -> (is_online, on_call)
+STATUS_FLAGS = {
+    "online": (True, False),
+    "oncall": (False, True),
+    "offline": (False, False),
+}
+
+
+class ExecutiveFlagBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # executive_id -> (is_online, on_call)
+
+    def record(self, executive_id, status):
+        with self._lock:
+            self._pending[executive_id] = STATUS_FLAGS[status]
+
+    def record_many(self, executive_ids, status):
+        with self._lock:
+            for executive_id in executive_ids:
+                self._pending[executive_id] = STATUS_FLAGS[status]
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write pending flags; returns how many executives were updated."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        online = {True: [], False: []}
+        on_call = {True: [], False: []}
+        for executive_id, (is_online, is_on_call) in pending.items():
+            online[is_online].append(executive_id)
+            on_call[is_on_call].append(executive_id)
+        try:
+            for value, executive_ids in online.items():
+                for chunk in chunked(executive_ids):
+                    Executive.objects.filter(executive_id__in=chunk).update(is_online=value)
+            for chunk in chunked(on_call[True]):
+                Executive.objects.filter(executive_id__in=chunk).update(on_call=True)
+            if on_call[False]:
+                from calls.models import AgoraCallHistory
+
+                in_call = AgoraCallHistory.objects.filter(executive=OuterRef("pk"), is_active=True)
+                for chunk in chunked(on_call[False]):
+                    Executive.objects.filter(executive_id__in=chunk, on_call=True).exclude(
+                        Exists(in_call)
+                    ).update(on_call=False)
+        except Exception:
+            # Put the batch back unless a newer status arrived meanwhile
+            with self._lock:
+                for executive_id, flags in pending.items():
+                    self._pending.setdefault(executive_id, flags)
+            raise
+        return len(pending)
+
+
+flags = ExecutiveFlagBuffer()
+
+
+async def run():
+    try:
+        await run_periodic(
+            getattr(settings, "EXECUTIVE_FLAG_FLUSH_SECONDS", 3),
+            database_sync_to_async(flags.flush),
+        )
+    finally:
+        await database_sync_to_async(flags.flush)()
@@ -0,0 +1,39 @@
+# executives/leases.py
+"""
+Expiry of executive presence leases.
+
+An online or on-call executive's presence entry is a lease of
+``EXECUTIVE_PRESENCE_LEASE_SECONDS`` that their socket renews while it
+is open. If the worker holding the socket dies, or the connection drops
+without a close, renewals stop. Every ``EXECUTIVE_PRESENCE_SWEEP_SECONDS``
+the ``presence-leases`` service then takes lapsed executives offline.
+
+Expired leases and disconnects share one offline path: the flags go to
+the write-behind buffer (one UPDATE per flush for the whole batch) and
+the deltas to one coalesced presence broadcast. Finding expired leases
+is a range read on the presence store, never a scan of the Executive
+table.
+"""
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from executives.flags import flags
+from executives.presence import broadcast_delta, presence
+from talkeasy.services import run_periodic
+
+
+async def take_offline(channel_layer, executive_ids, deltas):
+    flags.record_many(executive_ids, "offline")
+    for delta in deltas:
+        await broadcast_delta(channel_layer, delta)
+
+
+async def sweep_once():
+    deltas = await sync_to_async(presence.expire_leases, thread_sensitive=False)()
+    if deltas:
+        executive_ids = [delta["executive"]["executive_id"] for delta in deltas]
+        await take_offline(get_channel_layer(), executive_ids, deltas)
+
+
+async def run():
+    await run_periodic(getattr(settings, "EXECUTIVE_PRESENCE_SWEEP_SECONDS", 10), sweep_once)
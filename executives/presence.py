@@ -0,0 +1,315 @@
+# executives/presence.py
+"""
+Executive presence shown to users.
+
+The registry holds one entry per executive that has connected and a
+version number that goes up by one on every change. Sockets load a
+snapshot (``executive_status_list`` with its ``version``) when they
+connect, then receive ``presence_delta`` events carrying only the
+executives that changed.
+
+Changes are not sent one by one: they are collected for
+``EXECUTIVE_PRESENCE_COALESCE_MS`` and sent as one ``presence_delta``
+holding the latest entry of each executive that changed, covering
+versions ``from_version`` to ``version``. A delta that does not start
+right after the last version a socket has seen means it missed
+something; the socket is sent a fresh snapshot instead. Clients can
+also ask for one with ``{"type": "resync"}``.
+
+Users only interested in some executives can send
+``{"type": "subscribe", "languages": [<Language id>, ...], "genders": [...]}``
+(both empty to see everyone again). The socket then leaves the shared
+group for shard groups keyed on language and gender, gets a filtered
+snapshot, and from then on only deltas for executives it can see. A
+filtered feed skips versions by design, so its deltas carry
+``from_version: null`` and are not gap-checked.
+
+Entries and the version live in the store configured by
+``EXECUTIVE_PRESENCE_STORE`` (see presence_store.py), so every worker
+serves the same list. Each process also keeps its own copy, already
+serialized as the ``executive_status_list`` message and advanced by the
+deltas it sees, so a socket connecting costs no store or database reads
+and a single send. The copy is reloaded from the store when it notices a
+version gap, and dropped when the last socket in the shared group leaves
+(no deltas reach the process after that); the next socket to connect
+loads it again.
+"""
+import asyncio
+import re
+import threading
+from collections import defaultdict
+from django.conf import settings
+from executives.presence_store import store_from_url
+from talkeasy.wire import dumps
+
+PRESENCE_GROUP = "users_online"
+STATUSES = ("online", "offline", "oncall")
+
+
+def normalize_gender(gender):
+    # Group names only allow a restricted character set
+    return re.sub(r"[^a-z0-9]", "", str(gender).lower()) or "unspecified"
+
+
+def presence_entry(executive_id, name, status, gender="unspecified", languages=()):
+    return {
+        "executive_id": executive_id,
+        "name": name,
+        "status": status,
+        "is_available": status in ("online", "oncall"),
+        "gender": normalize_gender(gender),
+        "languages": sorted(languages),
+    }
+
+
+def shard_groups(entry):
+    """Every shard group an executive's presence is published to."""
+    gender = entry["gender"]
+    groups = {f"presence_gender_{gender}"}
+    for language in entry["languages"]:
+        groups.add(f"presence_lang_{language}")
+        groups.add(f"presence_{language}_{gender}")
+    return groups
+
+
+class PresenceSubscription:
+    """The executives a user's socket wants presence for."""
+
+    def __init__(self, languages=(), genders=()):
+        self.languages = frozenset(int(language) for language in languages)
+        self.genders = frozenset(normalize_gender(gender) for gender in genders)
+
+    def __bool__(self):
+        return bool(self.languages or self.genders)
+
+    def groups(self):
+        if self.languages and self.genders:
+            return {f"presence_{language}_{gender}" for language in self.languages for gender in self.genders}
+        if self.languages:
+            return {f"presence_lang_{language}" for language in self.languages}
+        if self.genders:
+            return {f"presence_gender_{gender}" for gender in self.genders}
+        return {PRESENCE_GROUP}
+
+    def matches(self, entry):
+        if self.languages and self.languages.isdisjoint(entry["languages"]):
+            return False
+        return not self.genders or entry["gender"] in self.genders
+
+    def as_dict(self):
+        return {"languages": sorted(self.languages), "genders": sorted(self.genders)}
+
+
+class PresenceSnapshot:
+    """This process's copy of the presence list, kept serialized."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._data = None  # the encoded entry list
+        self.version = 0
+        self.loaded = False
+        self.watchers = 0  # sockets in this process receiving the shared deltas
+
+    def apply(self, from_version, version, entries):
+        """Apply a delta; returns False if it does not follow on from this copy."""
+        with self._lock:
+            if self.loaded and version <= self.version:
+                return True
+            if not self.loaded or from_version != self.version + 1:
+                return False
+            for entry in entries:
+                self._entries[entry["executive_id"]] = entry
+            self.version = version
+            self._data = None
+            return True
+
+    def entries(self):
+        with self._lock:
+            return self.version, list(self._entries.values())
+
+    def load(self, version, entries):
+        with self._lock:
+            if self.loaded and version < self.version:
+                return
+            self._entries = {entry["executive_id"]: entry for entry in entries}
+            self.version = version
+            self.loaded = True
+            self._data = None
+
+    def watch(self):
+        with self._lock:
+            self.watchers += 1
+
+    def unwatch(self):
+        with self._lock:
+            self.watchers -= 1
+            if not self.watchers:
+                # Nothing keeps the copy current any more
+                self.loaded = False
+                self._data = None
+
+    def message(self, **extra):
+        """``(version, text)`` of the executive_status_list message, plus any ``extra`` fields."""
+        with self._lock:
+            if self._data is None:
+                self._data = dumps(list(self._entries.values()))
+            version, data = self.version, self._data
+        # The entry list is encoded once per version and placed into each envelope
+        envelope = dumps({**extra, "type": "executive_status_list", "version": version})
+        return version, f'{envelope[:-1]},"data":{data}}}'
+
+
+class PresenceRegistry:
+    """Presence protocol on top of a ``PresenceStore`` shared by all workers."""
+
+    def __init__(self, store, ttl=None):
+        self.store = store
+        self.ttl = ttl
+        self.cache = PresenceSnapshot()
+
+    def entry_ttl(self):
+        return self.ttl or getattr(settings, "EXECUTIVE_PRESENCE_TTL_SECONDS", 86400)
+
+    def lease_ttl(self):
+        return getattr(settings, "EXECUTIVE_PRESENCE_LEASE_SECONDS", 60)
+
+    def set_status(self, executive_id, name, status, gender="unspecified", languages=()):
+        """
+        Record ``status``; returns the delta to broadcast, or None if
+        nothing changed. Online and on-call entries are leases that the
+        executive's socket renews by setting the same status again.
+        """
+        entry = presence_entry(executive_id, name, status, gender, languages)
+        ttl = self.entry_ttl() if status == "offline" else self.lease_ttl()
+        version = self.store.put(executive_id, entry, ttl)
+        if version is None:
+            return None
+        self._observe(version, entry)
+        return {"version": version, "executive": entry}
+
+    def expire_leases(self, now=None):
+        """Turn executives whose lease lapsed offline; returns their deltas."""
+        def offline(entry):
+            if entry["status"] == "offline":
+                return None
+            return {**entry, "status": "offline", "is_available": False}
+
+        replaced = self.store.expire(offline, self.entry_ttl(), now)
+        for version, entry in replaced:
+            self._observe(version, entry)
+        return [{"version": version, "executive": entry} for version, entry in replaced]
+
+    def _observe(self, version, entry):
+        # An unloaded copy is left for the next socket that needs it
+        if self.cache.loaded and not self.cache.apply(version, version, [entry]):
+            self.refresh()
+
+    def status(self, executive_id):
+        entry = self.store.get(executive_id)
+        return entry["status"] if entry else "offline"
+
+    def snapshot(self):
+        """``(version, entries)`` as one consistent view."""
+        return self.store.snapshot()
+
+    def refresh(self):
+        """Reload this process's copy from the store."""
+        self.cache.load(*self.store.snapshot())
+
+
+presence = PresenceRegistry(store_from_url(getattr(settings, "EXECUTIVE_PRESENCE_STORE", "memory://")))
+
+
+def coalesce_window():
+    return getattr(settings, "EXECUTIVE_PRESENCE_COALESCE_MS", 150) / 1000
+
+
+def delta_text(from_version, version, entries):
+    """The ``presence_delta`` client message, encoded once for every socket in a group."""
+    return dumps({"type": "presence_delta", "from_version": from_version, "version": version, "data": entries})
+
+
+class PresenceBroadcaster:
+    """
+    Merges the presence changes made in this process during one window
+    into a single group_send to the shared group and one to each shard
+    group with changes in it. Each event carries its client message
+    already encoded as ``text``, so receiving sockets forward it as is.
+
+    ``stats`` counts deltas ``received``, deltas ``coalesced`` away because
+    the same executive changed again within the window, and messages
+    ``emitted`` to groups.
+    """
+
+    def __init__(self, window=None):
+        self.window = window
+        self._pending = {}  # executive_id -> latest entry in this window
+        self._versions = []
+        self._flush_task = None
+        self.stats = {"received": 0, "coalesced": 0, "emitted": 0}
+
+    async def queue(self, channel_layer, delta):
+        if delta is None:
+            return
+        entry = delta["executive"]
+        self.stats["received"] += 1
+        if entry["executive_id"] in self._pending:
+            self.stats["coalesced"] += 1
+        self._pending[entry["executive_id"]] = entry
+        self._versions.append(delta["version"])
+
+        window = coalesce_window() if self.window is None else self.window
+        if window <= 0:
+            await self.flush(channel_layer)
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later(channel_layer, window))
+
+    async def _flush_later(self, channel_layer, window):
+        try:
+            await asyncio.sleep(window)
+        finally:
+            self._flush_task = None
+        try:
+            await self.flush(channel_layer)
+        except Exception as e:
+            print(f"Presence broadcast failed: {e}")
+
+    async def flush(self, channel_layer):
+        if not self._pending:
+            return
+        entries, versions = list(self._pending.values()), sorted(self._versions)
+        self._pending, self._versions = {}, []
+        # Other workers may have taken versions in between; such a batch
+        # cannot be applied incrementally and receivers resync instead
+        contiguous = versions[-1] - versions[0] + 1 == len(versions)
+        from_version = versions[0] if contiguous else None
+        sends = [channel_layer.group_send(PRESENCE_GROUP, {
+            "type": "presence_delta",
+            "from_version": from_version,
+            "version": versions[-1],
+            "executives": entries,
+            "text": delta_text(from_version, versions[-1], entries),
+        })]
+
+        by_shard = defaultdict(list)
+        for entry in entries:
+            for group in shard_groups(entry):
+                by_shard[group].append(entry)
+        for group, shard_entries in by_shard.items():
+            sends.append(channel_layer.group_send(group, {
+                "type": "presence_shard_delta",
+                "version": versions[-1],
+                "executives": shard_entries,
+                "text": delta_text(None, versions[-1], shard_entries),
+            }))
+
+        self.stats["emitted"] += len(sends)
+        await asyncio.gather(*sends)
+
+
+broadcaster = PresenceBroadcaster()
+
+
+async def broadcast_delta(channel_layer, delta):
+    await broadcaster.queue(channel_layer, delta)
@@ -0,0 +1,410 @@
+# executives/presence_store.py
+"""
+Storage for executive presence, shared between ASGI workers.
+
+A store maps a key (the executive_id) to a JSON-serializable entry with
+a time-to-live, and keeps one version number that goes up whenever an
+entry changes. ``put`` is an atomic compare-and-set: writing the entry a
+key already holds only extends its TTL and returns None, otherwise the
+entry is replaced and the new version returned. Expired entries read as
+missing, so presence left behind by a dead worker ages out on its own.
+``expire`` hands expired entries to a callback that may replace them
+(taking a new version each) or drop them, atomically, so when several
+workers sweep at once each expiry is handled exactly once.
+
+Backends are picked with ``EXECUTIVE_PRESENCE_STORE``:
+
+* ``memory://`` - a dict in this process (development, single worker)
+* ``sqlite:///path/to/presence.db`` - a file shared by the workers on one host
+* ``redis://host:6379/0`` - any server speaking the Redis protocol
+
+The SQLite and Redis stores open a connection per thread that uses
+them; ``close()`` closes all of them and is called on shutdown.
+"""
+import abc
+import json
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import unquote, urlsplit
+
+
+def encode(entry):
+    return json.dumps(entry, sort_keys=True, separators=(",", ":"))
+
+
+class PresenceStore(abc.ABC):
+    @abc.abstractmethod
+    def put(self, key, entry, ttl, now=None):
+        """Store ``entry`` for ``ttl`` seconds; returns the new version, or None if unchanged."""
+
+    @abc.abstractmethod
+    def get(self, key, now=None):
+        pass
+
+    @abc.abstractmethod
+    def snapshot(self, now=None):
+        """``(version, entries)`` for all live entries, read atomically."""
+
+    @abc.abstractmethod
+    def expire(self, replace, ttl, now=None):
+        """
+        Replace each expired entry with ``replace(entry)`` for ``ttl``
+        seconds, or drop it when that returns None. Returns
+        ``[(version, new_entry), ...]`` for the replaced ones.
+        """
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+    def close(self):
+        """Release connections; the store reconnects if used again."""
+
+
+class ThreadConnections:
+    """One connection per thread, all of which can be closed from any thread."""
+
+    def __init__(self, connect):
+        self.connect = connect
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = []
+
+    def get(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self.connect()
+            with self._lock:
+                self._opened.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            opened, self._opened = self._opened, []
+            self._local = threading.local()
+        for conn in opened:
+            try:
+                conn.close()
+            except Exception as e:
+                print(f"Closing presence store connection failed: {e}")
+
+
+class MemoryPresenceStore(PresenceStore):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (entry, expires_at)
+        self._version = 0
+
+    def put(self, key, entry, ttl, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            current = self._entries.get(key)
+            self._entries[key] = (entry, now + ttl)
+            if current and current[1] > now and current[0] == entry:
+                return None
+            self._version += 1
+            return self._version
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        current = self._entries.get(key)
+        return current[0] if current and current[1] > now else None
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            return self._version, [entry for entry, expires_at in self._entries.values() if expires_at > now]
+
+    def expire(self, replace, ttl, now=None):
+        now = time.time() if now is None else now
+        replaced = []
+        with self._lock:
+            for key, (entry, expires_at) in list(self._entries.items()):
+                if expires_at > now:
+                    continue
+                replacement = replace(entry)
+                if replacement is None:
+                    del self._entries[key]
+                    continue
+                self._entries[key] = (replacement, now + ttl)
+                self._version += 1
+                replaced.append((self._version, replacement))
+        return replaced
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLitePresenceStore(PresenceStore):
+    def __init__(self, path):
+        self.path = path
+        self._connections = ThreadConnections(self._connect)
+
+    def _connect(self):
+        # Only its own thread queries it, but close() may run on another
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS presence "
+            "(key TEXT PRIMARY KEY, entry TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS presence_expires_at ON presence (expires_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS presence_version "
+            "(id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)"
+        )
+        conn.execute("INSERT OR IGNORE INTO presence_version VALUES (0, 0)")
+        return conn
+
+    def _connection(self):
+        return self._connections.get()
+
+    def close(self):
+        self._connections.close()
+
+    @contextmanager
+    def _transaction(self, mode="IMMEDIATE"):
+        conn = self._connection()
+        conn.execute(f"BEGIN {mode}")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def put(self, key, entry, ttl, now=None):
+        now = time.time() if now is None else now
+        encoded = encode(entry)
+        with self._transaction() as conn:
+            current = conn.execute("SELECT entry, expires_at FROM presence WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT INTO presence VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET entry = excluded.entry, expires_at = excluded.expires_at",
+                (key, encoded, now + ttl),
+            )
+            if current and current[1] > now and current[0] == encoded:
+                return None
+            conn.execute("UPDATE presence_version SET version = version + 1")
+            return conn.execute("SELECT version FROM presence_version").fetchone()[0]
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        row = self._connection().execute(
+            "SELECT entry FROM presence WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        with self._transaction("DEFERRED") as conn:
+            version = conn.execute("SELECT version FROM presence_version").fetchone()[0]
+            rows = conn.execute("SELECT entry FROM presence WHERE expires_at > ?", (now,)).fetchall()
+        return version, [json.loads(row[0]) for row in rows]
+
+    def expire(self, replace, ttl, now=None):
+        now = time.time() if now is None else now
+        replaced = []
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT key, entry FROM presence WHERE expires_at <= ?", (now,)).fetchall()
+            for key, encoded in rows:
+                replacement = replace(json.loads(encoded))
+                if replacement is None:
+                    conn.execute("DELETE FROM presence WHERE key = ?", (key,))
+                    continue
+                conn.execute(
+                    "UPDATE presence SET entry = ?, expires_at = ? WHERE key = ?",
+                    (encode(replacement), now + ttl, key),
+                )
+                conn.execute("UPDATE presence_version SET version = version + 1")
+                version = conn.execute("SELECT version FROM presence_version").fetchone()[0]
+                replaced.append((version, replacement))
+        return replaced
+
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM presence")
+
+
+class RespError(Exception):
+    pass
+
+
+class RespClient:
+    """Just enough of the Redis protocol (RESP2) for the presence store."""
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, timeout=5):
+        self.address = (host, port)
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._sock = None
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, timeout=self.timeout)
+        self._reader = self._sock.makefile("rb")
+        if self.password:
+            self.execute("AUTH", self.password)
+        if self.db:
+            self.execute("SELECT", self.db)
+
+    def close(self):
+        if self._sock is not None:
+            self._reader.close()
+            self._sock.close()
+            self._sock = None
+
+    def execute(self, *args):
+        if self._sock is None:
+            self._connect()
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        try:
+            self._sock.sendall(b"".join(parts))
+            reply = self._read()
+        except OSError:
+            self.close()
+            raise
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def _read(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by server")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode()
+        if kind == b"-":
+            return RespError(body.decode())
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [self._read() for _ in range(length)]
+        raise RespError(f"Unexpected reply: {line!r}")
+
+
+class RedisPresenceStore(PresenceStore):
+    """
+    Entries live in one hash and their expiry times in a sorted set, so
+    a snapshot is a single MULTI/EXEC. Writes are optimistic WATCH
+    transactions, retried if another worker touched presence meanwhile.
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0, password=None, prefix="presence"):
+        self.options = {"host": host, "port": port, "db": db, "password": password}
+        self.entries_key = f"{prefix}:entries"
+        self.expiry_key = f"{prefix}:expiry"
+        self.version_key = f"{prefix}:version"
+        self._connections = ThreadConnections(lambda: RespClient(**self.options))
+
+    def _client(self):
+        return self._connections.get()
+
+    def close(self):
+        self._connections.close()
+
+    def put(self, key, entry, ttl, now=None):
+        now = time.time() if now is None else now
+        encoded = encode(entry).encode()
+        client = self._client()
+        while True:
+            client.execute("WATCH", self.entries_key, self.expiry_key)
+            current = client.execute("HGET", self.entries_key, key)
+            expires_at = client.execute("ZSCORE", self.expiry_key, key)
+            changed = current != encoded or expires_at is None or float(expires_at) <= now
+            client.execute("MULTI")
+            client.execute("HSET", self.entries_key, key, encoded)
+            client.execute("ZADD", self.expiry_key, repr(now + ttl), key)
+            if changed:
+                client.execute("INCR", self.version_key)
+            result = client.execute("EXEC")
+            if result is not None:
+                return result[-1] if changed else None
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        client = self._client()
+        client.execute("MULTI")
+        client.execute("HGET", self.entries_key, key)
+        client.execute("ZSCORE", self.expiry_key, key)
+        current, expires_at = client.execute("EXEC")
+        if current is None or expires_at is None or float(expires_at) <= now:
+            return None
+        return json.loads(current)
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        client = self._client()
+        client.execute("MULTI")
+        client.execute("GET", self.version_key)
+        client.execute("HGETALL", self.entries_key)
+        client.execute("ZRANGEBYSCORE", self.expiry_key, f"({now!r}", "+inf")
+        version, flat, live = client.execute("EXEC")
+        live = set(live)
+        entries = dict(zip(flat[::2], flat[1::2]))
+        return int(version or 0), [json.loads(entries[key]) for key in live if key in entries]
+
+    def expire(self, replace, ttl, now=None):
+        now = time.time() if now is None else now
+        client = self._client()
+        while True:
+            client.execute("WATCH", self.entries_key, self.expiry_key)
+            keys = client.execute("ZRANGEBYSCORE", self.expiry_key, "-inf", repr(now))
+            if not keys:
+                client.execute("UNWATCH")
+                return []
+            current = client.execute("HMGET", self.entries_key, *keys)
+            commands, replacements = [], []  # replacements: (index of its INCR reply, entry)
+            for key, encoded in zip(keys, current):
+                replacement = replace(json.loads(encoded)) if encoded is not None else None
+                if replacement is None:
+                    commands += [("HDEL", self.entries_key, key), ("ZREM", self.expiry_key, key)]
+                    continue
+                commands += [
+                    ("HSET", self.entries_key, key, encode(replacement)),
+                    ("ZADD", self.expiry_key, repr(now + ttl), key),
+                    ("INCR", self.version_key),
+                ]
+                replacements.append((len(commands) - 1, replacement))
+            client.execute("MULTI")
+            for command in commands:
+                client.execute(*command)
+            result = client.execute("EXEC")
+            if result is not None:
+                return [(result[index], replacement) for index, replacement in replacements]
+
+    def clear(self):
+        self._client().execute("DEL", self.entries_key, self.expiry_key)
+
+
+def store_from_url(url):
+    parts = urlsplit(url)
+    if parts.scheme == "memory":
+        return MemoryPresenceStore()
+    if parts.scheme == "sqlite":
+        return SQLitePresenceStore(unquote(parts.path))
+    if parts.scheme == "redis":
+        return RedisPresenceStore(
+            host=parts.hostname or "localhost",
+            port=parts.port or 6379,
+            db=int(parts.path.strip("/") or 0),
+            password=unquote(parts.password) if parts.password else None,
+        )
+    raise ValueError(f"Unsupported presence store: {url}")
@@ -1,3 +1,730 @@
-from django.test import TestCase
+import json
+import os
+import socketserver
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import asyncio
+from asgiref.sync import async_to_sync
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from calls.models import AgoraCallHistory
+from executives import consumers, leases
+from executives.authentication import ExecutiveTokenAuthentication, ExecutiveTokenCache, token_cache
+from executives.flags import ExecutiveFlagBuffer
+from executives.models import Executive, ExecutiveToken
+from executives.consumers import UsersConsumer
+from executives.presence import (
+    PresenceBroadcaster, PresenceRegistry, PresenceSnapshot, PresenceSubscription, presence_entry, shard_groups,
+)
+from executives.presence_store import (
+    MemoryPresenceStore, PresenceStore, RedisPresenceStore, SQLitePresenceStore, store_from_url,
+)
+from talkeasy import middleware
+from users.blacklist import jti_blacklist
+from users.models import UserProfile
+from users.utils import create_tokens_for_userprofile
 
-# Create your tests here.
+
+class PresenceRegistryTests(SimpleTestCase):
+    def test_only_changes_produce_deltas(self):
+        registry = PresenceRegistry(MemoryPresenceStore())
+        delta = registry.set_status("EX1", "Asha", "online")
+        self.assertEqual(delta["version"], 1)
+        self.assertEqual(delta["executive"]["status"], "online")
+        self.assertIsNone(registry.set_status("EX1", "Asha", "online"))
+
+        registry.set_status("EX2", "Ravi", "oncall")
+        registry.set_status("EX1", "Asha", "offline")
+        version, entries = registry.snapshot()
+        self.assertEqual(version, 3)
+        self.assertEqual({e["executive_id"]: e["is_available"] for e in entries}, {"EX1": False, "EX2": True})
+        self.assertEqual(registry.status("EX3"), "offline")
+
+
+class PresenceLeaseTests(SimpleTestCase):
+    def test_lapsed_leases_go_offline_once(self):
+        registry = PresenceRegistry(MemoryPresenceStore())
+        registry.refresh()  # as loaded by a connected socket
+        registry.set_status("EX1", "Asha", "online")
+        registry.set_status("EX2", "Ravi", "offline")
+        lapsed = time.time() + registry.lease_ttl() + 1
+
+        deltas = registry.expire_leases(now=lapsed)
+        self.assertEqual([(d["version"], d["executive"]["executive_id"], d["executive"]["status"]) for d in deltas],
+                         [(3, "EX1", "offline")])
+        self.assertEqual(registry.expire_leases(now=lapsed), [])
+        self.assertEqual(registry.cache.version, 3)
+
+    def test_renewal_keeps_the_lease(self):
+        registry = PresenceRegistry(MemoryPresenceStore())
+        registry.set_status("EX1", "Asha", "online")
+        self.assertIsNone(registry.set_status("EX1", "Asha", "online"))
+        self.assertEqual(registry.expire_leases(now=time.time() + registry.lease_ttl() - 1), [])
+
+
+@override_settings(EXECUTIVE_PRESENCE_COALESCE_MS=0)
+class LeaseSweepTests(TransactionTestCase):
+    def test_sweep_takes_lapsed_executives_offline_in_bulk(self):
+        for i in range(3):
+            Executive.objects.create(
+                executive_id=f"EX{i}", mobile_number=f"800000000{i}", name=f"Exec {i}", is_online=True,
+            )
+        registry = PresenceRegistry(MemoryPresenceStore())
+        for i in range(2):
+            registry.store.put(f"EX{i}", presence_entry(f"EX{i}", f"Exec {i}", "online"), 60, now=time.time() - 120)
+        registry.set_status("EX2", "Exec 2", "online")
+        buffer = ExecutiveFlagBuffer()
+        for name, value in (("presence", registry), ("flags", buffer)):
+            self.addCleanup(setattr, leases, name, getattr(leases, name))
+            setattr(leases, name, value)
+
+        with self.assertNumQueries(0):
+            async_to_sync(leases.sweep_once)()
+        with self.assertNumQueries(2):
+            self.assertEqual(buffer.flush(), 2)
+
+        self.assertEqual(
+            dict(Executive.objects.values_list("executive_id", "is_online")),
+            {"EX0": False, "EX1": False, "EX2": True},
+        )
+        self.assertEqual(registry.status("EX0"), "offline")
+        self.assertEqual(registry.status("EX2"), "online")
+
+
+class ExecutiveFlagBufferTests(TestCase):
+    def setUp(self):
+        self.executives = [
+            Executive.objects.create(executive_id=f"EX{i}", mobile_number=f"800000000{i}", on_call=True)
+            for i in range(4)
+        ]
+
+    def test_flush_batches_by_value_and_keeps_only_the_latest(self):
+        buffer = ExecutiveFlagBuffer()
+        buffer.record("EX0", "oncall")
+        buffer.record("EX0", "online")
+        buffer.record("EX1", "online")
+        buffer.record_many(["EX2", "EX3"], "offline")
+
+        with self.assertNumQueries(3):
+            self.assertEqual(buffer.flush(), 4)
+        with self.assertNumQueries(0):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(
+            dict(Executive.objects.values_list("executive_id", "is_online")),
+            {"EX0": True, "EX1": True, "EX2": False, "EX3": False},
+        )
+        self.assertFalse(Executive.objects.filter(on_call=True).exists())
+
+    def test_clearing_on_call_spares_executives_in_a_call(self):
+        user = UserProfile.objects.create(mobile_number="9000000001")
+        AgoraCallHistory.objects.create(
+            user=user, executive=self.executives[0], channel_name="chan_1",
+            token="t", executive_token="t", uid=1, status="pending",
+        )
+        buffer = ExecutiveFlagBuffer()
+        buffer.record_many(["EX0", "EX1"], "online")
+        buffer.flush()
+        self.assertEqual(
+            dict(Executive.objects.filter(executive_id__in=["EX0", "EX1"]).values_list("executive_id", "on_call")),
+            {"EX0": True, "EX1": False},
+        )
+
+
+class WebSocketAuthTests(TestCase):
+    def setUp(self):
+        middleware.principals.clear()
+        self.addCleanup(middleware.principals.clear)
+        self.executive = Executive.objects.create(executive_id="EX1", mobile_number="8000000001")
+        self.token = ExecutiveToken.generate(self.executive)
+
+    def test_executive_reconnects_are_served_from_the_cache(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(middleware.resolve_executive_token(self.token.refresh_token), self.executive)
+        with self.assertNumQueries(0):
+            self.assertEqual(middleware.resolve_executive_token(self.token.refresh_token), self.executive)
+        self.assertIsNone(middleware.resolve_executive_token("unknown"))
+
+    def test_revocation_and_ban_evict_the_principal(self):
+        middleware.resolve_executive_token(self.token.refresh_token)
+        self.token.revoked = True
+        self.token.save()
+        self.assertIsNone(middleware.resolve_executive_token(self.token.refresh_token))
+
+        other = ExecutiveToken.generate(self.executive)
+        middleware.resolve_executive_token(other.refresh_token)
+        self.executive.is_banned = True
+        self.executive.save()
+        self.assertEqual(len(middleware.principals), 0)
+        self.assertIsNone(middleware.resolve_executive_token(other.refresh_token))
+
+    def test_user_jwt_is_cached_until_logout(self):
+        # UsersConsumer looks executives up first, and ids overlap between the tables
+        self.executive.delete()
+        user = UserProfile.objects.create(mobile_number="9000000001")
+        access = create_tokens_for_userprofile(user)["access"]
+        models = (Executive, UserProfile)
+        jti_blacklist.reset()
+        self.addCleanup(jti_blacklist.reset)
+        # Executive, then UserProfile, then loading the JTI blacklist
+        with self.assertNumQueries(3):
+            self.assertEqual(middleware.resolve_jwt(access, models), user)
+        with self.assertNumQueries(0):
+            self.assertEqual(middleware.resolve_jwt(access, models), user)
+        self.assertIsNone(middleware.resolve_jwt("not-a-jwt", models))
+
+        user.is_active = False
+        user.save(update_fields=["is_active"])
+        self.assertIsNone(middleware.resolve_jwt(access, models))
+
+    def test_cache_is_bounded_and_entries_expire(self):
+        cache = middleware.PrincipalCache(max_entries=2)
+        for key in ("a", "b", "c"):
+            cache.put(key, self.executive, expires_at=100)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("a", now=50))
+        self.assertEqual(cache.get("c", now=50), self.executive)
+        self.assertIsNone(cache.get("c", now=100))
+
+
+class ExecutiveTokenAuthenticationTests(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.addCleanup(token_cache.clear)
+        self.executive = Executive.objects.create(executive_id="EX1", mobile_number="8000000001")
+        self.token = ExecutiveToken.generate(self.executive)
+        self.request = RequestFactory().get("/", HTTP_X_EXECUTIVE_TOKEN=self.token.refresh_token)
+
+    def authenticate(self):
+        return ExecutiveTokenAuthentication().authenticate(self.request)
+
+    def test_repeat_requests_pass_is_authenticated_without_queries(self):
+        class PingView(APIView):
+            authentication_classes = [ExecutiveTokenAuthentication]
+            permission_classes = [IsAuthenticated]
+
+            def get(self, request):
+                executives.append(request.user)
+                return Response({"status": "ok"})
+
+        view, executives = PingView.as_view(), []
+        with self.assertNumQueries(1):
+            self.assertEqual(view(self.request).status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(view(self.request).status_code, 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(executives[-1].executive_id, "EX1")
+
+    def test_logout_revokes_the_cached_token(self):
+        self.authenticate()
+        response = self.client.post(
+            reverse("executive-logout", args=[self.executive.id]),
+            {"refresh_token": self.token.refresh_token},
+        )
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0), self.assertRaisesMessage(AuthenticationFailed, "Token revoked"):
+            self.authenticate()
+
+    def test_ban_invalidates_the_executive_tokens(self):
+        self.authenticate()
+        # Any save path, not just the status view, drops the cached tokens
+        self.executive.is_banned = True
+        self.executive.save(update_fields=["is_banned"])
+        with self.assertRaisesMessage(AuthenticationFailed, "Token revoked"):
+            self.authenticate()
+
+    def test_unknown_and_expired_tokens_are_rejected(self):
+        self.request = RequestFactory().get("/", HTTP_X_EXECUTIVE_TOKEN="unknown")
+        with self.assertRaisesMessage(AuthenticationFailed, "Invalid token"):
+            self.authenticate()
+        self.token.expires_at = timezone.now() - timedelta(seconds=1)
+        self.token.save()
+        self.request = RequestFactory().get("/", HTTP_X_EXECUTIVE_TOKEN=self.token.refresh_token)
+        with self.assertRaisesMessage(AuthenticationFailed, "Token expired"):
+            self.authenticate()
+
+    def test_cache_is_bounded(self):
+        cache = ExecutiveTokenCache(max_entries=2)
+        tokens = [ExecutiveToken.generate(self.executive).refresh_token for _ in range(3)]
+        for token in tokens:
+            cache.lookup(token)
+        self.assertEqual(len(cache), 2)
+        with self.assertNumQueries(1):
+            cache.lookup(tokens[0])
+
+
+class UsersConsumerPresenceTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = PresenceRegistry(MemoryPresenceStore())
+        self.registry.set_status("EX1", "Asha", "online")
+        self.registry.set_status("EX2", "Ravi", "online")
+        self.patch_registry()
+        self.consumer = UsersConsumer()
+        self.sent = []
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            self.sent.append(json.loads(text_data))
+        self.consumer.send = send
+        async_to_sync(self.consumer.send_snapshot)()
+        self.sent.clear()
+
+    def patch_registry(self):
+        original = consumers.presence
+        consumers.presence = self.registry
+        self.addCleanup(setattr, consumers, "presence", original)
+
+    def deliver(self, delta):
+        async_to_sync(self.consumer.presence_delta)({
+            "type": "presence_delta",
+            "from_version": delta["version"],
+            "version": delta["version"],
+            "executives": [delta["executive"]],
+        })
+
+    def test_in_order_deltas_are_forwarded(self):
+        self.deliver(self.registry.set_status("EX1", "Asha", "oncall"))
+        self.assertEqual(self.sent, [{
+            "type": "presence_delta",
+            "from_version": 3,
+            "version": 3,
+            "data": [{
+                "executive_id": "EX1", "name": "Asha", "status": "oncall", "is_available": True,
+                "gender": "unspecified", "languages": [],
+            }],
+        }])
+
+    def test_version_gap_resyncs_from_snapshot(self):
+        self.registry.set_status("EX1", "Asha", "offline")  # never delivered
+        self.deliver(self.registry.set_status("EX2", "Ravi", "offline"))
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0]["type"], "executive_status_list")
+        self.assertEqual(self.sent[0]["version"], 4)
+        self.assertEqual(self.consumer.presence_version, 4)
+
+    def test_subscribe_moves_the_socket_between_groups(self):
+        layer = GroupRecordingChannelLayer()
+        self.consumer.channel_layer, self.consumer.channel_name = layer, "socket-1"
+        self.consumer.presence_groups = {"users_online"}
+        self.registry.cache.watch()
+        self.registry.set_status("EX3", "Meera", "online", gender="female", languages=[1])
+
+        async_to_sync(self.consumer.receive)(json.dumps({"type": "subscribe", "languages": [1], "genders": ["female"]}))
+        self.assertEqual(layer.membership, {"presence_1_female"})
+        self.assertEqual([e["executive_id"] for e in self.sent[-1]["data"]], ["EX3"])
+        self.assertEqual(self.sent[-1]["subscription"], {"languages": [1], "genders": ["female"]})
+
+        self.sent.clear()
+        event = {"type": "presence_shard_delta", "version": 4, "executives": [
+            presence_entry("EX3", "Meera", "oncall", gender="female", languages=[1]),
+        ]}
+        async_to_sync(self.consumer.presence_shard_delta)(event)
+        async_to_sync(self.consumer.presence_shard_delta)(event)
+        self.deliver(self.registry.set_status("EX1", "Asha", "offline"))
+        self.assertEqual([(m["from_version"], m["version"]) for m in self.sent], [(None, 4)])
+
+        async_to_sync(self.consumer.receive)(json.dumps({"type": "subscribe"}))
+        self.assertEqual(layer.membership, {"users_online"})
+        self.assertNotIn("subscription", self.sent[-1])
+
+    def test_pre_encoded_deltas_are_forwarded_unchanged(self):
+        frames = []
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            frames.append(text_data)
+        self.consumer.send = send
+        layer, broadcaster = RecordingChannelLayer(), PresenceBroadcaster(window=0)
+        async_to_sync(broadcaster.queue)(layer, self.registry.set_status("EX1", "Asha", "oncall"))
+        event = layer.sent[0][1]
+        async_to_sync(self.consumer.presence_delta)(event)
+        self.assertIs(frames[0], event["text"])
+
+        self.consumer.subscription = PresenceSubscription(genders=["unspecified"])
+        self.consumer.shard_versions = {}
+        shard_event = layer.sent[1][1]
+        async_to_sync(self.consumer.presence_shard_delta)({**shard_event, "version": 4})
+        self.assertIs(frames[1], shard_event["text"])
+        # A shard event this socket only partly matches is encoded for it
+        self.consumer.subscription = PresenceSubscription(languages=[1])
+        mixed = {**shard_event, "version": 5, "executives": [
+            presence_entry("EX3", "Meera", "online", languages=[1]), *shard_event["executives"],
+        ]}
+        async_to_sync(self.consumer.presence_shard_delta)(mixed)
+        self.assertEqual([e["executive_id"] for e in json.loads(frames[2])["data"]], ["EX3"])
+
+    def test_stale_deltas_are_dropped(self):
+        self.deliver({"version": 2, "executive": {"executive_id": "EX2"}})
+        self.assertEqual(self.sent, [])
+
+    def test_connect_is_one_send_from_the_cached_snapshot(self):
+        def fail():
+            raise AssertionError("store read on connect")
+        self.registry.store.snapshot = fail
+
+        self.deliver(self.registry.set_status("EX3", "Meera", "online"))
+        self.sent.clear()
+        async_to_sync(self.consumer.send_snapshot)(user_info={"user_type": "user"})
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0]["version"], 3)
+        self.assertEqual(self.sent[0]["user_info"], {"user_type": "user"})
+        self.assertEqual([e["executive_id"] for e in self.sent[0]["data"]], ["EX1", "EX2", "EX3"])
+
+
+    def test_copy_is_reloaded_after_the_last_socket_leaves(self):
+        self.consumer.channel_layer, self.consumer.channel_name = GroupRecordingChannelLayer(), "socket-1"
+        async_to_sync(self.consumer.join_presence_group)("users_online")
+        async_to_sync(self.consumer.leave_presence_group)("users_online")
+        # Changed on another worker; with no socket here, no delta arrives
+        self.registry.store.put("EX1", presence_entry("EX1", "Asha", "offline"), 60)
+
+        async_to_sync(self.consumer.send_snapshot)()
+        self.assertEqual(self.sent[0]["version"], 3)
+        self.assertEqual(self.sent[0]["data"][0]["status"], "offline")
+
+
+class PresenceSnapshotTests(SimpleTestCase):
+    def entry(self, executive_id, status="online"):
+        return {"executive_id": executive_id, "status": status}
+
+    def test_deltas_apply_in_order_only(self):
+        snapshot = PresenceSnapshot()
+        self.assertFalse(snapshot.apply(1, 1, [self.entry("EX1")]))
+        snapshot.load(1, [self.entry("EX1")])
+        self.assertTrue(snapshot.apply(2, 3, [self.entry("EX1", "oncall"), self.entry("EX2")]))
+        self.assertTrue(snapshot.apply(3, 3, [self.entry("EX2")]))
+        self.assertFalse(snapshot.apply(5, 5, [self.entry("EX3")]))
+        self.assertFalse(snapshot.apply(None, 6, [self.entry("EX3")]))
+        self.assertEqual(snapshot.version, 3)
+
+    def test_message_is_encoded_once_per_version(self):
+        snapshot = PresenceSnapshot()
+        snapshot.load(5, [self.entry("EX1")])
+        version, text = snapshot.message()
+        self.assertEqual(json.loads(text), {"type": "executive_status_list", "version": 5, "data": [self.entry("EX1")]})
+        data = snapshot._data
+        self.assertEqual(json.loads(snapshot.message(user_info={"name": "A"})[1])["user_info"], {"name": "A"})
+        self.assertIs(snapshot._data, data)
+        snapshot.apply(6, 6, [self.entry("EX2")])
+        self.assertEqual(snapshot.message()[0], 6)
+
+
+
+class RecordingChannelLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+class GroupRecordingChannelLayer(RecordingChannelLayer):
+    def __init__(self):
+        super().__init__()
+        self.membership = {"users_online"}
+
+    async def group_add(self, group, channel):
+        self.membership.add(group)
+
+    async def group_discard(self, group, channel):
+        self.membership.discard(group)
+
+
+class PresenceBroadcasterTests(SimpleTestCase):
+    def delta(self, version, executive_id, status):
+        return {"version": version, "executive": presence_entry(executive_id, executive_id, status)}
+
+    def test_changes_in_one_window_are_sent_once(self):
+        layer, broadcaster = RecordingChannelLayer(), PresenceBroadcaster(window=0.01)
+
+        async def flap():
+            await broadcaster.queue(layer, self.delta(1, "EX1", "offline"))
+            await broadcaster.queue(layer, self.delta(2, "EX1", "online"))
+            await broadcaster.queue(layer, self.delta(3, "EX2", "oncall"))
+            await broadcaster.queue(layer, None)
+            self.assertEqual(layer.sent, [])
+            await asyncio.sleep(0.05)
+
+        async_to_sync(flap)()
+        # The shared group plus the one "unspecified" gender shard
+        self.assertEqual(len(layer.sent), 2)
+        group, message = layer.sent[0]
+        self.assertEqual((group, message["from_version"], message["version"]), ("users_online", 1, 3))
+        self.assertEqual(
+            {e["executive_id"]: e["status"] for e in message["executives"]},
+            {"EX1": "online", "EX2": "oncall"},
+        )
+        self.assertEqual(broadcaster.stats, {"received": 3, "coalesced": 1, "emitted": 2})
+
+    def test_non_contiguous_batches_force_a_resync(self):
+        layer, broadcaster = RecordingChannelLayer(), PresenceBroadcaster(window=0.01)
+
+        async def interleaved():
+            await broadcaster.queue(layer, self.delta(4, "EX1", "online"))
+            await broadcaster.queue(layer, self.delta(6, "EX2", "online"))
+            await asyncio.sleep(0.05)
+
+        async_to_sync(interleaved)()
+        self.assertIsNone(layer.sent[0][1]["from_version"])
+
+    def test_zero_window_sends_immediately(self):
+        layer, broadcaster = RecordingChannelLayer(), PresenceBroadcaster(window=0)
+        async_to_sync(broadcaster.queue)(layer, self.delta(1, "EX1", "online"))
+        self.assertEqual(len(layer.sent), 2)
+
+    def test_changes_fan_out_to_their_shards(self):
+        layer, broadcaster = RecordingChannelLayer(), PresenceBroadcaster(window=0)
+        entry = presence_entry("EX1", "Asha", "online", gender="Female", languages=[3])
+        async_to_sync(broadcaster.queue)(layer, {"version": 1, "executive": entry})
+        self.assertEqual(
+            {group: message["type"] for group, message in layer.sent},
+            {
+                "users_online": "presence_delta",
+                "presence_gender_female": "presence_shard_delta",
+                "presence_lang_3": "presence_shard_delta",
+                "presence_3_female": "presence_shard_delta",
+            },
+        )
+        self.assertEqual(broadcaster.stats["emitted"], 4)
+
+
+class PresenceSubscriptionTests(SimpleTestCase):
+    def test_groups_cover_the_matching_shards(self):
+        entry = presence_entry("EX1", "Asha", "online", gender="female", languages=[1, 2])
+        for languages, genders, expected in [
+            ([1], ["Female"], {"presence_1_female"}),
+            ([2, 5], [], {"presence_lang_2", "presence_lang_5"}),
+            ([], ["female"], {"presence_gender_female"}),
+        ]:
+            subscription = PresenceSubscription(languages, genders)
+            self.assertEqual(subscription.groups(), expected)
+            self.assertTrue(subscription.matches(entry))
+            self.assertTrue(subscription.groups() & shard_groups(entry))
+
+        self.assertFalse(PresenceSubscription([3], []).matches(entry))
+        self.assertFalse(PresenceSubscription([1], ["male"]).matches(entry))
+        self.assertFalse(PresenceSubscription())
+        self.assertEqual(PresenceSubscription().groups(), {"users_online"})
+
+
+class RespStandIn(socketserver.ThreadingTCPServer):
+    """A tiny in-process server speaking the subset of the Redis protocol the store uses."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RespStandInHandler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.revisions = {}  # key -> write counter, for WATCH
+
+    def touch(self, key):
+        self.revisions[key] = self.revisions.get(key, 0) + 1
+
+    def run(self, command, args):
+        data = self.data
+        if command == "PING":
+            return "PONG"
+        if command == "GET":
+            return data.get(args[0])
+        if command == "INCR":
+            data[args[0]] = str(int(data.get(args[0], b"0")) + 1).encode()
+            self.touch(args[0])
+            return int(data[args[0]])
+        if command == "DEL":
+            for key in args:
+                data.pop(key, None)
+                self.touch(key)
+            return len(args)
+        if command == "HGET":
+            return data.get(args[0], {}).get(args[1])
+        if command == "HSET":
+            data.setdefault(args[0], {})[args[1]] = args[2]
+            self.touch(args[0])
+            return 1
+        if command == "HGETALL":
+            return [item for pair in data.get(args[0], {}).items() for item in pair]
+        if command == "ZADD":
+            data.setdefault(args[0], {})[args[2]] = float(args[1])
+            self.touch(args[0])
+            return 1
+        if command == "ZSCORE":
+            score = data.get(args[0], {}).get(args[1])
+            return None if score is None else repr(score).encode()
+        if command == "ZRANGEBYSCORE":
+            def bound(arg):
+                arg = arg.decode()
+                return arg.startswith("("), float(arg.lstrip("("))
+            (low_open, low), (high_open, high) = bound(args[1]), bound(args[2])
+            return [
+                member for member, score in sorted(data.get(args[0], {}).items(), key=lambda kv: kv[1])
+                if (score > low or (not low_open and score == low))
+                and (score < high or (not high_open and score == high))
+            ]
+        if command == "HMGET":
+            return [data.get(args[0], {}).get(field) for field in args[1:]]
+        if command in ("HDEL", "ZREM"):
+            removed = sum(data.get(args[0], {}).pop(field, None) is not None for field in args[1:])
+            self.touch(args[0])
+            return removed
+        raise ValueError(f"unknown command {command}")
+
+
+class RespStandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server, watched, queued = self.server, None, None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command, args = args[0].decode().upper(), args[1:]
+            with server.lock:
+                if command == "WATCH":
+                    watched = {key: server.revisions.get(key, 0) for key in args}
+                    reply = "OK"
+                elif command == "UNWATCH":
+                    watched, reply = None, "OK"
+                elif command == "MULTI":
+                    queued, reply = [], "OK"
+                elif command == "EXEC":
+                    if watched and any(server.revisions.get(k, 0) != v for k, v in watched.items()):
+                        reply = None
+                    else:
+                        reply = [server.run(c, a) for c, a in queued]
+                    watched = queued = None
+                elif queued is not None:
+                    queued.append((command, args))
+                    reply = "QUEUED"
+                else:
+                    reply = server.run(command, args)
+            self.wfile.write(self.encode(reply))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def encode(self, reply):
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, str):
+            return b"+%s\r\n" % reply.encode()
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return b"*%d\r\n" % len(reply) + b"".join(self.encode(item) for item in reply)
+
+
+class PresenceStoreContract:
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.addCleanup(self.store.close)
+
+    def test_close_releases_connections_and_store_reconnects(self):
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(lambda i: self.store.put(f"EX{i}", {"status": "online"}, 60), range(8)))
+        self.store.close()
+        self.assertEqual(len(self.store.snapshot()[1]), 8)
+
+    def test_put_is_compare_and_set(self):
+        self.assertEqual(self.store.put("EX1", {"status": "online"}, 60, now=1000), 1)
+        self.assertIsNone(self.store.put("EX1", {"status": "online"}, 60, now=1010))
+        self.assertEqual(self.store.put("EX1", {"status": "oncall"}, 60, now=1020), 2)
+        self.assertEqual(self.store.get("EX1", now=1020), {"status": "oncall"})
+        self.assertEqual(self.store.snapshot(now=1020), (2, [{"status": "oncall"}]))
+
+    def test_entries_expire(self):
+        self.store.put("EX1", {"status": "online"}, 60, now=1000)
+        self.store.put("EX2", {"status": "online"}, 60, now=1030)
+        self.assertIsNone(self.store.get("EX1", now=1061))
+        self.assertEqual(self.store.snapshot(now=1061), (2, [{"status": "online"}]))
+        # An expired entry written again counts as a change
+        self.assertEqual(self.store.put("EX1", {"status": "online"}, 60, now=1061), 3)
+
+    def test_expire_replaces_or_drops_lapsed_entries(self):
+        self.store.put("EX1", {"status": "online"}, 60, now=1000)
+        self.store.put("EX2", {"status": "offline"}, 60, now=1000)
+        self.store.put("EX3", {"status": "online"}, 600, now=1000)
+
+        def offline(entry):
+            return None if entry["status"] == "offline" else {"status": "offline"}
+
+        self.assertEqual(self.store.expire(offline, 3600, now=1100), [(4, {"status": "offline"})])
+        self.assertEqual(self.store.get("EX1", now=1100), {"status": "offline"})
+        self.assertIsNone(self.store.get("EX2", now=1100))
+        self.assertEqual(self.store.expire(offline, 3600, now=1100), [])
+        version, entries = self.store.snapshot(now=1100)
+        self.assertEqual((version, len(entries)), (4, 2))
+
+    def test_concurrent_writers_get_distinct_versions(self):
+        def write(i):
+            return self.store.put(f"EX{i % 10}", {"n": i}, 60)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            versions = list(pool.map(write, range(200)))
+        self.assertEqual(sorted(versions), list(range(1, 201)))
+        version, entries = self.store.snapshot()
+        self.assertEqual((version, len(entries)), (200, 10))
+
+
+class MemoryPresenceStoreTests(PresenceStoreContract, SimpleTestCase):
+    def make_store(self):
+        return MemoryPresenceStore()
+
+
+class SQLitePresenceStoreTests(PresenceStoreContract, SimpleTestCase):
+    def make_store(self):
+        # The -wal and -shm files live next to the database; drop them all
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return store_from_url(f"sqlite://{os.path.join(directory.name, 'presence.db')}")
+
+    def test_close_closes_every_thread_connection(self):
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(lambda i: self.store.get(f"EX{i}"), range(8)))
+        opened = list(self.store._connections._opened)
+        self.assertGreater(len(opened), 1)
+        self.store.close()
+        for conn in opened:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                conn.execute("SELECT 1")
+
+    def test_incomplete_backend_fails_at_construction(self):
+        class NoExpiry(SQLitePresenceStore):
+            expire = PresenceStore.expire
+        with self.assertRaises(TypeError):
+            NoExpiry(self.store.path)
+
+    def test_workers_share_the_file(self):
+        other = SQLitePresenceStore(self.store.path)
+        self.addCleanup(other.close)
+        self.store.put("EX1", {"status": "online"}, 60)
+        self.assertEqual(other.get("EX1"), {"status": "online"})
+        self.assertEqual(other.put("EX2", {"status": "online"}, 60), 2)
+
+
+class RedisPresenceStoreTests(PresenceStoreContract, SimpleTestCase):
+    def make_store(self):
+        server = RespStandIn()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        host, port = server.server_address
+        store = store_from_url(f"redis://{host}:{port}/0")
+        self.assertIsInstance(store, RedisPresenceStore)
+        return store
@@ -71,6 +71,7 @@ class RechargePlanDeleteAPIView(APIView):
 
 from rest_framework import status, permissions
 from payments.models import UserRecharge
+from calls.autoend import rearm_user_calls
 
 class RechargePlansView(APIView):
     permission_classes = [permissions.AllowAny]
@@ -104,6 +105,9 @@ class UserRechargeView(APIView):
             is_successful=True  
         )
 
+        # Extra coins mean extra talk time for any call already in progress
+        rearm_user_calls(user.id)
+
         return Response({
             "message": "Recharge successful",
             "coins_added": coins_to_add,
@@ -10,14 +10,17 @@ django.setup()
 
 from channels.routing import ProtocolTypeRouter, URLRouter
 from executives.routing import websocket_urlpatterns
-from executives.middleware import JWTAuthMiddleware
+from calls.routing import websocket_urlpatterns as call_websocket_urlpatterns
+from talkeasy.middleware import JWTAuthMiddleware
+from talkeasy.services import ServicesMiddleware, lifespan
 
 # Get Django ASGI application
 django_asgi_app = get_asgi_application()
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": JWTAuthMiddleware(
-        URLRouter(websocket_urlpatterns)
-    ),
+    "websocket": ServicesMiddleware(JWTAuthMiddleware(
+        URLRouter(websocket_urlpatterns + call_websocket_urlpatterns)
+    )),
+    "lifespan": lifespan,
 })
\ No newline at end of file
@@ -0,0 +1,86 @@
+# talkeasy/authcache.py
+"""
+Bounded cache for authentication results.
+
+Used by the WebSocket principal cache (talkeasy/middleware.py) and the
+executive token cache (executives/authentication.py). Entries are keyed
+on a token digest, expire at their own time and are evicted least
+recently used first. Each entry records its owner (``owner_key`` of the
+principal it belongs to), so every entry of a principal can be dropped
+when it changes; ``connect_invalidation`` in talkeasy/middleware.py does
+that for both caches from the same model signals.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def owner_key(model, pk):
+    return (model._meta.label, pk)
+
+
+class AuthCache:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, owner, expires_at), oldest first
+        self._keys = {}  # owner -> keys it owns
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None:
+                return None
+            if cached[2] <= now:
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return cached[0]
+
+    def put(self, key, value, owner, expires_at):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, owner, expires_at)
+            self._keys.setdefault(owner, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def update(self, key, value):
+        """Replace the value of a cached entry, keeping its owner and expiry."""
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries[key] = (value,) + cached[1:]
+
+    def invalidate(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def invalidate_owner(self, owner):
+        with self._lock:
+            for key in list(self._keys.get(owner, ())):
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+
+    def _discard(self, key):
+        cached = self._entries.pop(key, None)
+        if cached is None:
+            return
+        keys = self._keys.get(cached[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[cached[1]]
@@ -0,0 +1,98 @@
+# talkeasy/bench.py
+"""
+Helpers shared by the ``bench_*`` management commands.
+
+Benchmarks never touch the configured database: they run against a
+throwaway test database created for the duration of the command.
+"""
+import statistics
+import time
+from contextlib import contextmanager
+from django.db import connection
+
+
+@contextmanager
+def bench_database(verbosity=0):
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+class Timer:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds."""
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000 if samples else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+    }
+
+
+def seed_parties(count, coin_balance=10_000, coins_per_second=3, amount_per_min="6.00"):
+    """Create ``count`` (user, executive) pairs with stats rows, ready to call."""
+    from executives.models import Executive, ExecutiveStats
+    from executives.presence import presence
+    from users.models import UserProfile, UserStats
+
+    # bulk_create skips UserProfile.save() and its post_save signals, so
+    # user_id and the stats rows are filled in here. Rows are re-read because
+    # MySQL does not return primary keys from bulk inserts.
+    UserProfile.objects.bulk_create([
+        UserProfile(mobile_number=f"9{i:09d}", user_id=f"B{i:07d}", name=f"Caller {i}")
+        for i in range(count)
+    ])
+    users = list(UserProfile.objects.filter(user_id__startswith="B").order_by("id"))
+    UserStats.objects.bulk_create([UserStats(user=u, coin_balance=coin_balance) for u in users])
+
+    Executive.objects.bulk_create([
+        Executive(
+            executive_id=f"BE{i:06d}", mobile_number=f"8{i:09d}", name=f"Bench {i}",
+            is_online=True, online=True,
+        )
+        for i in range(count)
+    ])
+    executives = list(Executive.objects.filter(executive_id__startswith="BE").order_by("id"))
+    for executive in executives:
+        presence.set_status(executive.executive_id, executive.name, "online")
+    ExecutiveStats.objects.bulk_create([
+        ExecutiveStats(executive=e, coins_per_second=coins_per_second, amount_per_min=amount_per_min)
+        for e in executives
+    ])
+    return users, executives
+
+
+def seed_calls(users, executives, **fields):
+    """Create one call per (user, executive) pair; ``fields`` override the defaults."""
+    from calls.models import AgoraCallHistory
+
+    defaults = dict(token="t", executive_token="t", coins_per_second=3, amount_per_min="6.00")
+    defaults.update(fields)
+    AgoraCallHistory.objects.bulk_create([
+        AgoraCallHistory(
+            user=user, executive=executive, channel_name=f"bench_{i}",
+            uid=i, callee_uid=i + 1000, **defaults,
+        )
+        for i, (user, executive) in enumerate(zip(users, executives))
+    ])
+    return list(AgoraCallHistory.objects.filter(channel_name__startswith="bench_").order_by("id"))
@@ -0,0 +1,160 @@
+# talkeasy/dbpool.py
+"""
+Thread pool for the ORM work of WebSocket consumers.
+
+``database_sync_to_async`` defaults to ``thread_sensitive=True``, which
+runs every socket's queries in a worker on one shared thread, and closes
+the connection around each call when ``CONN_MAX_AGE`` is 0. Consumers
+use ``consumer_db`` instead: their queries run on a pool of
+``CONSUMER_DB_POOL_SIZE`` threads, so sockets no longer wait behind one
+another. Each thread keeps its own connections open for up to
+``CONSUMER_DB_CONN_MAX_AGE`` seconds, closing them early only when they
+become unusable.
+
+Work is still ordered per connection: jobs submitted under the same key
+(the consumer's channel name) run one at a time in submission order, so
+a socket never sees its own writes reordered. ``stats()`` reports how
+many jobs are waiting on the pool and how deep that queue has been.
+
+``CONSUMER_DB_POOL_SIZE = 0`` turns the pool off and falls back to
+``database_sync_to_async`` (tests that count queries on their own
+connection rely on that).
+"""
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connections
+
+
+def pool_size():
+    return getattr(settings, "CONSUMER_DB_POOL_SIZE", 8)
+
+
+def recycle_connections(opened):
+    """Close this thread's connections that are broken or older than the limit."""
+    max_age = getattr(settings, "CONSUMER_DB_CONN_MAX_AGE", 600)
+    now = time.monotonic()
+    for conn in connections.all(initialized_only=True):
+        if conn.connection is None:
+            opened.pop(conn.alias, None)
+            continue
+        started = opened.setdefault(conn.alias, now)
+        if now - started >= max_age or (conn.errors_occurred and not conn.is_usable()):
+            conn.close()
+            opened.pop(conn.alias, None)
+
+
+class DBExecutor:
+    def __init__(self, size=None):
+        self.size = size
+        self._pool = None
+        self._lock = threading.Lock()
+        self._counters = threading.Lock()
+        self._tails = {}  # key -> the last job submitted under it
+        self._local = threading.local()
+        self.queued = 0  # waiting for a pool thread
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+
+    def workers(self):
+        return pool_size() if self.size is None else self.size
+
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers(), thread_name_prefix="consumer-db")
+            return self._pool
+
+    def stats(self):
+        return {
+            "size": self.workers(),
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "max_queued": self.max_queued,
+            "connections": len(self._tails),
+        }
+
+    def _call(self, func, args, kwargs):
+        with self._counters:
+            self.queued -= 1
+            self.running += 1
+        opened = self._local.__dict__.setdefault("opened", {})
+        recycle_connections(opened)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recycle_connections(opened)
+            with self._counters:
+                self.running -= 1
+                self.completed += 1
+
+    async def run(self, key, func, *args, **kwargs):
+        """Run ``func`` on the pool after the jobs already submitted under ``key``."""
+        if not self.workers():
+            return await database_sync_to_async(func)(*args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        previous = self._tails.get(key)
+        done = loop.create_future()
+        self._tails[key] = done
+
+        def release(_=None):
+            if not done.done():
+                done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+        future = None
+        try:
+            if previous is not None:
+                await asyncio.shield(previous)
+            with self._counters:
+                self.queued += 1
+                self.max_queued = max(self.max_queued, self.queued)
+            future = loop.run_in_executor(self.pool(), functools.partial(self._call, func, args, kwargs))
+            return await asyncio.shield(future)
+        finally:
+            # If cancelled, the next job still waits for this one (or the
+            # one before it) to finish
+            pending = future if future is not None else previous
+            if pending is None or pending.done():
+                release()
+            else:
+                pending.add_done_callback(release)
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        # Close each thread's connections before the threads go away
+        workers = pool._max_workers
+        barrier = threading.Barrier(workers)
+
+        def close():
+            try:
+                barrier.wait(timeout=5)
+            except threading.BrokenBarrierError:
+                pass
+            connections.close_all()
+
+        for _ in range(workers):
+            pool.submit(close)
+        pool.shutdown(wait=True)
+
+
+db_executor = DBExecutor()
+
+
+def consumer_db(func):
+    """Like ``database_sync_to_async`` for consumer methods, ordered per connection."""
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        return await db_executor.run(getattr(self, "channel_name", id(self)), func, self, *args, **kwargs)
+    return wrapper
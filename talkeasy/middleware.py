@@ -1,71 +1,177 @@
-# middleware.py (create this file in your project root or app directory)
-from channels.middleware import BaseMiddleware
-from channels.db import database_sync_to_async
-from django.contrib.auth.models import AnonymousUser
+# talkeasy/middleware.py
+"""
+WebSocket authentication shared by every consumer.
+
+Two kinds of credentials reach the sockets: SimpleJWT access tokens
+(users, admins and executives logged in with a password) and
+``ExecutiveToken`` refresh tokens sent by the executive app. Both are
+resolved here, and the principal they resolve to is kept in a bounded
+cache keyed on a digest of the token for ``WEBSOCKET_AUTH_CACHE_SECONDS``
+(never past the token's own expiry), so a reconnecting client costs no
+JWT decode and no queries.
+
+Entries are dropped as soon as this process sees the principal or token
+saved: logout, ban, suspension and token revocation all go through a
+save. The same signals keep the REST ``token_cache`` of
+executives/authentication.py current. Changes made by another process
+are picked up when the entry ages out.
+
+``JWTAuthMiddleware`` puts the ``AUTH_USER_MODEL`` user of the ``token``
+query parameter in ``scope["user"]``; consumers expecting another kind
+of principal call ``authenticate_jwt()`` / ``authenticate_executive_token()``.
+"""
+import copy
+import time
 from urllib.parse import parse_qs
 import jwt
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
 from django.conf import settings
-from users.models import UserProfile
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db.models.signals import post_delete, post_save
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.tokens import UntypedToken
+from executives.authentication import token_cache
+from executives.models import Executive, ExecutiveToken
+from talkeasy.authcache import AuthCache, owner_key, token_digest
+from users.models import UserProfile
+from users.utils import is_token_blacklisted
+
 
+def cache_ttl():
+    return getattr(settings, "WEBSOCKET_AUTH_CACHE_SECONDS", 60)
 
-@database_sync_to_async
-def get_user_from_token(token):
+
+class PrincipalCache(AuthCache):
+    def get(self, key, now=None):
+        principal = super().get(key, now)
+        # Consumers keep the principal on the connection; hand each one its own
+        return None if principal is None else copy.copy(principal)
+
+    def put(self, key, principal, expires_at):
+        super().put(key, principal, principal_key(principal), expires_at)
+
+    def invalidate_principal(self, principal):
+        self.invalidate_owner(principal_key(principal))
+
+
+def principal_key(principal):
+    return owner_key(type(principal), principal.pk)
+
+
+principals = PrincipalCache(getattr(settings, "WEBSOCKET_AUTH_CACHE_SIZE", 10000))
+
+
+def may_connect(principal):
+    return principal.is_active and not getattr(principal, "is_banned", False)
+
+
+def resolve_jwt(token, models):
+    """Principal for a JWT access token, looked up in ``models`` in order."""
+    key = ("jwt", tuple(model._meta.label for model in models), token_digest(token))
+    principal = principals.get(key)
+    if principal is not None:
+        return principal
     try:
-        from rest_framework_simplejwt.tokens import UntypedToken
-        from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-        
-        # Validate token format
         UntypedToken(token)
-        
-        # Decode token
-        decoded_data = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-        user_id = decoded_data.get('user_id')
-        
-        if user_id:
-            # Try UserProfile first
-            try:
-                user = UserProfile.objects.get(id=user_id)
-                return user
-            except UserProfile.DoesNotExist:
-                # Fallback to default User model
-                User = get_user_model()
-                try:
-                    user = User.objects.get(id=user_id)
-                    return user
-                except User.DoesNotExist:
-                    return None
+        decoded_token = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+    except (InvalidToken, TokenError, jwt.InvalidTokenError) as e:
+        print(f"JWT Authentication failed: {e}")
+        return None
+
+    user_id = decoded_token.get("user_id")
+    if not user_id:
+        return None
+    for model in models:
+        principal = model.objects.filter(id=user_id).first()
+        if principal is not None:
+            break
+    else:
+        return None
+    if not may_connect(principal):
+        return None
+    if isinstance(principal, UserProfile) and is_token_blacklisted(decoded_token.get("jti")):
+        return None
+
+    expires_at = min(time.time() + cache_ttl(), decoded_token.get("exp", float("inf")))
+    principals.put(key, principal, expires_at)
+    return principal
+
+
+def resolve_executive_token(token):
+    """Executive for an ``ExecutiveToken`` refresh token, or None if it is unusable."""
+    key = ("executive_token", token_digest(token))
+    executive = principals.get(key)
+    if executive is not None:
+        return executive
+    token_obj = ExecutiveToken.objects.select_related("executive").filter(refresh_token=token).first()
+    if token_obj is None or token_obj.revoked:
+        return None
+    expires_at = token_obj.expires_at.timestamp()
+    if expires_at <= time.time() or not may_connect(token_obj.executive):
+        return None
+    principals.put(key, token_obj.executive, min(time.time() + cache_ttl(), expires_at))
+    return token_obj.executive
+
+
+async def authenticate_jwt(token, models=None):
+    try:
+        return await database_sync_to_async(resolve_jwt)(token, models or (get_user_model(),))
+    except Exception as e:
+        print(f"JWT Authentication failed: {e}")
         return None
-        
-    except (InvalidToken, TokenError, jwt.ExpiredSignatureError, jwt.InvalidTokenError, Exception) as e:
-        print(f"Token validation error: {e}")
+
+
+async def authenticate_executive_token(token):
+    try:
+        return await database_sync_to_async(resolve_executive_token)(token)
+    except Exception as e:
+        print(f"Custom Token Authentication failed: {e}")
         return None
 
 
+def token_from_scope(scope, header=None):
+    """Token from the ``header`` request header, else the ``token`` query parameter."""
+    if header:
+        headers = dict(scope.get("headers", []))
+        token = headers.get(header, b"").decode().replace("Bearer ", "")
+        if token:
+            return token
+    query_params = parse_qs(scope.get("query_string", b"").decode())
+    return query_params.get("token", [None])[0]
+
+
 class JWTAuthMiddleware(BaseMiddleware):
-    """
-    Custom middleware to authenticate WebSocket connections using JWT tokens
-    """
-    
-    def __init__(self, inner):
-        super().__init__(inner)
+    """Puts the JWT's ``AUTH_USER_MODEL`` user, or AnonymousUser, in ``scope["user"]``."""
 
     async def __call__(self, scope, receive, send):
-        # Only process WebSocket connections
+        scope["user"] = AnonymousUser()
         if scope["type"] == "websocket":
-            # Get token from query string
-            query_string = scope.get("query_string", b"").decode()
-            query_params = parse_qs(query_string)
-            token = query_params.get("token", [None])[0]
-            
+            token = token_from_scope(scope)
             if token:
-                # Authenticate user
-                user = await get_user_from_token(token)
-                if user:
-                    scope["user"] = user
-                else:
-                    scope["user"] = AnonymousUser()
-            else:
-                scope["user"] = AnonymousUser()
-        
-        return await super().__call__(scope, receive, send)
\ No newline at end of file
+                scope["user"] = await authenticate_jwt(token) or AnonymousUser()
+        return await super().__call__(scope, receive, send)
+
+
+def principal_changed(sender, instance, **kwargs):
+    principals.invalidate_principal(instance)
+    if isinstance(instance, Executive):
+        token_cache.invalidate_executive(instance.pk)
+
+
+def executive_token_changed(sender, instance, **kwargs):
+    principals.invalidate(("executive_token", token_digest(instance.refresh_token)))
+    if instance.revoked and kwargs.get("signal") is post_save:
+        # Logout: answer the next request from the cache without a query
+        token_cache.revoke(instance.refresh_token)
+    else:
+        token_cache.invalidate(instance.refresh_token)
+
+
+def connect_invalidation():
+    for model in (get_user_model(), Executive, UserProfile):
+        post_save.connect(principal_changed, sender=model, dispatch_uid=f"ws-auth-{model._meta.label}")
+        post_delete.connect(principal_changed, sender=model, dispatch_uid=f"ws-auth-delete-{model._meta.label}")
+    post_save.connect(executive_token_changed, sender=ExecutiveToken, dispatch_uid="ws-auth-executive-token")
+    post_delete.connect(executive_token_changed, sender=ExecutiveToken, dispatch_uid="ws-auth-executive-token-delete")
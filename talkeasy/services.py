@@ -0,0 +1,75 @@
+# talkeasy/services.py
+"""
+Long-running asyncio services that live inside the ASGI process.
+
+Apps register a coroutine factory in ``AppConfig.ready()``; nothing runs
+until ``start()`` is called from the ASGI event loop, either by the
+lifespan handler or, for servers without lifespan support (Daphne), by
+``ServicesMiddleware`` on the first WebSocket connection. Cleanup
+registered with ``on_shutdown`` runs after the services have stopped.
+"""
+import asyncio
+from channels.middleware import BaseMiddleware
+
+_factories = {}
+_tasks = {}
+_cleanups = []
+
+
+def register(name, factory):
+    _factories[name] = factory
+
+
+def on_shutdown(func):
+    _cleanups.append(func)
+
+
+def start():
+    loop = asyncio.get_running_loop()
+    for name, factory in _factories.items():
+        task = _tasks.get(name)
+        if task is None or task.done():
+            _tasks[name] = loop.create_task(factory(), name=name)
+
+
+async def stop():
+    tasks = list(_tasks.values())
+    _tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for func in _cleanups:
+        try:
+            func()
+        except Exception as e:
+            print(f"Shutdown cleanup {func.__qualname__} failed: {e}")
+
+
+async def run_periodic(interval, func):
+    """Await ``func()`` every ``interval`` seconds, surviving errors."""
+    while True:
+        try:
+            await func()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Background service {func.__qualname__} failed: {e}")
+        await asyncio.sleep(interval)
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await stop()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+class ServicesMiddleware(BaseMiddleware):
+    async def __call__(self, scope, receive, send):
+        start()
+        return await super().__call__(scope, receive, send)
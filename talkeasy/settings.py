@@ -232,11 +232,45 @@ SIMPLE_JWT = {
 AGORA_APP_ID = '9019fa33fc6d4654848121f4b88b346c'
 AGORA_APP_CERTIFICATE = 'e2f0a6a085d34973ad08c7cfa785796d'
 AGORA_TOKEN_TTL_SECONDS = 3600  # 1 hour
+AGORA_TOKEN_REFRESH_MARGIN_SECONDS = 300  # cached tokens are re-signed this long before expiry
 COINS_PER_SECOND = 3
 
+#calls
+CALL_METERING_INTERVAL_SECONDS = 1  # how often joined calls are charged
+CALL_TIMER_TICK_SECONDS = 0.25  # resolution of auto-end and timeout timers
+CALL_RING_TIMEOUT_SECONDS = 30  # unanswered calls become missed
+CALL_JOIN_TIMEOUT_SECONDS = 30  # accepted calls nobody joined become missed
+CALL_HEARTBEAT_TIMEOUT_SECONDS = 60  # calls whose heartbeats stop are ended
+CALL_SWEEP_INTERVAL_SECONDS = 15  # backstop scan for unanswered calls
+CALL_HEARTBEAT_FLUSH_SECONDS = 5  # buffered heartbeats are written this often
+CALL_REAPER_INTERVAL_SECONDS = 30  # scan for calls whose heartbeat lease lapsed
+CALL_REAPER_STALE_SECONDS = 120  # lease length; abandoned calls are settled after this
+
 
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels.layers.InMemoryChannelLayer"
     }
-}
\ No newline at end of file
+}
+
+#presence
+EXECUTIVE_PRESENCE_STORE = "memory://"  # sqlite:///path/presence.db or redis://host:6379/0 to share between workers
+EXECUTIVE_PRESENCE_TTL_SECONDS = 86400  # offline executives stay in the presence list this long
+EXECUTIVE_PRESENCE_COALESCE_MS = 150  # presence changes within this window go out as one message; 0 sends each at once
+EXECUTIVE_PRESENCE_LEASE_SECONDS = 60  # online executives whose socket stops renewing go offline after this
+EXECUTIVE_PRESENCE_SWEEP_SECONDS = 10  # how often lapsed presence leases are looked for
+EXECUTIVE_FLAG_FLUSH_SECONDS = 3  # is_online/on_call changes are written to the database this often
+
+#auth caches
+WEBSOCKET_AUTH_CACHE_SECONDS = 60  # resolved socket principals are reused this long (logout/ban/revocation evict them earlier)
+WEBSOCKET_AUTH_CACHE_SIZE = 10000  # at most this many cached principals per process
+EXECUTIVE_TOKEN_CACHE_SECONDS = 60  # X-EXECUTIVE-TOKEN lookups are reused this long (logout and bans update them at once)
+EXECUTIVE_TOKEN_CACHE_SIZE = 10000  # at most this many cached executive tokens per process
+USER_JTI_BLOOM_BITS = 1 << 23  # 1 MiB filter, well under 0.1% false positives up to 500k blacklisted tokens
+USER_JTI_BLACKLIST_REFRESH_SECONDS = 30  # tokens blacklisted by other processes are picked up this often
+USER_JTI_BLACKLIST_RESCAN_ROWS = 1000  # ids below the highest seen that each refresh reads again, for rows committed out of order
+USER_JTI_BLACKLIST_RELOAD_SECONDS = 3600  # the filter is rebuilt from the whole table this often
+
+#consumers
+CONSUMER_DB_POOL_SIZE = 8  # threads running consumer queries, each with its own connection; 0 uses the shared sync thread
+CONSUMER_DB_CONN_MAX_AGE = 600  # pool threads reconnect after this many seconds
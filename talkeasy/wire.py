@@ -0,0 +1,175 @@
+# talkeasy/wire.py
+"""
+Encoding of messages sent to WebSocket clients.
+
+An event sent to a group is delivered to every socket in it, and each
+consumer used to ``json.dumps`` the same payload for itself. Senders now
+attach the client message already encoded, once, as ``text`` (see
+``with_text``), and handlers forward it unchanged. Handlers keep a
+``dumps`` fallback for events sent without ``text``.
+
+orjson is used when it is installed, the standard library otherwise.
+
+Clients that offer the ``talkeasy.msgpack.v1`` subprotocol (and servers
+with msgpack installed) get the same messages as binary MessagePack
+frames instead: keys are replaced by the short codes in ``FIELD_CODES``
+and human-readable filler (``message`` on anything but errors,
+``debug_info``) is left out. Such clients may send MessagePack frames
+using the same codes. Everyone else keeps getting JSON text.
+Consumers opt in through ``WireProtocolMixin``; their code keeps
+producing JSON text, which is packed once per distinct text, so a group
+message is still encoded once however many packed sockets receive it.
+"""
+import functools
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "talkeasy.msgpack.v1"
+
+# Part of the protocol: only ever add codes, never reuse one
+FIELD_CODES = {
+    "type": "t",
+    "call_id": "c",
+    "user_id": "u",
+    "executive_id": "e",
+    "version": "v",
+    "from_version": "f",
+    "data": "d",
+    "status": "s",
+    "name": "n",
+    "is_available": "a",
+    "gender": "g",
+    "languages": "l",
+    "genders": "gs",
+    "timestamp": "ts",
+    "action": "ac",
+    "reason": "r",
+    "error": "er",
+    "code": "co",
+    "duration": "du",
+    "duration_seconds": "ds",
+    "joined_at": "ja",
+    "ended_by": "eb",
+    "coins_deducted": "cd",
+    "executive_earnings": "ee",
+    "coins_per_second": "cps",
+    "amount_per_min": "apm",
+    "channel_name": "ch",
+    "caller_name": "cn",
+    "caller_uid": "ru",
+    "callee_uid": "cu",
+    "executive_token": "et",
+    "subscription": "sb",
+    "user_info": "ui",
+    "user_type": "ut",
+    "is_executive": "ie",
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+FILLER = frozenset({"message", "debug_info"})
+
+
+def dumps(message):
+    """``message`` as compact JSON text."""
+    if orjson is not None:
+        return orjson.dumps(message, default=str).decode()
+    return json.dumps(message, separators=(",", ":"), default=str)
+
+
+def with_text(event, message=None):
+    """``event`` plus ``text``: ``message`` (the event itself by default) encoded once for every receiver."""
+    return {**event, "text": dumps(event if message is None else message)}
+
+
+def text_of(event, message=None):
+    """The pre-encoded ``text`` of ``event``, or ``message`` (default: the event) encoded now."""
+    text = event.get("text")
+    if text is not None:
+        return text
+    return dumps(event if message is None else message)
+
+
+def loads(text):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def compact(value):
+    """``value`` with keys replaced by their codes and filler dropped."""
+    if isinstance(value, dict):
+        keep_filler = value.get("type") == "error"
+        return {
+            FIELD_CODES.get(key, key): compact(item)
+            for key, item in value.items()
+            if keep_filler or key not in FILLER
+        }
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    return value
+
+
+def expand(value):
+    """Undo ``compact``'s key codes."""
+    if isinstance(value, dict):
+        return {FIELD_NAMES.get(key, key): expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [expand(item) for item in value]
+    return value
+
+
+def pack(message):
+    return msgpack.packb(compact(message))
+
+
+@functools.lru_cache(maxsize=128)
+def pack_text(text):
+    """A JSON message as MessagePack; repeats of the same text are packed once."""
+    return pack(loads(text))
+
+
+def unpack(data):
+    return expand(msgpack.unpackb(data))
+
+
+def negotiate(scope):
+    """The subprotocol to accept for ``scope``, or None for plain JSON."""
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in scope.get("subprotocols", ()):
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+
+class WireProtocolMixin:
+    """
+    For ``AsyncWebsocketConsumer`` subclasses: negotiates the MessagePack
+    subprotocol on accept and converts frames on sockets that chose it.
+    """
+    packed = False
+
+    async def accept(self, subprotocol=None, headers=None):
+        if subprotocol is None:
+            subprotocol = negotiate(self.scope)
+        self.packed = subprotocol == MSGPACK_SUBPROTOCOL
+        await super().accept(subprotocol, headers)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self.packed and text_data is not None:
+            text_data, bytes_data = None, pack_text(text_data)
+        await super().send(text_data, bytes_data, close)
+
+    async def websocket_receive(self, message):
+        if self.packed and message.get("bytes") is not None:
+            try:
+                message = {"type": message["type"], "text": dumps(unpack(message["bytes"]))}
+            except Exception as e:
+                print(f"Invalid MessagePack frame: {e}")
+                return
+        await super().websocket_receive(message)
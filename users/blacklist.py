@@ -0,0 +1,124 @@
+# users/blacklist.py
+"""
+Process-local index of blacklisted user token JTIs.
+
+Nearly every token ``UserProfileJWTAuthentication`` sees is not
+blacklisted, so asking the database each time is a wasted query. The
+index keeps a Bloom filter of every blacklisted JTI plus an exact set of
+the ones confirmed blacklisted. A JTI the filter has never seen is
+answered without a query; only filter hits that are not in the exact set
+are checked against the database (and added to the set if confirmed).
+
+The filter is loaded on first use and tops itself up with rows added by
+other processes every ``USER_JTI_BLACKLIST_REFRESH_SECONDS``. Rows do
+not always commit in id order (a logout can commit id N after another
+one's N+1 was read), so each refresh reads again the last
+``USER_JTI_BLACKLIST_RESCAN_ROWS`` ids below the highest it has seen,
+and the whole filter is rebuilt every
+``USER_JTI_BLACKLIST_RELOAD_SECONDS`` in case a row fell further
+behind. Tokens blacklisted in this process are added immediately.
+"""
+import hashlib
+import threading
+import time
+from django.conf import settings
+from users.models import UserProfileBlacklistedToken
+
+
+class BloomFilter:
+    def __init__(self, bits=1 << 23, hashes=7):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class JtiBlacklist:
+    def __init__(self, bits=None):
+        self._lock = threading.Lock()
+        self._bits = bits
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._filter = BloomFilter(self._bits or getattr(settings, "USER_JTI_BLOOM_BITS", 1 << 23))
+            self._exact = set()
+            self._last_id = 0
+            self._loaded_at = None
+            self._reloaded_at = None
+
+    def refresh(self, now=None):
+        """Add the blacklist rows created since the last refresh, re-reading the trailing ids."""
+        now = time.monotonic() if now is None else now
+        rescan = getattr(settings, "USER_JTI_BLACKLIST_RESCAN_ROWS", 1000)
+        rows = list(
+            UserProfileBlacklistedToken.objects.filter(id__gt=max(self._last_id - rescan, 0))
+            .order_by("id")
+            .values_list("id", "token__jti")
+        )
+        with self._lock:
+            for row_id, jti in rows:
+                self._filter.add(jti)
+                self._last_id = max(self._last_id, row_id)
+            self._loaded_at = now
+            if self._reloaded_at is None:
+                self._reloaded_at = now
+
+    def reload(self, now=None):
+        """Rebuild the filter from the whole table, then swap it in."""
+        now = time.monotonic() if now is None else now
+        bloom = BloomFilter(self._bits or getattr(settings, "USER_JTI_BLOOM_BITS", 1 << 23))
+        last_id = 0
+        for row_id, jti in UserProfileBlacklistedToken.objects.values_list("id", "token__jti").iterator():
+            bloom.add(jti)
+            last_id = max(last_id, row_id)
+        with self._lock:
+            # Tokens blacklisted here meanwhile may not be committed yet
+            for jti in self._exact:
+                bloom.add(jti)
+            self._filter, self._last_id = bloom, max(self._last_id, last_id)
+            self._loaded_at = self._reloaded_at = now
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        reload_interval = getattr(settings, "USER_JTI_BLACKLIST_RELOAD_SECONDS", 3600)
+        if self._reloaded_at is not None and now - self._reloaded_at >= reload_interval:
+            self.reload(now)
+            return
+        interval = getattr(settings, "USER_JTI_BLACKLIST_REFRESH_SECONDS", 30)
+        if self._loaded_at is None or now - self._loaded_at >= interval:
+            self.refresh(now)
+
+    def add(self, jti):
+        with self._lock:
+            self._filter.add(jti)
+            self._exact.add(jti)
+
+    def __contains__(self, jti):
+        if not jti:
+            return False
+        self._maybe_refresh()
+        with self._lock:
+            if jti in self._exact:
+                return True
+            if jti not in self._filter:
+                return False
+        if not UserProfileBlacklistedToken.objects.filter(token__jti=jti).exists():
+            return False
+        self.add(jti)
+        return True
+
+
+jti_blacklist = JtiBlacklist()
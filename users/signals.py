@@ -1,25 +1,192 @@
-from django.db.models.signals import post_save, post_delete
+"""
+Executive change feed for the ``executives_group`` channel group.
+
+Every Executive save used to broadcast the whole table serialized with
+``ExecutiveSerializer``. Now a save only reports the feed fields that
+actually differ from the database (and nothing at all when none do), and
+the changes made inside one transaction go out as a single
+``send_executive_update`` message once it commits:
+
+    {"type": "send_executive_update",
+     "data": [{"id": 3, "executive_id": "EX3", "changed": {"on_call": true}},
+              {"id": 4, "executive_id": "EX4", "deleted": true}]}
+
+The values a save is compared with are read in ``pre_save``: from what
+the instance itself last saved, else (full saves only) with one query.
+A save with ``update_fields`` and nothing to compare with reports those
+fields as they are. Loading instances costs nothing extra.
+
+Queryset ``.update()`` calls (presence flags, call claims) send no
+signals and are not part of the feed.
+"""
+import threading
+import weakref
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 from executives.models import Executive
 from executives.serializers import ExecutiveSerializer
 
-def broadcast_executives():
-    channel_layer = get_channel_layer()
-    data = ExecutiveSerializer(Executive.objects.all().order_by('-created_at'), many=True).data
-    async_to_sync(channel_layer.group_send)(
-        "executives_group",
-        {
-            "type": "send_executive_update",
-            "data": data
+EXECUTIVES_GROUP = "executives_group"
+
+# Serializer fields not carried by the feed: the password is write-only,
+# and stats / languages live in other tables that saving an Executive
+# does not touch
+SKIPPED_FIELDS = {"password", "stats", "languages_known"}
+
+_fields = None
+_local = threading.local()
+
+
+def feed_fields():
+    """``{serializer field name: (model field, serializer field)}``"""
+    global _fields
+    if _fields is None:
+        serializer_fields = ExecutiveSerializer().fields
+        _fields = {
+            name: (Executive._meta.get_field(field.source), field)
+            for name, field in serializer_fields.items()
+            if name not in SKIPPED_FIELDS and not field.write_only
         }
-    )
+    return _fields
+
+
+def remember(instance, update_fields=None):
+    """Note the values now in the database for the next save to diff against."""
+    state = instance.__dict__.setdefault("_feed_state", {})
+    for model_field, _ in feed_fields().values():
+        if update_fields is not None and model_field.name not in update_fields:
+            continue
+        if model_field.attname in instance.__dict__:
+            state[model_field.attname] = instance.__dict__[model_field.attname]
+
+
+def stored_state(instance, update_fields):
+    """The values ``instance`` is about to overwrite, as far as they are known."""
+    state = instance.__dict__.get("_feed_state", {})
+    if update_fields is not None or instance._state.adding:
+        return state
+    attnames = [
+        model_field.attname for model_field, _ in feed_fields().values()
+        if model_field.attname in instance.__dict__
+    ]
+    if all(attname in state for attname in attnames):
+        return state
+    return Executive.objects.filter(pk=instance.pk).values(*attnames).first() or {}
+
+
+def changed_fields(instance, state, update_fields):
+    changed = {}
+    for name, (model_field, field) in feed_fields().items():
+        attname = model_field.attname
+        if attname not in instance.__dict__:
+            continue  # deferred and not loaded, so not saved either
+        if update_fields is not None and model_field.name not in update_fields:
+            continue
+        if attname in state and state[attname] == instance.__dict__[attname]:
+            continue
+        changed[name] = field.to_representation(field.get_attribute(instance))
+    return changed
+
+
+class ChangeBatch:
+    """
+    Changes made in one transaction, sent together once it commits.
+
+    Each change is registered with its own ``on_commit`` callback, so a
+    change made in a savepoint that is rolled back is dropped with it.
+    The batch only holds weak references to those callbacks: the ones
+    Django discarded are gone, and the last one still waiting sends the
+    batch.
+    """
+
+    def __init__(self):
+        self.changes = {}  # executive pk -> change
+        self.waiting = []  # weak references to callbacks that have not run
+
+    def alive(self):
+        self.waiting = [ref for ref in self.waiting if ref() is not None]
+        return bool(self.waiting)
+
+    def record(self, change, using):
+        callback = CommitChange(self, change)
+        self.waiting.append(weakref.ref(callback))
+        transaction.on_commit(callback, using=using)
+
+    def committed(self, callback):
+        change = callback.change
+        previous = self.changes.get(change["id"])
+        if previous and "changed" in previous and "changed" in change:
+            previous["changed"].update(change["changed"])
+        else:
+            self.changes[change["id"]] = change
+        self.waiting = [ref for ref in self.waiting if ref() not in (None, callback)]
+        if not self.waiting:
+            send_changes(list(self.changes.values()))
+
+
+class CommitChange:
+    def __init__(self, batch, change):
+        self.batch = batch
+        self.change = change
+
+    def __call__(self):
+        self.batch.committed(self)
+
+
+def current_batch(using):
+    connection = transaction.get_connection(using)
+    if not hasattr(_local, "batches"):
+        _local.batches = {}
+    batch = _local.batches.get(connection.alias)
+    # A batch with nothing left to run was sent or rolled back
+    if batch is None or not batch.alive():
+        batch = _local.batches[connection.alias] = ChangeBatch()
+    return batch
+
+
+def record_change(change, using):
+    if not transaction.get_connection(using).in_atomic_block:
+        send_changes([change])
+        return
+    current_batch(using).record(change, using)
+
+
+def send_changes(changes):
+    if not changes:
+        return
+    try:
+        channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_send)(
+            EXECUTIVES_GROUP,
+            {
+                "type": "send_executive_update",
+                "data": changes
+            }
+        )
+    except Exception as e:
+        print(f"Executive update broadcast failed: {e}")
+
+
+@receiver(pre_save, sender=Executive)
+def executive_saving(sender, instance, update_fields=None, **kwargs):
+    instance.__dict__["_feed_stored"] = stored_state(instance, update_fields)
+
 
 @receiver(post_save, sender=Executive)
-def executive_saved(sender, instance, **kwargs):
-    broadcast_executives()
+def executive_saved(sender, instance, created, update_fields=None, using=None, **kwargs):
+    state = instance.__dict__.pop("_feed_stored", {})
+    changed = changed_fields(instance, {} if created else state, update_fields)
+    remember(instance, update_fields)
+    if changed:
+        record_change(
+            {"id": instance.pk, "executive_id": instance.executive_id, "changed": changed},
+            using,
+        )
+
 
 @receiver(post_delete, sender=Executive)
-def executive_deleted(sender, instance, **kwargs):
-    broadcast_executives()
+def executive_deleted(sender, instance, using=None, **kwargs):
+    record_change({"id": instance.pk, "executive_id": instance.executive_id, "deleted": True}, using)
@@ -1,3 +1,172 @@
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from executives.models import Executive
+from users import signals
+from users.blacklist import BloomFilter, jti_blacklist
+from users.models import UserProfile, UserProfileBlacklistedToken, UserProfileOutstandingToken
+from users.utils import blacklist_token, create_tokens_for_userprofile, is_token_blacklisted
 
-# Create your tests here.
+
+class ExecutiveChangeFeedTests(TestCase):
+    def setUp(self):
+        self.sent = []
+        original = signals.send_changes
+        signals.send_changes = lambda changes: self.sent.append(changes) if changes else None
+        self.addCleanup(setattr, signals, "send_changes", original)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.executive = Executive.objects.create(executive_id="EX1", mobile_number="8000000001")
+        self.assertEqual(self.sent[0][0]["changed"]["executive_id"], "EX1")
+        self.sent.clear()
+
+    def test_save_sends_only_changed_fields(self):
+        executive = Executive.objects.get(pk=self.executive.pk)
+        # The stored values are read for the first full save only
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(2):
+            executive.on_call = True
+            executive.save()
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(1):
+            executive.name = "Asha"
+            executive.save()
+        self.assertEqual(self.sent, [
+            [{"id": executive.pk, "executive_id": "EX1", "changed": {"on_call": True}}],
+            [{"id": executive.pk, "executive_id": "EX1", "changed": {"name": "Asha"}}],
+        ])
+
+    def test_loading_executives_takes_no_snapshot(self):
+        self.assertNotIn("_feed_state", Executive.objects.get(pk=self.executive.pk).__dict__)
+
+    def test_no_op_save_sends_nothing(self):
+        executive = Executive.objects.get(pk=self.executive.pk)
+        executive.save()
+        executive.on_call = True
+        executive.save(update_fields=["name"])
+        self.assertEqual(self.sent, [])
+
+    def test_changes_in_one_transaction_are_sent_once_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            other = Executive.objects.create(executive_id="EX2", mobile_number="8000000002")
+        other_pk = other.pk
+        self.sent.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.executive.name = "Asha"
+                self.executive.save()
+                self.executive.is_online = True
+                self.executive.save()
+                other.delete()
+                self.assertEqual(self.sent, [])
+        self.assertEqual(self.sent, [[
+            {"id": self.executive.pk, "executive_id": "EX1", "changed": {"name": "Asha", "is_online": True}},
+            {"id": other_pk, "executive_id": "EX2", "deleted": True},
+        ]])
+
+    def test_rolled_back_changes_are_not_sent(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        self.executive.on_call = True
+                        self.executive.save()
+                        raise ValueError
+                except ValueError:
+                    pass
+                self.executive.refresh_from_db()
+                self.executive.is_banned = True
+                self.executive.save(update_fields=["is_banned"])
+        self.assertEqual(self.sent, [[{"id": self.executive.pk, "executive_id": "EX1", "changed": {"is_banned": True}}]])
+
+
+class ExecutiveChangeFeedCommitTests(TransactionTestCase):
+    def test_batches_follow_real_commits_and_rollbacks(self):
+        sent = []
+        original = signals.send_changes
+        signals.send_changes = sent.append
+        self.addCleanup(setattr, signals, "send_changes", original)
+        executive = Executive.objects.create(executive_id="EX1", mobile_number="8000000001")
+        sent.clear()
+
+        with transaction.atomic():
+            executive.name = "Asha"
+            executive.save(update_fields=["name"])
+            try:
+                with transaction.atomic():
+                    executive.on_call = True
+                    executive.save(update_fields=["on_call"])
+                    raise ValueError
+            except ValueError:
+                pass
+        with transaction.atomic():
+            executive.is_banned = True
+            executive.save(update_fields=["is_banned"])
+            transaction.set_rollback(True)
+        with transaction.atomic():
+            executive.is_online = True
+            executive.save(update_fields=["is_online"])
+
+        self.assertEqual(sent, [
+            [{"id": executive.pk, "executive_id": "EX1", "changed": {"name": "Asha"}}],
+            [{"id": executive.pk, "executive_id": "EX1", "changed": {"is_online": True}}],
+        ])
+
+
+class JtiBlacklistTests(TestCase):
+    def setUp(self):
+        jti_blacklist.reset()
+        self.addCleanup(jti_blacklist.reset)
+        self.user = UserProfile.objects.create(mobile_number="9000000001")
+        self.refresh = create_tokens_for_userprofile(self.user)["refresh"]
+        self.outstanding = UserProfileOutstandingToken.objects.get(token=self.refresh)
+
+    def test_unlisted_tokens_cost_no_query_once_loaded(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(is_token_blacklisted("unlisted"))
+        with self.assertNumQueries(0):
+            for i in range(100):
+                self.assertFalse(is_token_blacklisted(f"unlisted-{i}"))
+
+    def test_blacklist_token_updates_the_index(self):
+        is_token_blacklisted("load")
+        blacklist_token(self.refresh)
+        with self.assertNumQueries(0):
+            self.assertTrue(is_token_blacklisted(self.outstanding.jti))
+
+    @override_settings(USER_JTI_BLACKLIST_REFRESH_SECONDS=0)
+    def test_tokens_blacklisted_elsewhere_are_picked_up(self):
+        self.assertFalse(is_token_blacklisted(self.outstanding.jti))
+        UserProfileBlacklistedToken.objects.create(token=self.outstanding)
+        # refresh, then the filter hit is confirmed against the table
+        with self.assertNumQueries(2):
+            self.assertTrue(is_token_blacklisted(self.outstanding.jti))
+
+    def test_rows_committed_out_of_id_order_are_picked_up(self):
+        other = UserProfileOutstandingToken.objects.get(token=create_tokens_for_userprofile(self.user)["refresh"])
+        late = UserProfileBlacklistedToken.objects.create(token=other)
+        UserProfileBlacklistedToken.objects.create(token=self.outstanding)
+        late.delete()
+        jti_blacklist.refresh()  # sees the higher id only
+        UserProfileBlacklistedToken.objects.create(id=late.id, token=other)
+
+        jti_blacklist.refresh()
+        self.assertTrue(is_token_blacklisted(other.jti))
+
+    def test_reload_rebuilds_the_filter(self):
+        is_token_blacklisted("load")
+        jti_blacklist._filter.add("stale")
+        UserProfileBlacklistedToken.objects.create(token=self.outstanding)
+        jti_blacklist.reload()
+        self.assertNotIn("stale", jti_blacklist._filter)
+        self.assertTrue(is_token_blacklisted(self.outstanding.jti))
+
+    def test_filter_hits_are_confirmed_against_the_database(self):
+        is_token_blacklisted("load")
+        jti_blacklist._filter.add("stale")
+        with self.assertNumQueries(1):
+            self.assertFalse(is_token_blacklisted("stale"))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(bits=1 << 16, hashes=5)
+        for i in range(1000):
+            bloom.add(f"jti-{i}")
+        self.assertTrue(all(f"jti-{i}" in bloom for i in range(1000)))
+        false_positives = sum(f"other-{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 100)
@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta, timezone
 from rest_framework_simplejwt.tokens import RefreshToken
 from users.models import UserProfileOutstandingToken, UserProfileBlacklistedToken
+from users.blacklist import jti_blacklist
 
 class UserProfileRefreshToken(RefreshToken):
     
@@ -29,12 +30,13 @@ def create_tokens_for_userprofile(user):
     }
 
 def is_token_blacklisted(jti):
-    return UserProfileBlacklistedToken.objects.filter(token__jti=jti).exists()
+    return jti in jti_blacklist
 
 def blacklist_token(token_str):
     try:
         outstanding_token = UserProfileOutstandingToken.objects.get(token=token_str)
         UserProfileBlacklistedToken.objects.get_or_create(token=outstanding_token)
+        jti_blacklist.add(outstanding_token.jti)
     except UserProfileOutstandingToken.DoesNotExist:
         pass
 
@@ -136,7 +136,7 @@ class RegisterOrLoginView(APIView):
 from rest_framework_simplejwt.tokens import RefreshToken , TokenError
 
 
-from users.utils import create_tokens_for_userprofile
+from users.utils import blacklist_token, create_tokens_for_userprofile
 
 class VerifyOTPView(APIView):
     permission_classes = []
@@ -216,6 +216,7 @@ class LogoutView(APIView):
             user.save(update_fields=['is_active', 'is_loginned', 'is_online'])
             
             token.blacklist()
+            blacklist_token(refresh_token)
             
             return Response({'message': 'Logout successful.'}, status=status.HTTP_200_OK)
             